@@ -4,77 +4,63 @@ from subprocess import call, Popen, PIPE
 import argparse
 import sys
 import os
+import io
 import threading
-from multiprocessing import Queue
+import time
+from Queue import Queue
+from collections import namedtuple
+from multiprocessing import Pool
 import datetime
-import re
-from shared import (BackupError, DDError, AverageSpeedCalculator, outputStatus, humanReadableSize,
-                    humanReadableSizeToBytes, partsInSnapshot, findDiskDeviceIdentifierByUUID, isUUID)
-
-_nullBlock = '\0'
+import shutil
+from shared import (BackupError, BackupDataError, DDError, AverageSpeedCalculator, outputStatus, humanReadableSize,
+                    humanReadableSizeToBytes, partsInSnapshot, deviceIdentifierForSourceString, isUUID, ManifestEntry,
+                    partDigest, zeroPartDigest, manifestPath, readManifest, writeManifest, manifestEntryForPartFile,
+                    inProgressSnapshotName, isSnapshotDir, isPartFile, partIndexFromName, fileOrDeviceSize, partCodec,
+                    partFileName, partNamesByIndex, readPartData, humanReadableDuration, forEachInParallel,
+                    partNeedsDecoding, partDeltaPaths, storedPartDataSize, isDeltaFile, deltaFileName, deltasInSnapshot,
+                    deltaNamesByIndex)
+from comparison import (firstNonZeroOffset, firstDifferenceOffset, firstNonZeroOffsetInFile,
+                        firstDifferenceOffsetInFiles, firstDifferenceOffsetWithFile, zeroPage, window)
+from metrics import Metrics
+from throttle import Throttle, addThrottleArguments, throttleFromArguments, outputThrottledTime
+from diskio import (cloneFile, fadvise, dropFromCache, openUncached, alignedBuffer, directIOAlignment, dataRanges,
+                    POSIX_FADV_SEQUENTIAL, POSIX_FADV_WILLNEED, POSIX_FADV_DONTNEED)
+from changelog import changeLogPath, writeChangeLog
+from delta import encodeDelta, deltaChainSize, defaultDeltaRatio
+from objectstore import (ObjectStore, emptyObjectName, indexPath, readIndex, writeIndex, isObjectStoreSnapshot,
+                         objectStoreOfBackup)
+from compression import (availableCodecs, codecFunctions, compressData, compressedPartHeader, isWorthCompressing,
+                         defaultEntropyThreshold, maximumCompressionRatio, UnknownCodecError)
 
 def isFileAllZeros(path, blockSize):
     """Returns true if the file at path contains no data other than 0. Will check data in increments of blockSize."""
-    global _nullBlock
-    
-    # Quick optimization so that we don't have to recreate _nullBlock more than necessary
-    if len(_nullBlock) != blockSize:
-        _nullBlock = '\0' * blockSize
-    
-    result = False
-    
-    with open(path, 'rb') as f:
-        while True:
-            block = f.read(blockSize)
-            
-            if len(block) == 0:
-                break
-            
-            result = True
-            
-            if len(block) == blockSize and block != _nullBlock:
-                return False
-            elif block != ('\0' * len(block)):
-                return False
-    
-    return result
+    return os.stat(path).st_size > 0 and firstNonZeroOffsetInFile(path, blockSize) is None
 
 def areFilesIdentical(path1, path2, blockSize):
     """Returns true if both files contain identical data. Will check data in increments of blockSize."""
-    with open(path1, 'rb') as f1:
-        with open(path2, 'rb') as f2:
-            while True:
-                block1 = f1.read(blockSize)
-                block2 = f2.read(blockSize)
-                
-                if block1 != block2:
-                    return False
-                
-                if len(block1) == 0:
-                    break
-    
-    return True
+    return firstDifferenceOffsetInFiles(path1, path2, blockSize) is None
 
-def partPathAtIndex(dest, index):
-    """Returns the path of a backup part for the given backup destination and index"""
-    return os.path.join(dest, 'part_%08d' % index)
-    
 def newPartPathAtIndex(dest, index):
     """Returns the path of a newly created backup part for the given backup destination and index. A new part has not
     yet been compared to an existing part to see if they're identical or if the new part contains all zeros"""
     return os.path.join(dest, 'part_%08d.new' % index)
 
-def copyPartToDisk(source, dest, partSize, blockSize, index, speedCalculator):
-    """Copies source into dest in partSize chunks. Returns the path of the newly created part, or None if the part
-    was within partSize-1 bytes of the end of source and there are no more parts to copy."""
-    partBlockCount = partSize // blockSize
-    partPath = newPartPathAtIndex(dest, index)
-    
-    if speedCalculator.averageSpeed() is not None:
+def outputCopyStatus(index, speedCalculator, metrics):
+    if speedCalculator.averageSpeed() is not None and metrics.eta() is not None:
+        outputStatus("Copying part %s ... speed: %s/sec, %s remaining" %
+                     (index+1, humanReadableSize(speedCalculator.averageSpeed()), humanReadableDuration(metrics.eta())))
+    elif speedCalculator.averageSpeed() is not None:
         outputStatus("Copying part %s ... speed: %s/sec" %
                      (index+1, humanReadableSize(speedCalculator.averageSpeed())))
     else:
         outputStatus("Copying part %s ..." % (index+1))
+
+def copyPartToDisk(source, dest, partSize, blockSize, index, speedCalculator, metrics):
+    """Copies source into dest in partSize chunks. Returns the path of the newly created part, or None if the part
+    was within partSize-1 bytes of the end of source and there are no more parts to copy."""
+    partBlockCount = partSize // blockSize
+    partPath = newPartPathAtIndex(dest, index)
+    outputCopyStatus(index, speedCalculator, metrics)
     
     p = Popen(['dd', 'if=%s' % source, 'of=%s' % partPath, 'bs=%s' % blockSize,
                'count=%s' % partBlockCount, 'skip=%s' % (index*partBlockCount)],
@@ -95,29 +81,35 @@ def copyPartToDisk(source, dest, partSize, blockSize, index, speedCalculator):
     else:
         return (partPath, newPartSize)
 
-def compareNewPart(newPartPath, partSize, blockSize, keepNullParts):
-    """Compares a freshly completed part to the previously existing part (if one exists) as well as checking
-    if the part is all zeros"""
+def compareNewPart(newPartPath, partSize, blockSize, keepNullParts, prevPartPath):
+    """Compares a freshly completed part to the previously existing part at prevPartPath, which may be compressed or
+    None if there is no previous part, as well as checking if the part is all zeros"""
     def areOldAndNewPartsIdentical(prevPartPath, newPartPath, newPartIsAllZeros):
         newPartSize = os.stat(newPartPath).st_size
         prevPartSize = os.stat(prevPartPath).st_size
         
         if not keepNullParts and prevPartSize == 0 and newPartIsAllZeros:
             return True
+        elif partNeedsDecoding(prevPartPath):
+            prevPartData = readPartData(prevPartPath)
+            return firstDifferenceOffsetWithFile(prevPartData, len(prevPartData), newPartPath, blockSize) is None
         else:
             result = areFilesIdentical(prevPartPath, newPartPath, blockSize)
             return result
     
     newPartIsAllZeros = isFileAllZeros(newPartPath, blockSize)
-    prevPartPath = os.path.splitext(newPartPath)[0]
     
-    if os.path.exists(prevPartPath):
+    if prevPartPath is not None:
         if areOldAndNewPartsIdentical(prevPartPath, newPartPath, newPartIsAllZeros):
             os.remove(newPartPath)
             return False
         else:
+            for deltaPath in partDeltaPaths(prevPartPath):
+                os.remove(deltaPath)
+            
             os.remove(prevPartPath)
     
+    prevPartPath = os.path.splitext(newPartPath)[0]
     os.rename(newPartPath, prevPartPath)
     
     # Only want to consider files that are of size partSize
@@ -128,26 +120,691 @@ def compareNewPart(newPartPath, partSize, blockSize, keepNullParts):
     
     return True
 
-def removeExcessPartsInDestStartingAtIndex(dest, index):
-    """Used to remove parts that are no longer needed for the given backup destination."""
-    deletedFiles = 0
+def readPartIntoBuffer(sourceFile, buffer, partSize, blockSize, index, throttle=None):
+    """Reads the part at the given index of sourceFile into buffer, in increments of blockSize. Returns the number of
+    bytes read, which is less than partSize for the final part and 0 past the end of the source."""
+    view = memoryview(buffer)
     
-    while os.path.exists(partPathAtIndex(dest, index)):
-        os.remove(partPathAtIndex(dest, index))
-        index += 1
-        deletedFiles += 1
+    if sourceFile.seekable():
+        sourceFile.seek(index * partSize)
     
-    return deletedFiles
+    bytesRead = 0
+    
+    while bytesRead < partSize:
+        startTime = time.time()
+        count = sourceFile.readinto(view[bytesRead:bytesRead+blockSize])
+        
+        if not count:
+            break
+        
+        if throttle is not None:
+            throttle.read(count, index, time.time() - startTime)
+        
+        bytesRead += count
+    
+    return bytesRead
 
-def snapshotTimestamp():
-    return "snapshot-%s" % datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
+def readSparsePartIntoBuffer(sourceFile, buffer, partSize, blockSize, index, throttle=None):
+    """Like readPartIntoBuffer, but only reads the blocks holding data and fills the holes in with zeros. Returns
+    the number of bytes in the part and the number actually read, or None if the holes can't be found."""
+    partOffset = index * partSize
+    length = max(0, min(partSize, os.fstat(sourceFile.fileno()).st_size - partOffset))
+    ranges = dataRanges(sourceFile.fileno(), partOffset, length)
+    
+    if ranges is None:
+        return None
+    
+    view = memoryview(buffer)
+    position = 0
+    bytesRead = 0
+    
+    for offset, count in ranges:
+        # Ranges are widened to whole blocks, which keeps reads aligned for O_DIRECT
+        start = max(position, (offset - partOffset) // blockSize * blockSize)
+        end = min(partSize, -(-(offset - partOffset + count) // blockSize) * blockSize)
+        
+        if start >= end:
+            continue
+        
+        view[position:start] = window(zeroPage(start - position), 0, start - position)
+        sourceFile.seek(partOffset + start)
+        position = start
+        
+        while position < end:
+            startTime = time.time()
+            count = sourceFile.readinto(view[position:min(position+blockSize, end)])
+            
+            # The source has been truncated since we looked at its size
+            if not count:
+                return position, bytesRead
+            
+            if throttle is not None:
+                throttle.read(count, index, time.time() - startTime)
+            
+            position += count
+            bytesRead += count
+    
+    if position < length:
+        view[position:length] = window(zeroPage(length - position), 0, length - position)
+    
+    return max(length, min(position, partSize)), bytesRead
+
+def isBufferAllZeros(buffer, length, blockSize):
+    """Returns true if the first length bytes of buffer contain no data other than 0. Will check data in increments of
+    blockSize."""
+    return length > 0 and firstNonZeroOffset(buffer, blockSize, length) is None
+
+def isBufferIdenticalToFile(buffer, length, path, blockSize):
+    """Returns true if the file at path contains exactly the first length bytes of buffer. Will check data in
+    increments of blockSize."""
+    return os.stat(path).st_size == length and firstDifferenceOffsetWithFile(buffer, length, path, blockSize) is None
+
+# The outcome of checking a part read from the source. If changed is true, the part has been written to its new part
+# path and still needs to be committed under partName.
+PreparedPart = namedtuple('PreparedPart', ['index', 'entry', 'changed', 'partName'])
+
+def isBufferIdenticalToPart(buffer, length, partPath, blockSize):
+    """Returns true if the part at partPath, which may be compressed or have deltas, contains exactly the first length
+    bytes of buffer"""
+    if partNeedsDecoding(partPath):
+        data = readPartData(partPath)
+        return len(data) == length and firstDifferenceOffset(buffer, data, blockSize, length) is None
+    
+    return isBufferIdenticalToFile(buffer, length, partPath, blockSize)
+
+class BackupDestination(object):
+    """A folder that parts are backed up into, along with its manifest, the names of its existing parts, and its
+    journal"""
+    def __init__(self, path, partSize, blockSize, keepNullParts, manifest, journal, metrics, codec=None,
+                 compressionPool=None, entropyThreshold=defaultEntropyThreshold, deltaDepth=0,
+                 deltaRatio=defaultDeltaRatio, dropCache=False, throttle=None):
+        self.path = path
+        self.partSize = partSize
+        self.blockSize = blockSize
+        self.keepNullParts = keepNullParts
+        self.manifest = manifest
+        self.journal = journal
+        self.codec = codec
+        self.compressionPool = compressionPool
+        self.entropyThreshold = entropyThreshold
+        self.metrics = metrics
+        self.deltaDepth = deltaDepth
+        self.deltaRatio = deltaRatio
+        self.dropCache = dropCache
+        self.throttle = throttle if throttle is not None else Throttle()
+        self.partNames = partNamesByIndex(path)
+        self.deltaNames = deltaNamesByIndex(path)
+    
+    def existingPartPath(self, index):
+        """Returns the path of the existing part at index in whatever format it was stored, or None if there is none"""
+        if index not in self.partNames:
+            return None
+        
+        return os.path.join(self.path, self.partNames[index])
+    
+    def preparePart(self, buffer, length, index, entry, storeAsEmpty):
+        """Checks a part that has been read into buffer against the existing part, and if it has changed writes it to
+        its new part path. Returns a PreparedPart."""
+        view = memoryview(buffer)[:length]
+        prevPartPath = self.existingPartPath(index)
+        
+        if prevPartPath is not None:
+            prevEntry = self.manifest.get(index)
+            prevPartSize = os.stat(prevPartPath).st_size
+            
+            if prevEntry is not None and (partCodec(prevPartPath) is not None or index in self.deltaNames):
+                unchanged = prevEntry == entry
+            elif prevEntry is not None:
+                # A part of zeros that was kept at full size is still considered unchanged, same as when comparing
+                # files
+                unchanged = prevEntry == entry and prevPartSize in (0 if storeAsEmpty else length, length)
+            elif storeAsEmpty and prevPartSize == 0:
+                unchanged = True
+            else:
+                with self.metrics.stage('compare', index):
+                    unchanged = isBufferIdenticalToPart(buffer, length, prevPartPath, self.blockSize)
+                
+                self.dropPartFromCache(prevPartPath)
+            
+            if unchanged:
+                self.metrics.count('partsUnchanged')
+                return PreparedPart(index, entry, False, None)
+        
+        delta = None
+        
+        if self.deltaDepth > 0 and prevPartPath is not None and not storeAsEmpty:
+            delta = self.deltaForPart(view, length, index, prevPartPath)
+        
+        if delta is not None:
+            partName, chunks = delta
+        else:
+            partName, chunks = self.encodePart(view, length, index, partFileName(index), storeAsEmpty)
+        
+        with self.metrics.stage('write', index):
+            with open(newPartPathAtIndex(self.path, index), 'wb') as f:
+                for chunk in self.throttle.writeChunks(chunks, self.blockSize, index):
+                    f.write(chunk)
+                
+                # The part has to be on disk before it's committed and recorded in the journal
+                f.flush()
+                os.fsync(f.fileno())
+                
+                if self.dropCache:
+                    fadvise(f.fileno(), 0, 0, POSIX_FADV_DONTNEED)
+        
+        self.metrics.count('partsChanged')
+        self.metrics.count('bytesWritten', sum(len(chunk) for chunk in chunks))
+        return PreparedPart(index, entry, True, partName)
+    
+    def describePart(self, buffer, length, index, isHole=False):
+        """Returns the ManifestEntry of a part that has been read into buffer, and whether it should be stored as an
+        empty part. isHole is set for a part that lies entirely in a hole of a sparse source."""
+        with self.metrics.stage('zeroCheck', index):
+            isAllZeros = length > 0 and (isHole or isBufferAllZeros(buffer, length, self.blockSize))
+        
+        if isAllZeros:
+            self.metrics.count('partsZero')
+        
+        with self.metrics.stage('hash', index):
+            entry = ManifestEntry(length, isAllZeros,
+                                  zeroPartDigest(length) if isAllZeros else partDigest(memoryview(buffer)[:length]))
+        
+        return entry, not self.keepNullParts and length == self.partSize and isAllZeros
+    
+    def encodePart(self, view, length, index, name, storeAsEmpty):
+        """Returns the name to store a changed part under, which is name with the codec as its extension if the part is
+        compressed, and the chunks of data to write to it. The part is compressed if there's a codec, the data looks
+        like it will compress, and it actually does."""
+        if storeAsEmpty:
+            return name, []
+        
+        if self.codec is not None and isWorthCompressing(view, length, self.entropyThreshold):
+            with self.metrics.stage('compress', index):
+                compressed = self.compressionPool.apply(compressData, (self.codec, view.tobytes()))
+            
+            if len(compressed) <= length * maximumCompressionRatio:
+                self.metrics.count('partsCompressed')
+                return '%s.%s' % (name, self.codec), [compressedPartHeader(length), compressed]
+        
+        return name, [view]
+    
+    def deltaForPart(self, view, length, index, prevPartPath):
+        """Returns the name and chunks of a delta against the existing part at prevPartPath to store the changed part
+        as, or None if it should be stored whole"""
+        deltaNames = self.deltaNames.get(index, [])
+        
+        if len(deltaNames) >= self.deltaDepth or storedPartDataSize(prevPartPath) != length:
+            return None
+        
+        with self.metrics.stage('delta', index):
+            chunks = encodeDelta(view, readPartData(prevPartPath), length, self.blockSize)
+        
+        self.dropPartFromCache(prevPartPath)
+        
+        chainSize = (deltaChainSize([os.path.join(self.path, name) for name in deltaNames]) +
+                     sum(len(chunk) for chunk in chunks))
+        
+        if chainSize > length * self.deltaRatio:
+            return None
+        
+        self.metrics.count('partsDelta')
+        return deltaFileName(index, len(deltaNames)+1), chunks
+    
+    def dropPartFromCache(self, partPath):
+        """Drops a part that has been read, along with its deltas, from the page cache if dropCache is set"""
+        if self.dropCache:
+            for path in [partPath] + partDeltaPaths(partPath):
+                dropFromCache(path)
+    
+    def removeDeltas(self, index):
+        for name in self.deltaNames.pop(index, []):
+            os.remove(os.path.join(self.path, name))
+    
+    def commitPart(self, preparedPart):
+        """Replaces the existing part with the newly written one if the part changed, or adds the newly written delta
+        to the part's chain, and records it in the manifest and journal."""
+        index = preparedPart.index
+        
+        with self.metrics.stage('commit', index):
+            if preparedPart.changed and isDeltaFile(preparedPart.partName):
+                os.rename(newPartPathAtIndex(self.path, index), os.path.join(self.path, preparedPart.partName))
+                self.deltaNames.setdefault(index, []).append(preparedPart.partName)
+            elif preparedPart.changed:
+                prevPartPath = self.existingPartPath(index)
+                
+                # The old part's deltas are removed first, so that they're never applied to the new part
+                self.removeDeltas(index)
+                
+                # A part stored in a different format than before doesn't replace the old file by being renamed. The old
+                # file is removed first so that there's never more than one file for the part, which is safe since the
+                # part isn't in the journal yet and is backed up again if this is interrupted.
+                if prevPartPath is not None and self.partNames[index] != preparedPart.partName:
+                    os.remove(prevPartPath)
+                
+                os.rename(newPartPathAtIndex(self.path, index), os.path.join(self.path, preparedPart.partName))
+                self.partNames[index] = preparedPart.partName
+            
+            self.manifest[index] = preparedPart.entry
+            self.journal.record(preparedPart)
+    
+    def removeExcessParts(self, index):
+        """Used to remove parts that are no longer needed, starting at index. Returns the number of parts removed."""
+        for excessIndex in [i for i in self.manifest.keys() if i >= index]:
+            del self.manifest[excessIndex]
+        
+        excessIndexes = [i for i in self.partNames.keys() if i >= index]
+        
+        for excessIndex in [i for i in self.deltaNames.keys() if i >= index]:
+            self.removeDeltas(excessIndex)
+        
+        for excessIndex in excessIndexes:
+            os.remove(self.existingPartPath(excessIndex))
+            del self.partNames[excessIndex]
+        
+        self.metrics.count('partsRemoved', len(excessIndexes))
+        return len(excessIndexes)
+    
+    def saveManifest(self):
+        writeManifest(self.path, self.manifest)
+
+class ObjectStoreDestination(BackupDestination):
+    """A snapshot whose parts are kept in an object store. Here partNames maps part index to object name."""
+    def __init__(self, path, partSize, blockSize, keepNullParts, manifest, journal, metrics, store, objectNames,
+                 codec=None, compressionPool=None, entropyThreshold=defaultEntropyThreshold, dropCache=False,
+                 throttle=None):
+        BackupDestination.__init__(self, path, partSize, blockSize, keepNullParts, manifest, journal, metrics, codec,
+                                   compressionPool, entropyThreshold, dropCache=dropCache, throttle=throttle)
+        self.store = store
+        self.partNames = objectNames
+    
+    def existingPartPath(self, index):
+        if index not in self.partNames:
+            return None
+        
+        return self.store.objectPath(self.partNames[index])
+    
+    def preparePart(self, buffer, length, index, entry, storeAsEmpty):
+        """Checks a part that has been read into buffer, and described by describePart, against the index of the
+        previous snapshot, and if it has changed looks for it in the store, writing it to the store only if it isn't
+        there. Returns a PreparedPart."""
+        view = memoryview(buffer)[:length]
+        prevObjectName = self.partNames.get(index)
+        
+        if (self.manifest.get(index) == entry and prevObjectName is not None and
+                (prevObjectName == emptyObjectName) == storeAsEmpty):
+            self.metrics.count('partsUnchanged')
+            return PreparedPart(index, entry, False, None)
+        
+        if storeAsEmpty:
+            objectName = emptyObjectName
+        else:
+            with self.metrics.stage('lookup', index):
+                objectName = self.store.findObject(entry.digest)
+        
+        if objectName is None:
+            objectName, chunks = self.encodePart(view, length, index, entry.digest, False)
+            
+            with self.metrics.stage('write', index):
+                self.store.writeObject(objectName, self.throttle.writeChunks(chunks, self.blockSize, index))
+                
+                if self.dropCache:
+                    dropFromCache(self.store.objectPath(objectName))
+            
+            self.metrics.count('bytesWritten', sum(len(chunk) for chunk in chunks))
+        elif not storeAsEmpty:
+            self.metrics.count('partsDeduplicated')
+        
+        self.metrics.count('partsChanged')
+        return PreparedPart(index, entry, True, objectName)
+    
+    def commitPart(self, preparedPart):
+        """Records the part in the index and journal. Objects are written straight into the store, so there's nothing
+        to replace."""
+        index = preparedPart.index
+        
+        with self.metrics.stage('commit', index):
+            if preparedPart.changed:
+                self.partNames[index] = preparedPart.partName
+            
+            self.manifest[index] = preparedPart.entry
+            self.journal.record(preparedPart)
+    
+    def removeExcessParts(self, index):
+        excessIndexes = [i for i in self.partNames.keys() if i >= index]
+        
+        for excessIndex in excessIndexes:
+            del self.partNames[excessIndex]
+        
+        for excessIndex in [i for i in self.manifest.keys() if i >= index]:
+            del self.manifest[excessIndex]
+        
+        self.metrics.count('partsRemoved', len(excessIndexes))
+        return len(excessIndexes)
+    
+    def saveManifest(self):
+        writeIndex(self.path, self.store.path, self.manifest, self.partNames)
+
+def journalPath(dest):
+    return os.path.join(dest, 'journal')
+
+def journalHeader(sourceSize, partSize, keepNullParts):
+    """Returns the first line of a journal. A journal is only resumed from if its header matches, i.e. if the source
+    is the same size and the backup uses the same settings. sourceSize is None for a stream of unknown size."""
+    return 'multipart-backup-journal 1 %s %d %d\n' % ('-' if sourceSize is None else sourceSize, partSize,
+                                                       1 if keepNullParts else 0)
+
+def readJournal(dest, header):
+    """Returns the parts recorded as committed in the journal in dest as a list of PreparedParts, in order of part
+    index starting at 0. Returns None if there's no journal or if its header doesn't match."""
+    if not os.path.exists(journalPath(dest)):
+        return None
+    
+    committedParts = []
+    
+    with open(journalPath(dest), 'r') as f:
+        if f.readline() != header:
+            return None
+        
+        for line in f:
+            fields = line.split()
+            
+            # A line that's incomplete or out of order means the backup was interrupted while writing it
+            if (not line.endswith('\n') or len(fields) not in (5, 6) or not isPartFile(fields[0]) or
+                    partIndexFromName(fields[0]) != len(committedParts)):
+                break
+            
+            entry = ManifestEntry(int(fields[1]), fields[2] == '1', fields[3])
+            partName = fields[5] if len(fields) == 6 else None
+            committedParts.append(PreparedPart(len(committedParts), entry, fields[4] == '1', partName))
+    
+    return committedParts
+
+def removeNewParts(dest, committedParts):
+    """Removes new parts that were left behind, possibly half written, by an interrupted backup, along with any part
+    that's stored in more than one format. Raises BackupDataError if the journal doesn't say which file of a committed
+    part is the right one."""
+    for filename in os.listdir(dest):
+        if filename.endswith('.new') and isPartFile(os.path.splitext(filename)[0]):
+            os.remove(os.path.join(dest, filename))
+    
+    partNames = {}
+    
+    for name in partsInSnapshot(dest):
+        partNames.setdefault(partIndexFromName(name), []).append(name)
+    
+    for index, names in partNames.items():
+        if len(names) < 2:
+            continue
+        
+        if index < len(committedParts):
+            keep = committedParts[index].partName
+            
+            if keep not in names:
+                raise BackupDataError('%s contains more than one file for part %s: %s' %
+                                      (dest, index, ', '.join(names)))
+        else:
+            # A part that hasn't been committed is backed up again from scratch
+            keep = None
+        
+        for name in names:
+            if name != keep:
+                os.remove(os.path.join(dest, name))
+
+class CommitJournal(object):
+    """Append-only record of the parts that have been committed to an in-progress backup, so that an interrupted
+    backup can continue where it left off instead of starting over from the first part. The indexes of the parts it
+    recorded as changed are kept for the change log. restartedParts are the parts committed by an interrupted backup
+    that's being started over from the first part, whose changes are carried over as the parts are recorded again."""
+    def __init__(self, dest, header, resume, restartedParts=()):
+        self.changedIndexes = set()
+        self.restartedParts = restartedParts
+        
+        if resume:
+            self.file = open(journalPath(dest), 'a')
+        else:
+            self.file = open(journalPath(dest), 'w')
+            self.file.write(header)
+            self.sync()
+    
+    def record(self, preparedPart):
+        """Records a committed part. The name a changed part was stored under is recorded as well, which is needed to
+        resume a backup into an object store."""
+        if preparedPart.index < len(self.restartedParts) and not preparedPart.changed:
+            restartedPart = self.restartedParts[preparedPart.index]
+            
+            # The part is unchanged only because the interrupted backup already changed it, so it's recorded the way
+            # that backup recorded it, or the change would be lost if this backup is interrupted as well
+            if restartedPart.changed and restartedPart.entry == preparedPart.entry:
+                preparedPart = restartedPart
+        
+        entry = preparedPart.entry
+        self.file.write('part_%08d %d %d %s %d%s\n' % (preparedPart.index, entry.size, 1 if entry.isZero else 0,
+                                                        entry.digest, 1 if preparedPart.changed else 0,
+                                                        '' if preparedPart.partName is None else
+                                                        ' ' + preparedPart.partName))
+        self.file.flush()
+        
+        # Only changed parts need to be durable before moving on. Recording them also syncs everything before them.
+        if preparedPart.changed:
+            self.changedIndexes.add(preparedPart.index)
+            self.sync()
+    
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+    
+    def close(self):
+        self.file.close()
+
+class PendingPart(object):
+    """A part that has been read into buffer and is waiting to be prepared by destinationCount destinations. It's
+    described only once, by whichever destination gets to it first, and its buffer can be reused once every
+    destination has released it. isHole is set for a part that lies entirely in a hole of a sparse source."""
+    def __init__(self, index, buffer, length, destinationCount, isHole=False):
+        self.index = index
+        self.buffer = buffer
+        self.length = length
+        self.isHole = isHole
+        self.remainingCount = destinationCount
+        self.description = None
+        self.lock = threading.Lock()
+    
+    def describe(self, destination):
+        with self.lock:
+            if self.description is None:
+                self.description = destination.describePart(self.buffer, self.length, self.index, self.isHole)
+            
+            return self.description
+    
+    def release(self):
+        """Returns true once every destination is done with the part"""
+        with self.lock:
+            self.remainingCount -= 1
+            return self.remainingCount == 0
+
+class BackupPipeline(object):
+    """Reads parts of the source once, on one thread, while a pool of workers for each destination checks them and
+    writes out the ones that changed. Prepared parts are handed back in order of index so they can be committed in
+    order."""
+    def __init__(self, sourceFile, destinations, partSize, blockSize, workerCount, queueDepth, startIndexes,
+                 isDirect=False, dropCache=False, sparse=False):
+        self.sourceFile = sourceFile
+        self.destinations = destinations
+        self.metrics = destinations[0].metrics
+        self.throttle = destinations[0].throttle
+        self.startIndexes = startIndexes
+        self.partSize = partSize
+        self.blockSize = blockSize
+        self.workerCount = workerCount
+        self.dropCache = dropCache
+        self.sparse = sparse
+        self.freeBuffers = Queue()
+        self.pendingParts = [Queue(queueDepth) for destination in destinations]
+        self.preparedParts = {}
+        self.partCount = None
+        self.error = None
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self._readParts)]
+        
+        for destinationIndex in xrange(len(destinations)):
+            self.threads += [threading.Thread(target=self._processParts, args=(destinationIndex,))
+                             for i in xrange(workerCount)]
+        
+        # Every part that has been read but not yet processed by every destination holds on to a buffer, so this
+        # bounds memory usage to (queueDepth + workerCount * number of destinations) * partSize
+        for i in xrange(queueDepth + workerCount * len(destinations)):
+            self.freeBuffers.put(alignedBuffer(partSize) if isDirect else bytearray(partSize))
+    
+    def start(self):
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+    
+    def stop(self):
+        """Stops reading any more parts and waits for all threads to finish"""
+        with self.condition:
+            self.stopped = True
+        
+        for thread in self.threads:
+            thread.join()
+    
+    def destinationIndexesForPart(self, index):
+        return [i for i, startIndex in enumerate(self.startIndexes) if index >= startIndex]
+    
+    def nextPreparedParts(self, index):
+        """Waits for the part at index to be prepared by every destination that it was handed to and returns a list of
+        the PreparedPart for each destination, with None for the destinations it wasn't handed to. Returns None if
+        there are no more parts. Re-raises any error that occurred on one of the pipeline's threads."""
+        destinationIndexes = self.destinationIndexesForPart(index)
+        
+        with self.condition:
+            while True:
+                # Parts that were prepared before an error are still handed back so that they get committed
+                preparedParts = self.preparedParts.get(index, {})
+                
+                if len(preparedParts) == len(destinationIndexes):
+                    self.preparedParts.pop(index, None)
+                    return [preparedParts.get(i) for i in xrange(len(self.destinations))]
+                
+                if self.error is not None:
+                    raise self.error
+                
+                if self.partCount is not None and index >= self.partCount:
+                    return None
+                
+                # Waiting with a timeout keeps the main thread responsive to KeyboardInterrupt
+                self.condition.wait(1)
+    
+    def _failed(self, error):
+        with self.condition:
+            if self.error is None:
+                self.error = error
+            
+            self.stopped = True
+            self.condition.notify_all()
+    
+    def _readParts(self):
+        index = min(self.startIndexes)
+        
+        try:
+            if self.dropCache:
+                fadvise(self.sourceFile.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+            
+            while not self.stopped:
+                buffer = self.freeBuffers.get()
+                
+                # While this part is read, the kernel reads ahead the next one
+                if self.dropCache:
+                    fadvise(self.sourceFile.fileno(), (index+1) * self.partSize, self.partSize, POSIX_FADV_WILLNEED)
+                
+                with self.metrics.stage('read', index):
+                    length, bytesRead = self._readPart(buffer, index)
+                
+                if self.dropCache:
+                    fadvise(self.sourceFile.fileno(), index * self.partSize, length, POSIX_FADV_DONTNEED)
+                
+                self.metrics.count('bytesRead', bytesRead)
+                
+                # If nothing was read, we've gone past the end of the file or device we're copying
+                if length == 0:
+                    self.freeBuffers.put(buffer)
+                    break
+                
+                destinationIndexes = self.destinationIndexesForPart(index)
+                pendingPart = PendingPart(index, buffer, length, len(destinationIndexes), bytesRead == 0)
+                
+                # A destination whose queue is full holds up reading here until it catches up
+                for destinationIndex in destinationIndexes:
+                    self.pendingParts[destinationIndex].put(pendingPart)
+                
+                index += 1
+                
+                if length != self.partSize:
+                    # We've hit the final part
+                    break
+        except Exception as e:
+            self._failed(e)
+        finally:
+            with self.condition:
+                self.partCount = index
+                self.condition.notify_all()
+            
+            for pendingParts in self.pendingParts:
+                for i in xrange(self.workerCount):
+                    pendingParts.put(None)
+    
+    def _readPart(self, buffer, index):
+        """Reads the part at index into buffer, skipping the holes of a sparse source. Returns the number of bytes in
+        the part and the number of bytes actually read."""
+        if self.sparse:
+            result = readSparsePartIntoBuffer(self.sourceFile, buffer, self.partSize, self.blockSize, index,
+                                              self.throttle)
+            
+            if result is not None:
+                length, bytesRead = result
+                
+                if length > bytesRead:
+                    self.metrics.count('bytesInHoles', length - bytesRead)
+                
+                return result
+            
+            # The filesystem can't tell where the holes are, so there's no point asking again
+            self.sparse = False
+        
+        length = readPartIntoBuffer(self.sourceFile, buffer, self.partSize, self.blockSize, index, self.throttle)
+        return length, length
+    
+    def _processParts(self, destinationIndex):
+        destination = self.destinations[destinationIndex]
+        
+        while True:
+            pendingPart = self.pendingParts[destinationIndex].get()
+            
+            if pendingPart is None:
+                break
+            
+            try:
+                # Parts are still taken off the queue after stopping so that the reader never blocks
+                if not self.stopped:
+                    entry, storeAsEmpty = pendingPart.describe(destination)
+                    preparedPart = destination.preparePart(pendingPart.buffer, pendingPart.length, pendingPart.index,
+                                                           entry, storeAsEmpty)
+                    
+                    with self.condition:
+                        self.preparedParts.setdefault(pendingPart.index, {})[destinationIndex] = preparedPart
+                        self.condition.notify_all()
+            except Exception as e:
+                self._failed(e)
+            finally:
+                if pendingPart.release():
+                    self.freeBuffers.put(pendingPart.buffer)
 
-def inProgressSnapshotName():
-    return 'snapshot-inprogress'
+# Snapshots beyond the number being kept are renamed with this prefix, and removed in the background by the next backup
+retiredSnapshotPrefix = 'retired-'
 
-def isSnapshotDir(dirName):
-    return (dirName == inProgressSnapshotName() or
-            re.search(r"^snapshot-\d{4}-\d{2}-\d{2}-\d{6}", dirName) is not None)
+def snapshotTimestamp():
+    return "snapshot-%s" % datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
 
 def previousSnapshots(destRoot):
     return map(lambda x: os.path.join(destRoot, x),
@@ -166,17 +823,45 @@ def createNewSnapshot(destRoot):
     os.mkdir(dest)
     return dest
 
-def createNewSnapshotWithLinksToOld(destRoot, lastSnapshot):
+class PartLinker(object):
+    """Links the parts of one snapshot into another, as hard links or, when useReflinks is set and the filesystem
+    supports it, as reflinks: separate files sharing their data blocks with the originals."""
+    def __init__(self, useReflinks):
+        self.useReflinks = useReflinks
+    
+    def link(self, sourcePath, destPath):
+        if self.useReflinks:
+            if cloneFile(sourcePath, destPath):
+                return
+            
+            # If one part can't be cloned then none of them can, since they're all on the same filesystem
+            self.useReflinks = False
+        
+        os.link(sourcePath, destPath)
+
+def createNewSnapshotWithLinksToOld(destRoot, lastSnapshot, linker, workerCount):
+    dest = createNewSnapshot(destRoot)
+    forEachInParallel(lambda part: linker.link(os.path.join(lastSnapshot, part), os.path.join(dest, part)),
+                      partsInSnapshot(lastSnapshot) + deltasInSnapshot(lastSnapshot), workerCount)
+    
+    # The manifest is copied rather than linked since it gets rewritten at the end of the backup
+    if os.path.exists(manifestPath(lastSnapshot)):
+        shutil.copyfile(manifestPath(lastSnapshot), manifestPath(dest))
+    
+    return dest
+
+def createNewSnapshotWithIndexOfOld(destRoot, lastSnapshot):
+    """Creates a new snapshot in an object store, which only needs a copy of the previous snapshot's index"""
     dest = createNewSnapshot(destRoot)
     
-    for part in partsInSnapshot(lastSnapshot):
-        os.link(os.path.join(lastSnapshot, part), os.path.join(dest, part))
+    if isObjectStoreSnapshot(lastSnapshot):
+        shutil.copyfile(indexPath(lastSnapshot), indexPath(dest))
     
     return dest
 
-def setupAndReturnDestination(destRoot, snapshotCount):
-    """If snapshotCount > 0, either returns a new snapshot containing hard links to the previous snapshot's parts, or
-    returns an existing in-progress snapshot. If snapshotCount is 0, then returns destRoot."""
+def setupAndReturnDestination(destRoot, snapshotCount, linker, workerCount, useObjectStore):
+    """If snapshotCount > 0, either returns a new snapshot set up from the previous one, or returns an existing
+    in-progress snapshot. If snapshotCount is 0, then returns destRoot."""
     if not os.path.exists(destRoot):
         os.mkdir(destRoot)
     
@@ -185,12 +870,14 @@ def setupAndReturnDestination(destRoot, snapshotCount):
         incompleteSnapshot = findIncompleteSnapshot(prevs)
         
         if incompleteSnapshot is not None:
-            sys.stdout.write("NOTE: last snapshot is complete! Will attempt to "
+            sys.stdout.write("NOTE: last snapshot is incomplete! Will attempt to "
                              "finish it...\n")
             dest = incompleteSnapshot
+        elif len(prevs) > 0 and useObjectStore:
+            dest = createNewSnapshotWithIndexOfOld(destRoot, prevs[-1])
         elif len(prevs) > 0:
             sys.stdout.write("Setting up new snapshot...\n")
-            dest = createNewSnapshotWithLinksToOld(destRoot, prevs[-1])
+            dest = createNewSnapshotWithLinksToOld(destRoot, prevs[-1], linker, workerCount)
         else:
             dest = createNewSnapshot(destRoot)
     else:
@@ -211,61 +898,139 @@ def removeEmptyDirectoryEvenIfItHasAnAnnoyingDSStoreFileInIt(dir):
             except OSError:
                 pass
 
-def removeOldSnapshots(destRoot, snapshotCount):
-    """If the backup at the given root folder contains more snapshots than snapshotCount, removes the oldest extra
-    snapshots."""
+def retiredSnapshots(destRoot):
+    """Returns the snapshots in destRoot that have been retired and are waiting to be removed"""
+    return [os.path.join(destRoot, x) for x in sorted(os.listdir(destRoot))
+            if x.startswith(retiredSnapshotPrefix) and isSnapshotDir(x[len(retiredSnapshotPrefix):])]
+
+def retireOldSnapshots(destRoot, snapshotCount):
+    """If the backup at the given root folder contains more snapshots than snapshotCount, renames the oldest extra
+    snapshots so that they're no longer considered part of the backup. Returns the retired snapshots, which still need
+    to be removed."""
     prevs = previousSnapshots(destRoot)
-    snapshotsToRemove = prevs[:-snapshotCount]
+    retired = []
+    
+    for oldSnapshot in prevs[:-snapshotCount]:
+        retiredSnapshot = os.path.join(destRoot, retiredSnapshotPrefix + os.path.basename(oldSnapshot))
+        os.rename(oldSnapshot, retiredSnapshot)
+        retired.append(retiredSnapshot)
     
-    if len(snapshotsToRemove) > 0:
-        sys.stdout.write("Removing old snapshots...\n")
+    return retired
+
+def removeSnapshot(snapshot, workerCount):
+    """Removes the parts, manifest, index and change log of a snapshot from a pool of workerCount threads, and then the
+    snapshot folder itself if that leaves it empty"""
+    paths = [os.path.join(snapshot, part) for part in partsInSnapshot(snapshot) + deltasInSnapshot(snapshot)]
+    
+    for path in (manifestPath(snapshot), indexPath(snapshot), changeLogPath(snapshot)):
+        if os.path.exists(path):
+            paths.append(path)
+    
+    forEachInParallel(os.remove, paths, workerCount)
+    removeEmptyDirectoryEvenIfItHasAnAnnoyingDSStoreFileInIt(snapshot)
+
+class SnapshotPruner(object):
+    """Removes the snapshots retired by earlier backups on a background thread, so that they're deleted while the
+    backup runs instead of making it wait"""
+    def __init__(self, destRoot, workerCount):
+        self.snapshots = retiredSnapshots(destRoot)
+        self.workerCount = workerCount
+        self.error = None
+        self.thread = threading.Thread(target=self._removeSnapshots)
+        self.thread.daemon = True
+    
+    def start(self):
+        if len(self.snapshots) > 0:
+            self.thread.start()
+    
+    def wait(self):
+        """Waits for the old snapshots to be removed. A failure to remove them is only reported, since the backup itself
+        is unaffected and removing them will be tried again by the next backup."""
+        if len(self.snapshots) > 0:
+            self.thread.join()
         
-        for oldSnapshot in snapshotsToRemove:
-            for part in partsInSnapshot(oldSnapshot):
-                os.remove(os.path.join(oldSnapshot, part))
-            
-            removeEmptyDirectoryEvenIfItHasAnAnnoyingDSStoreFileInIt(oldSnapshot)
+        if self.error is not None:
+            sys.stderr.write('Warning: failed to remove old snapshots: %s\n' % self.error)
+    
+    def _removeSnapshots(self):
+        try:
+            for snapshot in self.snapshots:
+                removeSnapshot(snapshot, self.workerCount)
+        except Exception as e:
+            self.error = e
 
 def renameSnapshotToFinalName(dest):
     os.rename(dest, os.path.join(os.path.dirname(dest), snapshotTimestamp()))
 
-def deviceIdentifierForSourceString(source, sourceIsUUID):
-    if sourceIsUUID:
-        result = findDiskDeviceIdentifierByUUID(source)
-        
-        if result is None:
-            raise ValueError('Could not find a partition with UUID: %s' % source)
-
-        return result
+def loadProgress(dest, header, resumingSnapshot, manifest):
+    """Given the manifest read from dest, returns the manifest to check parts against, the list of parts that were
+    already committed by an interrupted backup into dest that can be resumed from, and the indexes of the parts it
+    changed, or None if they aren't known."""
+    committedParts = readJournal(dest, header)
+    
+    if committedParts is None:
+        # Without a journal matching this backup there's no telling which parts were changed by an interrupted backup,
+        # so the manifest can't be trusted
+        if resumingSnapshot or os.path.exists(journalPath(dest)):
+            return {}, [], None
         
-    elif os.path.exists(source):
-        return source
-    else:
-        raise ValueError('"%s" is not a valid device identifier or file' % source)
-
-def backup(sourceString, sourceIsUUID, destRoot, partSize, blockSize, keepNullParts, snapshotCount):
-    if partSize % blockSize != 0:
-        raise ValueError('Part size must be integer multiple of block size')
+        return manifest, [], set()
     
-    source = deviceIdentifierForSourceString(sourceString, sourceIsUUID)
-    dest = setupAndReturnDestination(destRoot, snapshotCount)
-    speedCalculator = AverageSpeedCalculator(5)
+    if len(committedParts) > 0:
+        sys.stdout.write("Resuming from part %s...\n" % (len(committedParts)+1))
+    
+    for preparedPart in committedParts:
+        manifest[preparedPart.index] = preparedPart.entry
     
-    partIndex = 0
+    # The part following the last committed one may have been replaced just before the backup was interrupted
+    manifest.pop(len(committedParts), None)
+    return manifest, committedParts, set(p.index for p in committedParts if p.changed)
+
+def backupPartsWithDD(source, destination, partSize, blockSize, startIndex):
+    """Copies every part of source starting at startIndex into destination using one dd process per part. Returns the
+    number of parts in the backup and the number of parts that changed."""
+    speedCalculator = AverageSpeedCalculator(5)
+    metrics = destination.metrics
+    partIndex = startIndex
     changedFiles = 0
     
     while True:
         speedCalculator.startOfCycle()
-        newPartPath, newPartSize = copyPartToDisk(source, dest, partSize, blockSize, partIndex, speedCalculator)
+        
+        with metrics.stage('copy', partIndex):
+            newPartPath, newPartSize = copyPartToDisk(source, destination.path, partSize, blockSize, partIndex,
+                                                      speedCalculator, metrics)
         
         if newPartPath is None:
             break
         
-        fileChanged = compareNewPart(newPartPath, partSize, blockSize, keepNullParts)
+        metrics.count('bytesRead', newPartSize)
+        metrics.count('bytesWritten', newPartSize)
+        
+        with metrics.stage('compare', partIndex):
+            fileChanged = compareNewPart(newPartPath, partSize, blockSize, destination.keepNullParts,
+                                         destination.existingPartPath(partIndex))
         
         if fileChanged:
             changedFiles += 1
+            destination.partNames[partIndex] = partFileName(partIndex)
+        
+        with metrics.stage('hash', partIndex):
+            if fileChanged or partIndex not in destination.manifest:
+                destination.manifest[partIndex] = manifestEntryForPartFile(destination.existingPartPath(partIndex),
+                                                                           partSize, blockSize)
+        
+        entry = destination.manifest[partIndex]
+        
+        with metrics.stage('commit', partIndex):
+            destination.journal.record(PreparedPart(partIndex, entry, fileChanged, None))
+        
+        metrics.count('partsChanged' if fileChanged else 'partsUnchanged')
         
+        if entry.isZero:
+            metrics.count('partsZero')
+        
+        metrics.partFinished(partIndex, entry.size, changed=fileChanged, zero=entry.isZero)
         partIndex += 1
         speedCalculator.endOfCycle(partSize)
         
@@ -273,19 +1038,328 @@ def backup(sourceString, sourceIsUUID, destRoot, partSize, blockSize, keepNullPa
             # We've hit the final part
             break
     
-    deletedFiles = removeExcessPartsInDestStartingAtIndex(dest, partIndex)
-    renameSnapshotToFinalName(dest)
+    return partIndex, changedFiles
+
+def openSource(source, blockSize, noCache):
+    """Opens source for reading parts from, with '-' meaning stdin. When noCache is set, a source that isn't stdin is
+    opened with O_DIRECT if possible, so that reading it bypasses the page cache. Returns the opened file and whether
+    it was opened that way."""
+    if source == '-':
+        return io.open(sys.stdin.fileno(), 'rb', buffering=0, closefd=False), False
     
-    if snapshotCount > 0:
-        removeOldSnapshots(destRoot, snapshotCount)
+    # O_DIRECT reads have to be aligned, which they are as long as the block size is
+    if noCache and blockSize % directIOAlignment == 0:
+        fd = openUncached(source)
+        
+        if fd is not None:
+            return io.open(fd, 'rb', buffering=0), True
+    
+    return io.open(source, 'rb', buffering=0), False
+
+def backupParts(source, destinations, partSize, blockSize, startIndexes, workerCount, queueDepth, noCache=False):
+    """Reads every part of source once and writes the parts that have changed into each of destinations. Returns
+    the number of parts in the backup and a list of the number of parts that changed in each destination."""
+    speedCalculator = AverageSpeedCalculator(5)
+    metrics = destinations[0].metrics
+    partIndex = min(startIndexes)
+    changedFiles = [0] * len(destinations)
+    sourceFile, isDirect = openSource(source, blockSize, noCache)
+    
+    with sourceFile:
+        pipeline = BackupPipeline(sourceFile, destinations, partSize, blockSize, workerCount, queueDepth, startIndexes,
+                                  isDirect, noCache and not isDirect, sourceFile.seekable())
+        pipeline.start()
+        speedCalculator.startOfCycle()
+        
+        try:
+            while True:
+                outputCopyStatus(partIndex, speedCalculator, metrics)
+                preparedParts = pipeline.nextPreparedParts(partIndex)
+                
+                if preparedParts is None:
+                    break
+                
+                for i, preparedPart in enumerate(preparedParts):
+                    if preparedPart is not None:
+                        destinations[i].commitPart(preparedPart)
+                        
+                        if preparedPart.changed:
+                            changedFiles[i] += 1
+                
+                entry = [p for p in preparedParts if p is not None][0].entry
+                
+                if len(destinations) == 1:
+                    metrics.partFinished(partIndex, entry.size, changed=preparedParts[0].changed, zero=entry.isZero,
+                                         partName=preparedParts[0].partName)
+                else:
+                    # Each destination gets an item in these lists, which is None for one that didn't need the part
+                    metrics.partFinished(partIndex, entry.size, changed=[p and p.changed for p in preparedParts],
+                                         zero=entry.isZero, partName=[p and p.partName for p in preparedParts])
+                
+                partIndex += 1
+                speedCalculator.nextCycle(entry.size)
+        finally:
+            pipeline.stop()
+    
+    return partIndex, changedFiles
+
+class BackupRoot(object):
+    """One of the backup roots being backed up into, along with its object store if it uses one, and once it's been
+    opened, the snapshot being written and the parts already committed to it by an interrupted backup"""
+    def __init__(self, destRoot, store):
+        self.destRoot = destRoot
+        self.store = store
+        self.storeLock = None
+        self.pruner = None
+        self.dest = None
+        self.manifest = None
+        self.objectNames = None
+        self.committedParts = []
+        self.changedIndexes = None
+        self.journal = None
+        self.startIndex = 0
+        self.destination = None
+    
+    def open(self, snapshotCount, linker, linkWorkers, header, streaming, metrics):
+        """Sets up the snapshot to back up into, or picks up an interrupted one, and starts removing retired
+        snapshots"""
+        resumingSnapshot = snapshotCount > 0 and os.path.exists(os.path.join(self.destRoot, inProgressSnapshotName()))
+        
+        if self.store is not None:
+            self.store.create()
+            
+            # Garbage collection can't run while a backup is using the store
+            self.storeLock = self.store.lock(False, True)
+            self.store.registerRoot(self.destRoot)
+        
+        with metrics.stage('setup'):
+            self.dest = setupAndReturnDestination(self.destRoot, snapshotCount, linker, linkWorkers,
+                                                  self.store is not None)
+            
+            # Writing the index right away marks the backup as using the object store, even if it's interrupted
+            if self.store is not None and not isObjectStoreSnapshot(self.dest):
+                writeIndex(self.dest, self.store.path, {}, {})
+        
+        self.pruner = SnapshotPruner(self.destRoot, linkWorkers) if snapshotCount > 0 else None
+        
+        if self.pruner is not None:
+            self.pruner.start()
+        
+        if self.store is not None:
+            storePath, manifest, self.objectNames = readIndex(self.dest)
+        else:
+            manifest = readManifest(self.dest)
+        
+        self.manifest, self.committedParts, self.changedIndexes = loadProgress(self.dest, header, resumingSnapshot,
+                                                                              manifest)
+        removeNewParts(self.dest, self.committedParts)
+        
+        if streaming:
+            # A stream can't skip ahead to where an interrupted backup left off, so it's read from the start. The parts
+            # that were already committed are in the manifest, so they're only checked, not written again.
+            self.journal = CommitJournal(self.dest, header, False, self.committedParts)
+            self.startIndex = 0
+        else:
+            self.journal = CommitJournal(self.dest, header, len(self.committedParts) > 0)
+            self.startIndex = len(self.committedParts)
+    
+    def finish(self, partIndex, snapshotCount, pruneInBackground, linkWorkers, metrics):
+        """Finishes the snapshot once partIndex parts have been backed up into it, and retires the snapshots beyond
+        snapshotCount. Returns the number of parts that were removed."""
+        with metrics.stage('finish'):
+            deletedFiles = self.destination.removeExcessParts(partIndex)
+            self.destination.saveManifest()
+            
+            if snapshotCount > 0:
+                prevs = [snapshot for snapshot in previousSnapshots(self.destRoot) if snapshot != self.dest]
+                
+                # When an interrupted backup's changes aren't known, every part is compared with the previous snapshot
+                if self.changedIndexes is not None:
+                    self.changedIndexes |= self.journal.changedIndexes
+                
+                writeChangeLog(self.dest, prevs[-1] if len(prevs) > 0 else None, self.changedIndexes)
+            
+            os.remove(journalPath(self.dest))
+            renameSnapshotToFinalName(self.dest)
+        
+        if snapshotCount > 0:
+            with metrics.stage('removeOldSnapshots'):
+                retired = retireOldSnapshots(self.destRoot, snapshotCount)
+                
+                if len(retired) > 0 and pruneInBackground:
+                    sys.stdout.write("Retired %s old snapshot(s), which the next backup will remove...\n" %
+                                     len(retired))
+                elif len(retired) > 0:
+                    sys.stdout.write("Removing old snapshots...\n")
+                    
+                    for snapshot in retired:
+                        removeSnapshot(snapshot, linkWorkers)
+            
+            with metrics.stage('waitForPruning'):
+                self.pruner.wait()
+        
+        return deletedFiles
+    
+    def close(self):
+        if self.storeLock is not None:
+            self.storeLock.close()
+            self.storeLock = None
+
+def objectStoreForBackupRoot(destRoot, snapshotCount, objectStorePath):
+    """Returns the object store the backup at destRoot uses, or should start using if objectStorePath is given, or None
+    if it doesn't use one"""
+    store = objectStoreOfBackup(destRoot, snapshotCount)
+    
+    if objectStorePath is not None:
+        if store is not None and os.path.realpath(store.path) != os.path.realpath(objectStorePath):
+            raise ValueError('Backup already uses the object store at %s' % store.path)
+        
+        store = ObjectStore(objectStorePath)
+    
+    return store
+
+def backup(sourceString, sourceIsUUID, destRoots, partSize, blockSize, keepNullParts, snapshotCount, useDD=False,
+           workerCount=2, queueDepth=2, codec=None, compressionProcesses=None,
+           entropyThreshold=defaultEntropyThreshold, metricsPath=None, useReflinks=False, linkWorkers=8,
+           pruneInBackground=True, objectStorePath=None, deltaDepth=0, deltaRatio=defaultDeltaRatio, noCache=False,
+           throttle=None):
+    """Backs up the source into each of the backup roots in destRoots, reading the source only once"""
+    if partSize % blockSize != 0:
+        raise ValueError('Part size must be integer multiple of block size')
+    
+    if workerCount < 1 or queueDepth < 1 or linkWorkers < 1:
+        raise ValueError('Worker counts and queue depth must be at least 1')
+    
+    if codec is not None and useDD:
+        raise ValueError('Compression is not supported when copying with dd')
+    
+    if codec is not None:
+        codecFunctions(codec)
+    
+    if len(set(os.path.realpath(destRoot) for destRoot in destRoots)) != len(destRoots):
+        raise ValueError('The same backup root was given more than once')
+    
+    if len(destRoots) > 1 and useDD:
+        raise ValueError('Backing up into more than one backup root is not supported when copying with dd')
+    
+    roots = [BackupRoot(destRoot, objectStoreForBackupRoot(destRoot, snapshotCount, objectStorePath))
+             for destRoot in destRoots]
+    usesObjectStore = any(root.store is not None for root in roots)
+    
+    if usesObjectStore and useDD:
+        raise ValueError('An object store cannot be used when copying with dd')
+    
+    if deltaDepth < 0 or deltaRatio <= 0:
+        raise ValueError('Delta depth must not be negative and delta ratio must be greater than 0')
+    
+    if deltaDepth > 0 and (useDD or usesObjectStore):
+        raise ValueError('Deltas are not supported when copying with dd or using an object store')
+    
+    # A source of '-' is a stream read from stdin, whose size isn't known until it ends
+    streaming = sourceString == '-' and not sourceIsUUID
+    
+    if streaming and useDD:
+        raise ValueError('Backing up from stdin is not supported when copying with dd')
+    
+    if noCache and useDD:
+        raise ValueError('Bypassing the page cache is not supported when copying with dd')
+    
+    if throttle is None:
+        throttle = Throttle()
+    
+    if throttle.isLimited() and useDD:
+        raise ValueError('Throttling is not supported when copying with dd')
+    
+    if streaming:
+        source = sourceString
+        sourceSize = None
+    else:
+        source = deviceIdentifierForSourceString(sourceString, sourceIsUUID)
+        sourceSize = fileOrDeviceSize(source)
+    
+    metrics = Metrics('backup', sourceSize, metricsPath)
+    throttle.metrics = metrics
+    succeeded = False
+    
+    if throttle.controlPath is not None:
+        throttle.installSignalHandler()
+    
+    try:
+        header = journalHeader(sourceSize, partSize, keepNullParts)
+        
+        for root in roots:
+            if len(roots) > 1:
+                sys.stdout.write("Preparing %s...\n" % root.destRoot)
+            
+            root.open(snapshotCount, PartLinker(useReflinks), linkWorkers, header, streaming, metrics)
+        
+        # The source is read from the earliest part any of the backup roots still needs, and the parts before that
+        # were already committed to all of them
+        startIndex = min(root.startIndex for root in roots)
+        metrics.skip(sum(p.entry.size for p in roots[0].committedParts[:startIndex]))
+        
+        # The process pool is started before any threads, since forking a process that has threads running is unsafe
+        compressionPool = Pool(compressionProcesses) if codec is not None else None
+        
+        for root in roots:
+            if root.store is not None:
+                for preparedPart in root.committedParts:
+                    if preparedPart.partName is not None:
+                        root.objectNames[preparedPart.index] = preparedPart.partName
+                
+                root.destination = ObjectStoreDestination(root.dest, partSize, blockSize, keepNullParts, root.manifest,
+                                                          root.journal, metrics, root.store, root.objectNames, codec,
+                                                          compressionPool, entropyThreshold, noCache, throttle)
+            else:
+                root.destination = BackupDestination(root.dest, partSize, blockSize, keepNullParts, root.manifest,
+                                                     root.journal, metrics, codec, compressionPool, entropyThreshold,
+                                                     deltaDepth, deltaRatio, noCache, throttle)
+        
+        try:
+            if useDD:
+                partIndex, changedFiles = backupPartsWithDD(source, roots[0].destination, partSize, blockSize,
+                                                            startIndex)
+                changedFiles = [changedFiles]
+            else:
+                partIndex, changedFiles = backupParts(source, [root.destination for root in roots], partSize,
+                                                      blockSize, [root.startIndex for root in roots], workerCount,
+                                                      queueDepth, noCache)
+        finally:
+            for root in roots:
+                root.journal.close()
+            
+            if compressionPool is not None:
+                compressionPool.close()
+                compressionPool.join()
+        
+        for i, root in enumerate(roots):
+            changedFiles[i] += len([p for p in root.committedParts if p.changed])
+            changedFiles[i] += root.finish(partIndex, snapshotCount, pruneInBackground, linkWorkers, metrics)
+        
+        succeeded = True
+    finally:
+        throttle.removeSignalHandler()
+        
+        for root in roots:
+            root.close()
+        
+        metrics.close(succeeded)
     
     sys.stdout.write("\n")
-    sys.stdout.write("Finished! Changed files: %s\n" % (changedFiles + deletedFiles))
+    
+    if len(roots) == 1:
+        sys.stdout.write("Finished! Changed files: %s\n" % changedFiles[0])
+    else:
+        for root, rootChangedFiles in zip(roots, changedFiles):
+            sys.stdout.write("Finished %s! Changed files: %s\n" % (root.destRoot, rootChangedFiles))
+    
+    outputThrottledTime(metrics)
 
 def main():
     parser = argparse.ArgumentParser(description="Iteratively backup file or device to multi-part file")
-    parser.add_argument('source', help="Source file, device identifier, or partition UUID")
-    parser.add_argument('dest', help="Destination folder for multi-part backup")
+    parser.add_argument('source', help="Source file, device identifier, or partition UUID, or - to read from stdin")
+    parser.add_argument('dest', nargs='+', help="Destination folder for multi-part backup. Several can be given to "
+                        "back up into each of them while reading the source only once.")
     parser.add_argument('-bs', '--block-size', help='Block size for dd and comparing files. Uses same format for sizes '
                         'as dd. Defaults to 1 MB.', type=str, default=str(1024*1024))
     parser.add_argument('-ps', '--part-size', help='Size of each part of the backup. Uses same format for sizes as dd. '
@@ -294,14 +1368,55 @@ def main():
                         action='store_true')
     parser.add_argument('-s', '--snapshots', type=int, default=4, help='Number of snapshots to maintain. Default is 4.') 
     parser.add_argument('-u', '--uuid', help='Indicates source is a partition UUID', action='store_true') 
+    parser.add_argument('--use-dd', help='Copy each part with dd rather than reading the source directly. Slower, '
+                        'but available as a fallback.', action='store_true')
+    parser.add_argument('-w', '--workers', type=int, default=2, help='Number of threads checking and writing parts '
+                        'while the source is being read. Default is 2.')
+    parser.add_argument('-q', '--queue-depth', type=int, default=2, help='Number of parts that may be read ahead of '
+                        'the workers. Each part read ahead uses part size bytes of memory. Default is 2.')
+    parser.add_argument('-c', '--compress', choices=availableCodecs(), help='Compress changed parts with the given '
+                        'codec, when a sample of the part suggests it will compress')
+    parser.add_argument('--compression-processes', type=int, default=None, help='Number of processes compressing '
+                        'parts. Defaults to the number of CPUs.')
+    parser.add_argument('--entropy-threshold', type=float, default=defaultEntropyThreshold, help='Parts whose '
+                        'sampled entropy is above this many bits per byte, like encrypted data, are stored without '
+                        'trying to compress them. Default is %s.' % defaultEntropyThreshold)
+    parser.add_argument('--reflink', help='Create new snapshots by cloning the parts of the previous snapshot where the '
+                        'filesystem supports it, rather than hard linking them', action='store_true')
+    parser.add_argument('--link-workers', type=int, default=8, help='Number of threads linking and removing parts '
+                        'when creating and removing snapshots. Default is 8.')
+    parser.add_argument('--prune-now', help='Remove old snapshots at the end of the backup, rather than in the '
+                        'background during the next backup', action='store_true')
+    parser.add_argument('--object-store', help='Store parts once each under their digest in this folder, which can be '
+                        'shared between backups, rather than in each snapshot. Only needed for the first backup, '
+                        'later backups keep using the same object store.', default=None)
+    parser.add_argument('--delta-depth', type=int, default=0, help='Store a changed part as a delta containing only '
+                        'the blocks that changed, until a part has this many deltas. Defaults to 0, which always '
+                        'stores changed parts whole.')
+    parser.add_argument('--delta-ratio', type=float, default=defaultDeltaRatio, help='Store a changed part whole once '
+                        'its deltas would take up more than this fraction of the part size. Defaults to %s.' %
+                        defaultDeltaRatio)
+    parser.add_argument('--no-cache', help='Keep the backup from filling the page cache, by reading the source with '
+                        'O_DIRECT where possible, or otherwise dropping each part of it from the cache once read, and '
+                        'by dropping parts in the backup from the cache once written or compared.',
+                        action='store_true')
+    addThrottleArguments(parser, 'reading the source', 'writing parts')
+    parser.add_argument('--metrics-file', help='Append a JSON line with the time spent in each stage to this file for '
+                        'every part, and a summary when the backup is done', default=None)
     args = parser.parse_args()
     
     try:
         partSize = humanReadableSizeToBytes(args.part_size)
         blockSize = humanReadableSizeToBytes(args.block_size)
-        backup(args.source, args.uuid, args.dest, partSize, blockSize, args.keep_null_parts, args.snapshots)
+        throttle = throttleFromArguments(args)
+        backup(args.source, args.uuid, args.dest, partSize, blockSize, args.keep_null_parts, args.snapshots,
+               useDD=args.use_dd, workerCount=args.workers, queueDepth=args.queue_depth, codec=args.compress,
+               compressionProcesses=args.compression_processes, entropyThreshold=args.entropy_threshold,
+               metricsPath=args.metrics_file, useReflinks=args.reflink, linkWorkers=args.link_workers,
+               pruneInBackground=not args.prune_now, objectStorePath=args.object_store, deltaDepth=args.delta_depth,
+               deltaRatio=args.delta_ratio, noCache=args.no_cache, throttle=throttle)
         return 0
-    except (DDError, ValueError, BackupError) as e:
+    except (DDError, ValueError, BackupError, BackupDataError, UnknownCodecError) as e:
         sys.stderr.write('Error: %s\n' % e)
         return 1
 
@@ -0,0 +1,335 @@
+#!/usr/bin/env python2.7
+from __future__ import division
+import argparse
+import datetime
+import imp
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from shared import BackupError, BackupDataError, humanReadableSize, humanReadableSizeToBytes
+
+packageDir = os.path.dirname(os.path.abspath(__file__))
+backupModule = imp.load_source('backup_to_parts', os.path.join(packageDir, 'backup-to-parts.py'))
+restoreModule = imp.load_source('restore_from_parts', os.path.join(packageDir, 'restore-from-parts.py'))
+
+# Synthetic images are made up of chunks of this size, each of which is either zeros, compressible text, or random
+chunkSize = 64*1024
+
+words = ('the quick brown fox jumps over lazy dog backup part snapshot block device image disk restore manifest '
+         'journal sector volume partition').split()
+
+class SyntheticImage(object):
+    """Generates a source image where zeroFraction of the chunks are zeros and compressibility of the rest are text
+    that compresses well, the others being random. Changes can be made between runs by rewriting a fraction of the
+    chunks with new data from the same mix."""
+    def __init__(self, path, size, zeroFraction, compressibility, seed):
+        self.path = path
+        self.size = size
+        self.zeroFraction = zeroFraction
+        self.compressibility = compressibility
+        self.random = random.Random(seed)
+    
+    def chunkCount(self):
+        return (self.size + chunkSize - 1) // chunkSize
+    
+    def chunkData(self, length):
+        choice = self.random.random()
+        
+        if choice < self.zeroFraction:
+            return '\0' * length
+        
+        if self.random.random() < self.compressibility:
+            text = []
+            textLength = 0
+            
+            while textLength < length:
+                word = self.random.choice(words) + ' '
+                text.append(word)
+                textLength += len(word)
+            
+            return ''.join(text)[:length]
+        
+        return os.urandom(length)
+    
+    def create(self):
+        with open(self.path, 'wb') as f:
+            for index in xrange(self.chunkCount()):
+                f.write(self.chunkData(min(chunkSize, self.size - index*chunkSize)))
+    
+    def change(self, changeRate):
+        """Rewrites changeRate of the chunks of the image. Returns the number of bytes rewritten."""
+        count = int(round(self.chunkCount() * changeRate))
+        bytesChanged = 0
+        
+        with open(self.path, 'r+b') as f:
+            for index in self.random.sample(xrange(self.chunkCount()), count):
+                length = min(chunkSize, self.size - index*chunkSize)
+                f.seek(index * chunkSize)
+                f.write(self.chunkData(length))
+                bytesChanged += length
+        
+        return bytesChanged
+
+def diskCounters():
+    """Returns the number of bytes read and written so far by each block device, from /proc/diskstats. Returns an empty
+    dictionary where that isn't available."""
+    counters = {}
+    
+    try:
+        with open('/proc/diskstats') as f:
+            for line in f:
+                fields = line.split()
+                
+                if len(fields) >= 10:
+                    counters[fields[2]] = (int(fields[5]) * 512, int(fields[9]) * 512)
+    except EnvironmentError:
+        pass
+    
+    return counters
+
+def processCounters():
+    """Returns the I/O counters of this process from /proc/self/io, or an empty dictionary where that isn't
+    available. read_bytes and write_bytes count what actually went to disk, rchar and wchar include the page cache."""
+    counters = {}
+    
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                counters[name.strip()] = int(value)
+    except EnvironmentError:
+        pass
+    
+    return counters
+
+def counterDifferences(before, after):
+    return dict((name, after[name] - before.get(name, 0)) for name in after)
+
+def diskDifferences(before, after):
+    differences = {}
+    
+    for device, (readBytes, writeBytes) in after.iteritems():
+        read = readBytes - before.get(device, (0, 0))[0]
+        written = writeBytes - before.get(device, (0, 0))[1]
+        
+        if read > 0 or written > 0:
+            differences[device] = {'readBytes': read, 'writeBytes': written}
+    
+    return differences
+
+def waitForNextSecond():
+    """Snapshots are named with a timestamp to the second, so two backups can't finish within the same second"""
+    time.sleep(1.0 - datetime.datetime.now().microsecond / 1000000 + 0.01)
+
+def measure(operation, imageSize, verbose, function):
+    """Runs function, returning a dictionary of how long it took, the CPU time used by this process and any child
+    processes that finished, and the bytes read and written by this process and by each disk"""
+    disksBefore = diskCounters()
+    processBefore = processCounters()
+    timesBefore = os.times()
+    startTime = time.time()
+    stdout = sys.stdout
+    
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    
+    try:
+        function()
+    finally:
+        if not verbose:
+            sys.stdout.close()
+            sys.stdout = stdout
+    
+    elapsed = time.time() - startTime
+    timesAfter = os.times()
+    
+    return {
+        'operation': operation,
+        'seconds': elapsed,
+        'imageBytes': imageSize,
+        'bytesPerSecond': imageSize / elapsed if elapsed > 0 else None,
+        'cpuUserSeconds': (timesAfter[0] - timesBefore[0]) + (timesAfter[2] - timesBefore[2]),
+        'cpuSystemSeconds': (timesAfter[1] - timesBefore[1]) + (timesAfter[3] - timesBefore[3]),
+        'processIO': counterDifferences(processBefore, processCounters()),
+        'diskIO': diskDifferences(disksBefore, diskCounters()),
+    }
+
+def directorySize(path):
+    """Returns the number of bytes allocated to the files under path, counting hard linked files once"""
+    seen = set()
+    total = 0
+    
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            st = os.lstat(os.path.join(root, name))
+            
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_blocks * 512
+    
+    return total
+
+def runBenchmark(settings, tempRoot, verbose):
+    """Runs a full backup, settings['incrementalRuns'] incremental backups each after changing the image, and a
+    restore of the last snapshot. Returns a list of the measurements of each."""
+    tempDir = tempfile.mkdtemp(prefix='multipart-backup-benchmark-', dir=tempRoot)
+    results = []
+    
+    try:
+        imagePath = os.path.join(tempDir, 'source.img')
+        backupPath = os.path.join(tempDir, 'backup')
+        restorePath = os.path.join(tempDir, 'restored.img')
+        image = SyntheticImage(imagePath, settings['imageSize'], settings['zeroFraction'],
+                               settings['compressibility'], settings['seed'])
+        image.create()
+        
+        def runBackup():
+            backupModule.backup(imagePath, False, [backupPath], settings['partSize'], settings['blockSize'], False,
+                                settings['incrementalRuns'] + 1, workerCount=settings['workers'],
+                                queueDepth=settings['queueDepth'], codec=settings['codec'])
+        
+        for run in xrange(settings['incrementalRuns'] + 1):
+            if run == 0:
+                bytesChanged = settings['imageSize']
+            else:
+                bytesChanged = image.change(settings['changeRate'])
+                waitForNextSecond()
+            
+            sys.stderr.write('Running full backup...\n' if run == 0 else 'Running incremental backup %s...\n' % run)
+            result = measure('backup-full' if run == 0 else 'backup-incremental', settings['imageSize'], verbose,
+                             runBackup)
+            result['bytesChanged'] = bytesChanged
+            result['backupBytes'] = directorySize(backupPath)
+            results.append(result)
+        
+        snapshot = backupModule.previousSnapshots(backupPath)[-1]
+        
+        sys.stderr.write('Running restore...\n')
+        results.append(measure('restore', settings['imageSize'], verbose,
+                               lambda: restoreModule.restore(snapshot, restorePath, settings['blockSize'], 0, False,
+                                                             settings['workers'])))
+        
+        if settings['verify']:
+            with open(imagePath, 'rb') as f1:
+                with open(restorePath, 'rb') as f2:
+                    while True:
+                        block1 = f1.read(chunkSize*16)
+                        
+                        if block1 != f2.read(chunkSize*16):
+                            raise BackupDataError('Restored image does not match the source image')
+                        
+                        if len(block1) == 0:
+                            break
+    finally:
+        shutil.rmtree(tempDir)
+    
+    return results
+
+def outputSummary(results, baseline):
+    """Writes a table of the results, with the change in throughput from the matching run of baseline if given"""
+    sys.stdout.write('%-20s %10s %12s %10s %10s %s\n' % ('operation', 'seconds', 'throughput', 'cpu user', 'cpu sys',
+                                                        'vs baseline' if baseline is not None else ''))
+    
+    for index, result in enumerate(results):
+        comparison = ''
+        
+        if baseline is not None and index < len(baseline['runs']):
+            previous = baseline['runs'][index]
+            
+            if previous['operation'] == result['operation'] and previous['bytesPerSecond'] and \
+               result['bytesPerSecond']:
+                comparison = '%+.1f%%' % ((result['bytesPerSecond'] / previous['bytesPerSecond'] - 1) * 100)
+        
+        sys.stdout.write('%-20s %10.2f %10s/s %10.2f %10.2f %s\n' %
+                         (result['operation'], result['seconds'], humanReadableSize(result['bytesPerSecond'] or 0),
+                          result['cpuUserSeconds'], result['cpuSystemSeconds'], comparison))
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure backup and restore throughput using synthetic disk images "
+                                     "in a temporary folder")
+    parser.add_argument('-s', '--size', help='Size of the synthetic image. Uses same format for sizes as dd. '
+                        'Defaults to 256 MB.', type=str, default=str(256*1024*1024))
+    parser.add_argument('-bs', '--block-size', help='Block size. Uses same format for sizes as dd. Defaults to 1 MB.',
+                        type=str, default=str(1024*1024))
+    parser.add_argument('-ps', '--part-size', help='Part size. Uses same format for sizes as dd. Defaults to 16 MB.',
+                        type=str, default=str(16*1024*1024))
+    parser.add_argument('-z', '--zero-fraction', type=float, default=0.25, help='Fraction of the image that is zeros. '
+                        'Default is 0.25.')
+    parser.add_argument('-x', '--compressibility', type=float, default=0.0, help='Fraction of the image that is not '
+                        'zeros that is compressible text rather than random data. Default is 0.')
+    parser.add_argument('-r', '--change-rate', type=float, default=0.05, help='Fraction of the image rewritten '
+                        'before each incremental backup. Default is 0.05.')
+    parser.add_argument('-i', '--incremental-runs', type=int, default=2, help='Number of incremental backups to run '
+                        'after the full backup. Default is 2.')
+    parser.add_argument('-w', '--workers', type=int, default=2, help='Number of worker threads. Default is 2.')
+    parser.add_argument('-q', '--queue-depth', type=int, default=2, help='Number of parts read ahead. Default is 2.')
+    parser.add_argument('-c', '--compress', choices=backupModule.availableCodecs(), help='Compress parts with the '
+                        'given codec')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for generating the image and its changes. Default '
+                        'is 0.')
+    parser.add_argument('-t', '--temp-dir', help='Folder to create the image and backup in, which determines the disk '
+                        'being measured. Defaults to the system temporary folder.', default=None)
+    parser.add_argument('-o', '--output', help='File to write the results to as JSON. Defaults to '
+                        'benchmark-results.json.', default='benchmark-results.json')
+    parser.add_argument('-b', '--baseline', help='Results file of an earlier run to compare throughput against',
+                        default=None)
+    parser.add_argument('--verify', help='Check that the restored image matches the source', action='store_true')
+    parser.add_argument('-v', '--verbose', help='Show the progress output of backups and restores',
+                        action='store_true')
+    args = parser.parse_args()
+    
+    try:
+        settings = {
+            'imageSize': humanReadableSizeToBytes(args.size),
+            'blockSize': humanReadableSizeToBytes(args.block_size),
+            'partSize': humanReadableSizeToBytes(args.part_size),
+            'zeroFraction': args.zero_fraction,
+            'compressibility': args.compressibility,
+            'changeRate': args.change_rate,
+            'incrementalRuns': args.incremental_runs,
+            'workers': args.workers,
+            'queueDepth': args.queue_depth,
+            'codec': args.compress,
+            'seed': args.seed,
+            'verify': args.verify,
+        }
+        
+        for name in ('zeroFraction', 'compressibility', 'changeRate'):
+            if not 0 <= settings[name] <= 1:
+                raise ValueError('Fractions must be between 0 and 1')
+        
+        baseline = None
+        
+        if args.baseline is not None:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        
+        results = runBenchmark(settings, args.temp_dir, args.verbose)
+        
+        with open(args.output, 'w') as f:
+            json.dump({
+                'date': datetime.datetime.now().isoformat(),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'cpuCount': multiprocessing.cpu_count(),
+                'settings': settings,
+                'runs': results,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+        
+        outputSummary(results, baseline)
+        sys.stdout.write('Results written to %s\n' % args.output)
+        return 0
+    except (ValueError, BackupError, BackupDataError, EnvironmentError) as e:
+        sys.stderr.write('Error: %s\n' % e)
+        return 1
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
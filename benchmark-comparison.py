@@ -0,0 +1,115 @@
+#!/usr/bin/env python2.7
+from __future__ import division
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from shared import humanReadableSize, humanReadableSizeToBytes
+from comparison import firstNonZeroOffsetInFile, firstDifferenceOffsetInFiles
+
+def isFileAllZerosUsingRead(path, blockSize):
+    """The original way of checking for zeros, which creates a new string for every block read"""
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(blockSize)
+            
+            if len(block) == 0:
+                return True
+            
+            if block != ('\0' * len(block)):
+                return False
+
+def areFilesIdenticalUsingRead(path1, path2, blockSize):
+    """The original way of comparing files, which creates a new string for every block read"""
+    with open(path1, 'rb') as f1:
+        with open(path2, 'rb') as f2:
+            while True:
+                block1 = f1.read(blockSize)
+                block2 = f2.read(blockSize)
+                
+                if block1 != block2:
+                    return False
+                
+                if len(block1) == 0:
+                    return True
+
+def writeTestFile(path, size, random):
+    chunkSize = 1024*1024
+    
+    with open(path, 'wb') as f:
+        for offset in xrange(0, size, chunkSize):
+            length = min(chunkSize, size-offset)
+            f.write(os.urandom(length) if random else '\0' * length)
+
+def timeMethod(method, repeat):
+    """Returns the fastest of repeat runs of method, in seconds"""
+    times = []
+    
+    for i in xrange(repeat):
+        startTime = time.time()
+        method()
+        times.append(time.time() - startTime)
+    
+    return min(times)
+
+def runBenchmark(fileSize, blockSizes, repeat):
+    tempDir = tempfile.mkdtemp(prefix='multipart-backup-benchmark-')
+    
+    try:
+        zerosPath = os.path.join(tempDir, 'zeros')
+        randomPath1 = os.path.join(tempDir, 'random1')
+        randomPath2 = os.path.join(tempDir, 'random2')
+        writeTestFile(zerosPath, fileSize, False)
+        writeTestFile(randomPath1, fileSize, True)
+        shutil.copyfile(randomPath1, randomPath2)
+        
+        # The files were just written so they'll be in the page cache, which is what we want: this measures the CPU
+        # cost of comparing, not disk speed
+        methods = [
+            ('zeros', 'read', lambda bs: isFileAllZerosUsingRead(zerosPath, bs)),
+            ('zeros', 'readinto', lambda bs: firstNonZeroOffsetInFile(zerosPath, bs, False)),
+            ('zeros', 'mmap', lambda bs: firstNonZeroOffsetInFile(zerosPath, bs, True)),
+            ('identical', 'read', lambda bs: areFilesIdenticalUsingRead(randomPath1, randomPath2, bs)),
+            ('identical', 'readinto', lambda bs: firstDifferenceOffsetInFiles(randomPath1, randomPath2, bs, False)),
+            ('identical', 'mmap', lambda bs: firstDifferenceOffsetInFiles(randomPath1, randomPath2, bs, True)),
+        ]
+        
+        sys.stdout.write('%-10s %-9s %s\n' % ('check', 'method',
+                                              ' '.join('%10s' % humanReadableSize(bs) for bs in blockSizes)))
+        
+        for check, name, method in methods:
+            speeds = []
+            
+            for blockSize in blockSizes:
+                elapsed = timeMethod(lambda: method(blockSize), repeat)
+                speeds.append('%8s/s' % humanReadableSize(fileSize / elapsed if elapsed > 0 else 0))
+            
+            sys.stdout.write('%-10s %-9s %s\n' % (check, name, ' '.join(speeds)))
+    finally:
+        shutil.rmtree(tempDir)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the speed of the ways parts can be checked for zeros and "
+                                     "compared, across block sizes")
+    parser.add_argument('-s', '--size', help='Size of the files to compare. Uses same format for sizes as dd. '
+                        'Defaults to 256 MB.', type=str, default=str(256*1024*1024))
+    parser.add_argument('-bs', '--block-sizes', help='Comma separated block sizes to test. Defaults to 4k,64k,1m,4m.',
+                        type=str, default='4k,64k,1m,4m')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of times to run each method, keeping '
+                        'the fastest. Default is 3.')
+    args = parser.parse_args()
+    
+    try:
+        fileSize = humanReadableSizeToBytes(args.size)
+        blockSizes = [humanReadableSizeToBytes(x) for x in args.block_sizes.split(',')]
+        runBenchmark(fileSize, blockSizes, args.repeat)
+        return 0
+    except ValueError as e:
+        sys.stderr.write('Error: %s\n' % e)
+        return 1
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
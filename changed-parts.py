@@ -0,0 +1,57 @@
+#!/usr/bin/env python2.7
+from __future__ import division
+import argparse
+import os
+import sys
+from shared import BackupDataError, humanReadableSize
+from changelog import changesBetweenSnapshots, formatChange
+from objectstore import ObjectStore, isObjectStoreSnapshot, readIndex
+
+def changedParts(oldSnapshot, newSnapshot, outputMode):
+    """Writes out the files that differ between two snapshots of a backup, going only by their change logs. In 'log'
+    mode every change is written in the same format as a change log. In 'upload' mode only the paths of the files in
+    newSnapshot that are new or changed are written, and in 'delete' mode only the names of the files that are gone."""
+    changes = changesBetweenSnapshots(oldSnapshot, newSnapshot)
+    uploads = [change for change in changes if change.action != 'deleted']
+    deletions = [change for change in changes if change.action == 'deleted']
+    
+    if isObjectStoreSnapshot(newSnapshot):
+        store = ObjectStore(readIndex(newSnapshot)[0])
+        pathOfChange = lambda change: store.objectPath(change.name)
+    else:
+        pathOfChange = lambda change: os.path.join(newSnapshot, change.name)
+    
+    if outputMode == 'log':
+        for change in changes:
+            sys.stdout.write(formatChange(change))
+    elif outputMode == 'upload':
+        for change in uploads:
+            sys.stdout.write(pathOfChange(change) + '\n')
+    else:
+        for change in deletions:
+            sys.stdout.write(change.name + '\n')
+    
+    sys.stderr.write("%s file(s) to upload (%s), %s file(s) deleted\n" %
+                     (len(uploads), humanReadableSize(sum(change.fileSize for change in uploads)), len(deletions)))
+
+def main():
+    parser = argparse.ArgumentParser(description="List the parts that changed between two snapshots of a multi-part "
+                                     "backup, using only their change logs")
+    parser.add_argument('old', help="The earlier snapshot, or - to list every part of the later snapshot")
+    parser.add_argument('new', help="The later snapshot")
+    parser.add_argument('-o', '--output', choices=['log', 'upload', 'delete'], default='log', help='"log" lists '
+                        'every change in the same format as a change log, "upload" lists only the paths of the files '
+                        'that were added or changed, and "delete" lists only the names of the files that were deleted. '
+                        'Default is "log".')
+    args = parser.parse_args()
+    
+    try:
+        changedParts(None if args.old == '-' else args.old, args.new, args.output)
+        return 0
+    except BackupDataError as e:
+        sys.stderr.write('Error: %s\n' % e)
+        return 1
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
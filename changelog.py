@@ -0,0 +1,207 @@
+from __future__ import division
+import os
+from collections import namedtuple
+from shared import (BackupDataError, ManifestEntry, partsInSnapshot, deltasInSnapshot, partIndexFromName,
+                    deltaIndexFromName, isDeltaFile, writeFileAtomically)
+from objectstore import ObjectStore, isObjectStoreSnapshot, readIndex, snapshotManifest
+
+# One file that differs between a snapshot and the one before it. For a snapshot in an object store, name is the name
+# of the object holding the part rather than a file in the snapshot. fileSize is the size of the file, and entry is the
+# ManifestEntry of the part the file belongs to, or None if it isn't known.
+Change = namedtuple('Change', ['action', 'index', 'name', 'fileSize', 'entry'])
+
+# added: a file that wasn't in the previous snapshot. changed: a file whose contents are different. zeroed: a file that
+# changed into a part of all zeros. deleted: a file that's no longer in the snapshot. Objects are only ever deleted from
+# an object store by garbage collection, since other snapshots may still use them, so they're never logged as deleted.
+changeActions = ('added', 'changed', 'zeroed', 'deleted')
+
+def changeLogPath(snapshot):
+    return os.path.join(snapshot, 'changes')
+
+def _snapshotFiles(snapshot):
+    """Returns the kind of snapshot, 'files' or 'objects', and a dictionary mapping each part index to a dictionary of
+    the names of the files making up the part and the paths of those files"""
+    files = {}
+    
+    if isObjectStoreSnapshot(snapshot):
+        storePath, manifest, objectNames = readIndex(snapshot)
+        store = ObjectStore(storePath)
+        
+        for index, name in objectNames.items():
+            files[index] = {name: store.objectPath(name)}
+        
+        return 'objects', files
+    
+    for name in partsInSnapshot(snapshot):
+        files.setdefault(partIndexFromName(name), {})[name] = os.path.join(snapshot, name)
+    
+    for name in deltasInSnapshot(snapshot):
+        files.setdefault(deltaIndexFromName(name), {})[name] = os.path.join(snapshot, name)
+    
+    return 'files', files
+
+def _isSameFile(stat1, stat2):
+    return stat1.st_ino == stat2.st_ino and stat1.st_dev == stat2.st_dev
+
+def snapshotChanges(prevSnapshot, snapshot, changedIndexes=None):
+    """Returns the kind of snapshot and a list of the Changes between prevSnapshot and snapshot, worked out from their
+    files and manifests. prevSnapshot may be None, in which case every file is added. Only the parts at changedIndexes
+    and the parts that were removed are looked at, or every part if changedIndexes is None."""
+    kind, files = _snapshotFiles(snapshot)
+    manifest = snapshotManifest(snapshot)
+    prevFiles = {}
+    prevManifest = {}
+    
+    # When a backup switches to an object store, there's nothing in common between the two snapshots
+    if prevSnapshot is not None:
+        prevKind, prevFiles = _snapshotFiles(prevSnapshot)
+        
+        if prevKind == kind:
+            prevManifest = snapshotManifest(prevSnapshot)
+        else:
+            prevFiles = {}
+    
+    indexes = set(prevFiles.keys()) - set(files.keys())
+    indexes |= set(files.keys()) if changedIndexes is None else set(changedIndexes)
+    changes = []
+    
+    for index in sorted(indexes):
+        names = files.get(index, {})
+        prevNames = prevFiles.get(index, {})
+        entry = manifest.get(index)
+        prevEntry = prevManifest.get(index)
+        addedDeltas = [name for name in names if isDeltaFile(name) and name not in prevNames]
+        
+        for name in sorted(set(names.keys()) | set(prevNames.keys())):
+            if name not in names:
+                if kind != 'objects':
+                    changes.append(Change('deleted', index, name, os.stat(prevNames[name]).st_size, prevEntry))
+                
+                continue
+            
+            stat = os.stat(names[name])
+            
+            if name in prevNames:
+                # An unchanged part is the same file linked into both snapshots, or the same object. A cloned part is
+                # a different file, so the manifest has to be relied on instead. A part whose changes were stored as a
+                # new delta is unchanged itself, and so are deltas, since a delta is never rewritten under the same
+                # name.
+                if (_isSameFile(stat, os.stat(prevNames[name])) or isDeltaFile(name) or len(addedDeltas) > 0 or
+                        (prevEntry is not None and prevEntry == entry)):
+                    continue
+                
+                action = 'zeroed' if entry is not None and entry.isZero else 'changed'
+            else:
+                action = 'added'
+            
+            changes.append(Change(action, index, name, stat.st_size, entry))
+    
+    return kind, changes
+
+def writeChangeLog(snapshot, prevSnapshot, changedIndexes=None):
+    """Writes the change log of snapshot, listing the files that differ from prevSnapshot, the snapshot it was made
+    from, or every file if prevSnapshot is None. changedIndexes are the parts the backup committed as changed, if known."""
+    kind, changes = snapshotChanges(prevSnapshot, snapshot, changedIndexes)
+    
+    with writeFileAtomically(changeLogPath(snapshot)) as f:
+        f.write('multipart-backup-changes 1 %s %s\n' %
+                (kind, os.path.basename(prevSnapshot) if prevSnapshot is not None else '-'))
+        
+        for change in changes:
+            f.write(formatChange(change))
+
+def formatChange(change):
+    entry = change.entry
+    
+    if entry is None:
+        return '%s %d %s %d - - -\n' % (change.action, change.index, change.name, change.fileSize)
+    
+    return '%s %d %s %d %d %d %s\n' % (change.action, change.index, change.name, change.fileSize, entry.size,
+                                       1 if entry.isZero else 0, entry.digest)
+
+def readChangeLog(snapshot):
+    """Returns the kind of snapshot, the name of the snapshot it was made from or None if it was the first, and its
+    list of Changes. Raises BackupDataError if the snapshot has no valid change log."""
+    if not os.path.exists(changeLogPath(snapshot)):
+        raise BackupDataError('%s has no change log' % snapshot)
+    
+    with open(changeLogPath(snapshot), 'r') as f:
+        header = f.readline().split()
+        
+        if len(header) != 4 or header[0] != 'multipart-backup-changes' or header[1] != '1':
+            raise BackupDataError('Change log of %s is not valid' % snapshot)
+        
+        changes = []
+        
+        for line in f:
+            fields = line.split()
+            
+            if len(fields) != 7 or fields[0] not in changeActions:
+                raise BackupDataError('Change log of %s is not valid' % snapshot)
+            
+            entry = None if fields[4] == '-' else ManifestEntry(int(fields[4]), fields[5] == '1', fields[6])
+            changes.append(Change(fields[0], int(fields[1]), fields[2], int(fields[3]), entry))
+    
+    return header[2], None if header[3] == '-' else header[3], changes
+
+def changesBetweenSnapshots(oldSnapshot, newSnapshot):
+    """Returns a list of the Changes between oldSnapshot and a later snapshot of the same backup, newSnapshot, worked
+    out only from the change logs of newSnapshot and the snapshots in between. oldSnapshot may be None to get every file
+    in newSnapshot."""
+    oldName = os.path.basename(os.path.normpath(oldSnapshot)) if oldSnapshot is not None else None
+    backupRoot = os.path.dirname(os.path.normpath(newSnapshot))
+    logs = []
+    snapshot = os.path.normpath(newSnapshot)
+    
+    # Follow the logs back from the new snapshot to the old one
+    while os.path.basename(snapshot) != oldName:
+        kind, prevName, changes = readChangeLog(snapshot)
+        logs.append((kind, changes))
+        
+        if prevName is None:
+            if oldName is not None:
+                raise BackupDataError('%s is not an earlier snapshot of the same backup as %s' %
+                                      (oldSnapshot, newSnapshot))
+            
+            break
+        
+        snapshot = os.path.join(backupRoot, prevName)
+        
+        if not os.path.isdir(snapshot):
+            raise BackupDataError('%s, which %s was made from, no longer exists' % (snapshot, newSnapshot))
+    
+    if len(set(kind for kind, changes in logs)) > 1:
+        raise BackupDataError('The backup started using an object store in between %s and %s' %
+                              (oldSnapshot, newSnapshot))
+    
+    return combineChanges([changes for kind, changes in reversed(logs)])
+
+def combineChanges(changeLists):
+    """Returns the net Changes made by the lists of Changes in changeLists, oldest first. A file that was added and
+    later deleted is left out, and a file that was deleted and later added again has changed."""
+    # Whether each file existed before the first list of changes, and its latest change
+    files = {}
+    
+    for changes in changeLists:
+        for change in changes:
+            key = (change.index, change.name)
+            existedBefore = files[key][0] if key in files else change.action != 'added'
+            files[key] = (existedBefore, change)
+    
+    combined = []
+    
+    for key in sorted(files.keys()):
+        existedBefore, change = files[key]
+        
+        if change.action == 'deleted':
+            if existedBefore:
+                combined.append(change)
+        elif not existedBefore:
+            combined.append(change._replace(action='added'))
+        elif change.action == 'added':
+            combined.append(change._replace(action='zeroed' if change.entry is not None and change.entry.isZero
+                                            else 'changed'))
+        else:
+            combined.append(change)
+    
+    return combined
@@ -0,0 +1,56 @@
+#!/usr/bin/env python2.7
+from __future__ import division
+import argparse
+import os
+import sys
+from shared import BackupError, BackupDataError, humanReadableSize, forEachInParallel
+from objectstore import ObjectStore
+
+def collectGarbage(storePath, dryRun, workerCount):
+    """Removes the objects in an object store that no snapshot of any backup using the store refers to anymore"""
+    store = ObjectStore(storePath)
+    
+    if not store.exists():
+        raise BackupDataError('%s is not an object store' % storePath)
+    
+    # Holding the lock exclusively guarantees no backup is adding references to objects while we look for unused ones
+    lockFile = store.lock(True, False)
+    
+    try:
+        referenced = store.referencedObjects()
+        garbage = [(name, path) for name, path in store.objectNames() if name not in referenced]
+        freedBytes = sum(os.stat(path).st_size for name, path in garbage)
+        
+        if not dryRun:
+            forEachInParallel(os.remove, [path for name, path in garbage], workerCount)
+    finally:
+        lockFile.close()
+    
+    if dryRun:
+        sys.stdout.write("Found %s unused object(s), which would free %s\n" % (len(garbage),
+                                                                               humanReadableSize(freedBytes)))
+    else:
+        sys.stdout.write("Removed %s unused object(s), freeing %s\n" % (len(garbage), humanReadableSize(freedBytes)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Remove objects from an object store that are no longer used by any "
+                                     "snapshot")
+    parser.add_argument('store', help="Object store folder")
+    parser.add_argument('-n', '--dry-run', help="Only report how much would be removed", action='store_true')
+    parser.add_argument('-w', '--workers', help='Number of threads used to remove objects. Defaults to 8.', type=int,
+                        default=8)
+    args = parser.parse_args()
+    
+    try:
+        if args.workers < 1:
+            raise ValueError('Number of workers must be at least 1')
+        
+        collectGarbage(args.store, args.dry_run, args.workers)
+        return 0
+    except (BackupError, BackupDataError, ValueError) as e:
+        sys.stderr.write('Error: %s\n' % e)
+        return 1
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
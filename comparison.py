@@ -0,0 +1,226 @@
+from __future__ import division
+import io
+import mmap
+import os
+
+_zeroPage = ''
+_minimumReadSize = 1024*1024
+
+def zeroPage(length):
+    """Returns a string of at least length zeros. The same string is shared by every comparison, so checking data for
+    zeros never allocates a new block of zeros."""
+    global _zeroPage
+    
+    if len(_zeroPage) < length:
+        _zeroPage = '\0' * length
+    
+    return _zeroPage
+
+def window(data, offset, length):
+    """Returns a view of length bytes of data starting at offset, without copying them"""
+    return windowFunction(data)(offset, length)
+
+def windowFunction(data):
+    """Returns a function taking an offset and length that returns a view of that range of data without copying it.
+    Used in loops so that data is only wrapped once."""
+    try:
+        view = memoryview(data)
+        return lambda offset, length: view[offset:offset+length]
+    except TypeError:
+        # mmap objects in Python 2 only support the old buffer interface
+        return lambda offset, length: buffer(data, offset, length)
+
+def _firstDifferenceInRange(data1, offset1, data2, offset2, length):
+    """Returns the offset relative to offset1 and offset2 of the first byte that differs between data1 and data2 in a
+    range of length bytes that's known to contain a difference. Narrows it down by halving the range, so nothing is
+    copied."""
+    start = 0
+    end = length
+    
+    while end - start > 1:
+        middle = (start + end) // 2
+        
+        if window(data1, offset1+start, middle-start) != window(data2, offset2+start, middle-start):
+            end = middle
+        else:
+            start = middle
+    
+    return start
+
+def firstNonZeroOffset(data, blockSize, length=None):
+    """Returns the offset of the first byte in the first length bytes of data that isn't zero, or None if they're all
+    zeros. Will check data in increments of blockSize."""
+    if length is None:
+        length = len(data)
+    
+    zeros = zeroPage(blockSize)
+    dataWindow = windowFunction(data)
+    zerosWindow = windowFunction(zeros)
+    
+    for offset in xrange(0, length, blockSize):
+        count = min(blockSize, length-offset)
+        
+        if dataWindow(offset, count) != zerosWindow(0, count):
+            return offset + _firstDifferenceInRange(data, offset, zeros, 0, count)
+    
+    return None
+
+def firstDifferenceOffset(data1, data2, blockSize, length=None):
+    """Returns the offset of the first byte that differs between the first length bytes of data1 and data2, or None if
+    they're identical. When no length is given the whole of both are compared, and if one is a prefix of the other
+    the offset returned is the length of the shorter one. Will check data in increments of blockSize."""
+    if length is None:
+        length = min(len(data1), len(data2))
+        sizeDifference = len(data1) != len(data2)
+    else:
+        sizeDifference = False
+    
+    window1 = windowFunction(data1)
+    window2 = windowFunction(data2)
+    
+    for offset in xrange(0, length, blockSize):
+        count = min(blockSize, length-offset)
+        
+        if window1(offset, count) != window2(offset, count):
+            return offset + _firstDifferenceInRange(data1, offset, data2, offset, count)
+    
+    return length if sizeDifference else None
+
+def mapFile(f):
+    """Memory maps the open file f for reading. Returns None if the file is empty or can't be mapped, such as with
+    devices and pipes."""
+    try:
+        size = os.fstat(f.fileno()).st_size
+        
+        if size == 0:
+            return None
+        
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    except (mmap.error, EnvironmentError, ValueError, OverflowError):
+        return None
+
+def readSizeForBlockSize(blockSize):
+    """Returns how much to read at a time when comparing in increments of blockSize. Small blocks are read several at
+    a time, since the overhead of each read is what limits speed for them."""
+    return blockSize * max(1, _minimumReadSize // blockSize)
+
+def readFully(f, buffer, length):
+    """Reads up to length bytes from f into buffer. Returns the number of bytes read, which is less than length only at
+    the end of the file."""
+    view = memoryview(buffer)
+    bytesRead = 0
+    
+    while bytesRead < length:
+        count = f.readinto(view[bytesRead:length])
+        
+        if not count:
+            break
+        
+        bytesRead += count
+    
+    return bytesRead
+
+def firstNonZeroOffsetInFile(path, blockSize, useMmap=True):
+    """Returns the offset of the first byte in the file at path that isn't zero, or None if it contains only zeros.
+    The file is memory mapped if possible, and otherwise read into a single preallocated buffer."""
+    with io.open(path, 'rb', buffering=0) as f:
+        mapped = mapFile(f) if useMmap else None
+        
+        if mapped is not None:
+            try:
+                return firstNonZeroOffset(mapped, blockSize)
+            finally:
+                mapped.close()
+        
+        readSize = readSizeForBlockSize(blockSize)
+        buffer = bytearray(readSize)
+        offset = 0
+        
+        while True:
+            count = readFully(f, buffer, readSize)
+            
+            if count == 0:
+                return None
+            
+            result = firstNonZeroOffset(buffer, blockSize, count)
+            
+            if result is not None:
+                return offset + result
+            
+            offset += count
+
+def firstDifferenceOffsetInFiles(path1, path2, blockSize, useMmap=True):
+    """Returns the offset of the first byte that differs between the files at path1 and path2, or None if they're
+    identical. If one file is a prefix of the other, the size of the shorter file is returned. Files are memory mapped
+    if possible, and otherwise read into two preallocated buffers."""
+    with io.open(path1, 'rb', buffering=0) as f1:
+        with io.open(path2, 'rb', buffering=0) as f2:
+            mapped1 = mapFile(f1) if useMmap else None
+            mapped2 = mapFile(f2) if useMmap else None
+            
+            try:
+                if mapped1 is not None and mapped2 is not None:
+                    return firstDifferenceOffset(mapped1, mapped2, blockSize)
+            finally:
+                for mapped in (mapped1, mapped2):
+                    if mapped is not None:
+                        mapped.close()
+            
+            readSize = readSizeForBlockSize(blockSize)
+            buffer1 = bytearray(readSize)
+            buffer2 = bytearray(readSize)
+            offset = 0
+            
+            while True:
+                count1 = readFully(f1, buffer1, readSize)
+                count2 = readFully(f2, buffer2, readSize)
+                count = min(count1, count2)
+                result = firstDifferenceOffset(buffer1, buffer2, blockSize, count)
+                
+                if result is not None:
+                    return offset + result
+                elif count1 != count2:
+                    return offset + count
+                elif count == 0:
+                    return None
+                
+                offset += count
+
+def firstDifferenceOffsetWithFile(data, length, path, blockSize, useMmap=True):
+    """Returns the offset of the first byte that differs between the first length bytes of data and the file at path,
+    or None if they're identical. If one is a prefix of the other, the shorter length is returned."""
+    with io.open(path, 'rb', buffering=0) as f:
+        fileSize = os.fstat(f.fileno()).st_size
+        mapped = mapFile(f) if useMmap else None
+        
+        if mapped is not None:
+            try:
+                result = firstDifferenceOffset(data, mapped, blockSize, min(length, fileSize))
+            finally:
+                mapped.close()
+            
+            if result is None and length != fileSize:
+                return min(length, fileSize)
+            
+            return result
+        
+        readSize = readSizeForBlockSize(blockSize)
+        buffer = bytearray(readSize)
+        offset = 0
+        
+        while True:
+            count = readFully(f, buffer, min(readSize, length-offset))
+            result = firstDifferenceOffset(window(data, offset, count), buffer, blockSize, count)
+            
+            if result is not None:
+                return offset + result
+            
+            offset += count
+            
+            if count == 0 or offset == length:
+                break
+        
+        if offset != length or readFully(f, buffer, 1) != 0:
+            return offset
+        
+        return None
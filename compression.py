@@ -0,0 +1,110 @@
+from __future__ import division
+import bz2
+import math
+import struct
+import zlib
+from collections import Counter
+from shared import BackupDataError
+
+# A compressed part starts with the length of the data it contains, followed by the compressed data
+_headerFormat = '>Q'
+_headerSize = struct.calcsize(_headerFormat)
+
+# Parts whose sampled entropy is above this many bits per byte, such as encrypted or already compressed data, are
+# stored raw without attempting to compress them
+defaultEntropyThreshold = 7.5
+
+# A compressed part is only kept if it's at most this fraction of the size of the raw part
+maximumCompressionRatio = 0.95
+
+_codecs = {}
+
+class UnknownCodecError(Exception):
+    pass
+
+def registerCodec(name, compress, decompress):
+    """Makes a codec available for compressing parts. compress and decompress each take a string and return a string.
+    name is used as the suffix of part files compressed with the codec, so it should consist of lowercase letters and
+    numbers only."""
+    _codecs[name] = (compress, decompress)
+
+def availableCodecs():
+    return sorted(_codecs.keys())
+
+def codecFunctions(name):
+    if name not in _codecs:
+        raise UnknownCodecError('Unknown compression codec: %s' % name)
+    
+    return _codecs[name]
+
+registerCodec('zlib', lambda data: zlib.compress(data, 1), zlib.decompress)
+registerCodec('bz2', lambda data: bz2.compress(data, 9), bz2.decompress)
+
+# Optional codecs, available when their modules are installed
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+if lzma is not None:
+    registerCodec('lzma', lambda data: lzma.compress(data, preset=1), lzma.decompress)
+
+try:
+    import lz4.frame
+    registerCodec('lz4', lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+try:
+    import zstandard
+    registerCodec('zstd', lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                  lambda data: zstandard.ZstdDecompressor().decompress(data))
+except ImportError:
+    pass
+
+def sampleEntropy(data, length, sampleSize=4096, sampleCount=16):
+    """Estimates the Shannon entropy in bits per byte of the first length bytes of data, from sampleCount samples of
+    sampleSize bytes spread evenly across it."""
+    if length == 0:
+        return 0.0
+    
+    view = memoryview(data)
+    step = max(length // sampleCount, 1)
+    counts = Counter()
+    
+    for offset in xrange(0, length, step):
+        counts.update(view[offset:offset+min(sampleSize, step)].tobytes())
+    
+    total = sum(counts.itervalues())
+    return -sum((count / total) * math.log(count / total, 2) for count in counts.itervalues())
+
+def isWorthCompressing(data, length, entropyThreshold=defaultEntropyThreshold):
+    """Returns true if a sample of the first length bytes of data suggests it will compress"""
+    return sampleEntropy(data, length) <= entropyThreshold
+
+def compressData(codec, data):
+    """Compresses data with the named codec. A top level function so that it can be run in a process pool."""
+    return codecFunctions(codec)[0](data)
+
+def compressedPartHeader(length):
+    return struct.pack(_headerFormat, length)
+
+def compressedPartDataSize(path):
+    """Returns the size of the data contained in the compressed part at path"""
+    with open(path, 'rb') as f:
+        return struct.unpack(_headerFormat, f.read(_headerSize))[0]
+
+def readCompressedPart(path, codec):
+    """Returns the decompressed contents of the part at path, which was compressed with codec"""
+    with open(path, 'rb') as f:
+        length = struct.unpack(_headerFormat, f.read(_headerSize))[0]
+        data = codecFunctions(codec)[1](f.read())
+    
+    if len(data) != length:
+        raise BackupDataError('Compressed part %s is %s bytes when decompressed, expected %s' %
+                              (path, len(data), length))
+    
+    return data
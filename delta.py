@@ -0,0 +1,93 @@
+from __future__ import division
+import os
+import struct
+from shared import BackupDataError
+from comparison import windowFunction
+
+# A delta starts with the length of the part it produces, followed by records made up of the offset and length of a
+# changed range and the data now in that range
+_headerFormat = '>Q'
+_headerSize = struct.calcsize(_headerFormat)
+_recordFormat = '>QI'
+_recordSize = struct.calcsize(_recordFormat)
+
+# Once the deltas of a part add up to more than this fraction of the part's size, the part is stored whole again
+defaultDeltaRatio = 0.5
+
+def changedRanges(newData, oldData, length, blockSize):
+    """Yields the offset and length of each run of consecutive blocks of blockSize that differ between the first length
+    bytes of newData and oldData"""
+    newWindow = windowFunction(newData)
+    oldWindow = windowFunction(oldData)
+    runStart = None
+    
+    for offset in xrange(0, length, blockSize):
+        count = min(blockSize, length-offset)
+        
+        if newWindow(offset, count) != oldWindow(offset, count):
+            if runStart is None:
+                runStart = offset
+        elif runStart is not None:
+            yield runStart, offset - runStart
+            runStart = None
+    
+    if runStart is not None:
+        yield runStart, length - runStart
+
+def encodeDelta(newData, oldData, length, blockSize):
+    """Returns the chunks of data making up a delta that turns oldData into the first length bytes of newData. Both must
+    be length bytes long."""
+    newWindow = windowFunction(newData)
+    chunks = [struct.pack(_headerFormat, length)]
+    
+    for offset, count in changedRanges(newData, oldData, length, blockSize):
+        chunks.append(struct.pack(_recordFormat, offset, count))
+        chunks.append(newWindow(offset, count))
+    
+    return chunks
+
+def deltaDataSize(path):
+    """Returns the size of the part produced by the delta at path"""
+    with open(path, 'rb') as f:
+        return struct.unpack(_headerFormat, f.read(_headerSize))[0]
+
+def applyDelta(data, path):
+    """Applies the delta at path to data, a bytearray holding the part the delta was made against"""
+    with open(path, 'rb') as f:
+        length = struct.unpack(_headerFormat, f.read(_headerSize))[0]
+        
+        if length != len(data):
+            raise BackupDataError('Delta %s is for a part of %s bytes, but the part is %s bytes' %
+                                  (path, length, len(data)))
+        
+        while True:
+            record = f.read(_recordSize)
+            
+            if len(record) == 0:
+                break
+            
+            if len(record) != _recordSize:
+                raise BackupDataError('Delta %s is truncated' % path)
+            
+            offset, count = struct.unpack(_recordFormat, record)
+            changedData = f.read(count)
+            
+            if len(changedData) != count or offset + count > length:
+                raise BackupDataError('Delta %s is truncated' % path)
+            
+            data[offset:offset+count] = changedData
+    
+    return data
+
+def applyDeltaChain(data, deltaPaths):
+    """Returns the part produced by applying each of the deltas at deltaPaths in turn to data"""
+    data = bytearray(data)
+    
+    for path in deltaPaths:
+        applyDelta(data, path)
+    
+    return str(data)
+
+def deltaChainSize(deltaPaths):
+    """Returns the number of bytes taken up on disk by the deltas at deltaPaths"""
+    return sum(os.stat(path).st_size for path in deltaPaths)
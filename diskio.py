@@ -0,0 +1,225 @@
+from __future__ import division
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import platform
+import stat
+import struct
+
+# Linux
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+BLKZEROOUT = 0x127f
+FICLONE = 0x40049409
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+# macOS
+F_PUNCHHOLE = 99
+F_NOCACHE = 48
+
+# lseek whence values for finding the data and holes of a sparse file, which Python 2 doesn't define
+_seekDataAndHole = {'Linux': (3, 4), 'Darwin': (4, 3)}
+
+# Buffers, offsets and lengths used with O_DIRECT must be multiples of this, which covers the logical block size of
+# any disk
+directIOAlignment = 4096
+
+# Errors meaning that a file can't be cloned on this filesystem, or between these two filesystems
+_cloneUnsupportedErrors = (errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS)
+
+_libc = None
+
+class _FPunchhole(ctypes.Structure):
+    _fields_ = [('fp_flags', ctypes.c_uint),
+                ('reserved', ctypes.c_uint),
+                ('fp_offset', ctypes.c_int64),
+                ('fp_length', ctypes.c_int64)]
+
+def libc():
+    global _libc
+    
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    
+    return _libc
+
+def punchHole(fd, offset, length):
+    """Deallocates length bytes at offset in the open regular file fd without changing its size, so that they read
+    back as zeros. Returns true if successful."""
+    system = platform.system()
+    
+    if system == 'Linux':
+        fallocate = libc().fallocate
+        fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        return fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0
+    elif system == 'Darwin':
+        args = _FPunchhole(0, 0, offset, length)
+        return libc().fcntl(fd, F_PUNCHHOLE, ctypes.byref(args)) == 0
+    else:
+        return False
+
+def zeroBlockDeviceRange(fd, offset, length):
+    """Zeroes out length bytes at offset of the open block device fd, letting the device discard them where it
+    supports that. Returns true if successful."""
+    if platform.system() != 'Linux':
+        return False
+    
+    fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, length))
+    return True
+
+def zeroRange(fd, offset, length):
+    """Makes length bytes at offset of the open file or device fd read back as zeros without writing them out, by
+    punching a hole in a regular file or zeroing out the range of a block device. Returns false if that isn't
+    supported, in which case the zeros need to be written instead."""
+    mode = os.fstat(fd).st_mode
+    
+    try:
+        if stat.S_ISREG(mode):
+            return punchHole(fd, offset, length)
+        elif stat.S_ISBLK(mode):
+            return zeroBlockDeviceRange(fd, offset, length)
+    except (IOError, OSError, AttributeError):
+        pass
+    
+    return False
+
+def cloneFile(sourcePath, destPath):
+    """Creates destPath as a reflink of sourcePath: a separate file that shares its data blocks with sourcePath until
+    either is modified. Works on filesystems such as Btrfs, XFS and APFS. Returns false if cloning isn't supported, in
+    which case destPath is not created."""
+    system = platform.system()
+    
+    if system == 'Linux':
+        with open(sourcePath, 'rb') as source:
+            fd = os.open(destPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            
+            try:
+                fcntl.ioctl(fd, FICLONE, source.fileno())
+            except IOError as e:
+                os.close(fd)
+                os.remove(destPath)
+                
+                if e.errno in _cloneUnsupportedErrors:
+                    return False
+                
+                raise
+            
+            os.close(fd)
+            return True
+    elif system == 'Darwin':
+        try:
+            clonefile = libc().clonefile
+        except AttributeError:
+            return False
+        
+        if clonefile(sourcePath, destPath, 0) == 0:
+            return True
+        
+        error = ctypes.get_errno()
+        
+        if error in _cloneUnsupportedErrors:
+            return False
+        
+        raise OSError(error, os.strerror(error), destPath)
+    else:
+        return False
+
+def fadvise(fd, offset, length, advice):
+    """Tells the kernel how the range of length bytes at offset of the open file fd is going to be used, where a length
+    of 0 means up to the end of the file. Returns false if that isn't supported, e.g. on macOS or for a pipe."""
+    if platform.system() != 'Linux':
+        return False
+    
+    try:
+        posixFadvise = libc().posix_fadvise
+    except AttributeError:
+        return False
+    
+    posixFadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+    
+    # posix_fadvise returns the error number rather than setting errno
+    return posixFadvise(fd, offset, length, advice) == 0
+
+def dropFromCache(path):
+    """Asks the kernel to drop the file at path from the page cache. Only pages that have been written to disk can be
+    dropped, so a file that has just been written should be synced first. Returns false if that isn't supported."""
+    fd = os.open(path, os.O_RDONLY)
+    
+    try:
+        return fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def openUncached(path):
+    """Opens path for reading without going through the page cache, using O_DIRECT on Linux or F_NOCACHE on macOS.
+    Reads from a file opened with O_DIRECT must use buffers, offsets and lengths aligned to directIOAlignment. Returns
+    the file descriptor, or None if this isn't supported for path."""
+    system = platform.system()
+    
+    if system == 'Linux' and hasattr(os, 'O_DIRECT'):
+        try:
+            return os.open(path, os.O_RDONLY | os.O_DIRECT)
+        except OSError as e:
+            # Some filesystems, such as tmpfs, don't support O_DIRECT
+            if e.errno == errno.EINVAL:
+                return None
+            
+            raise
+    elif system == 'Darwin':
+        fd = os.open(path, os.O_RDONLY)
+        
+        try:
+            fcntl.fcntl(fd, F_NOCACHE, 1)
+        except IOError:
+            os.close(fd)
+            return None
+        
+        return fd
+    else:
+        return None
+
+def dataRanges(fd, offset, length):
+    """Returns the offset and length of each range of the file fd within length bytes at offset that holds data.
+    Returns None if holes can't be found at all, as for a device."""
+    if platform.system() not in _seekDataAndHole or not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    
+    seekData, seekHole = _seekDataAndHole[platform.system()]
+    end = offset + length
+    ranges = []
+    
+    while offset < end:
+        try:
+            start = os.lseek(fd, offset, seekData)
+        except OSError as e:
+            # There's no more data after offset
+            if e.errno == errno.ENXIO:
+                break
+            elif e.errno in (errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP):
+                return None
+            
+            raise
+        
+        if start >= end:
+            break
+        
+        offset = min(os.lseek(fd, start, seekHole), end)
+        ranges.append((start, offset - start))
+    
+    return ranges
+
+def alignedBuffer(size, alignment=directIOAlignment):
+    """Returns a writable buffer of size bytes starting at an address that's a multiple of alignment, as needed for
+    reading with O_DIRECT"""
+    buffer = bytearray(size + alignment)
+    offset = -ctypes.addressof(ctypes.c_char.from_buffer(buffer)) % alignment
+    return memoryview(buffer)[offset:offset+size]
+
+def writeFully(fd, data):
+    """Writes all of data to fd, which os.write may only do part of at a time"""
+    while len(data) > 0:
+        data = data[os.write(fd, data):]
@@ -0,0 +1,99 @@
+from __future__ import division
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+class Metrics(object):
+    """Records how long each stage of a backup or restore takes, along with counts of bytes and parts. Stages can be
+    timed from any thread, and are also totalled per part when given a part index. When path is given, a JSON line is
+    appended to it as each part is finished, and a summary line when the operation is done."""
+    def __init__(self, operation, totalBytes, path=None):
+        self.operation = operation
+        self.totalBytes = totalBytes
+        self.startTime = time.time()
+        self.bytesDone = 0
+        self.stageSeconds = defaultdict(float)
+        self.partStageSeconds = defaultdict(lambda: defaultdict(float))
+        self.counts = defaultdict(int)
+        self.lock = threading.Lock()
+        self.file = open(path, 'a') if path is not None else None
+        self._write({'type': 'start', 'totalBytes': totalBytes})
+    
+    def _write(self, line):
+        if self.file is None:
+            return
+        
+        line['operation'] = self.operation
+        line['time'] = time.time()
+        self.file.write(json.dumps(line, sort_keys=True) + '\n')
+        self.file.flush()
+    
+    @contextmanager
+    def stage(self, name, index=None):
+        """Times the enclosed code as part of the named stage, and of the part at index if given"""
+        startTime = time.time()
+        
+        try:
+            yield
+        finally:
+            self.addTime(name, time.time() - startTime, index)
+    
+    def addTime(self, name, seconds, index=None):
+        """Adds seconds to the named stage, and to the part at index if given"""
+        with self.lock:
+            self.stageSeconds[name] += seconds
+            
+            if index is not None:
+                self.partStageSeconds[index][name] += seconds
+    
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+    
+    def skip(self, byteCount):
+        """Leaves out byteCount bytes that don't need to be processed, such as parts already backed up by an interrupted
+        backup that's being resumed, from the estimate of the time remaining"""
+        with self.lock:
+            self.totalBytes = max(0, self.totalBytes - byteCount) if self.totalBytes is not None else None
+    
+    def partFinished(self, index, imageBytes, **fields):
+        """Records that the part at index, which covers imageBytes of the image, is done. Any fields given are included
+        in the line written for the part."""
+        with self.lock:
+            self.bytesDone += imageBytes
+            line = {'type': 'part', 'index': index, 'imageBytes': imageBytes, 'elapsedSeconds': self.elapsed(),
+                    'etaSeconds': self.eta(), 'stageSeconds': dict(self.partStageSeconds.pop(index, {}))}
+            line.update(fields)
+            self._write(line)
+    
+    def elapsed(self):
+        return time.time() - self.startTime
+    
+    def eta(self):
+        """Returns the estimated number of seconds until every byte has been processed, going by the average speed so
+        far, or None if there's nothing to go by yet"""
+        if self.totalBytes is None or self.bytesDone == 0:
+            return None
+        
+        return max(0, self.elapsed() / self.bytesDone * (self.totalBytes - self.bytesDone))
+    
+    def summary(self):
+        elapsed = self.elapsed()
+        
+        with self.lock:
+            return {'elapsedSeconds': elapsed, 'imageBytes': self.bytesDone, 'totalBytes': self.totalBytes,
+                    'bytesPerSecond': self.bytesDone / elapsed if elapsed > 0 else None,
+                    'stageSeconds': dict(self.stageSeconds), 'counts': dict(self.counts)}
+    
+    def close(self, succeeded):
+        """Writes the summary line and closes the metrics file"""
+        line = self.summary()
+        line['type'] = 'summary'
+        line['succeeded'] = succeeded
+        self._write(line)
+        
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,274 @@
+from __future__ import division
+import io
+import os
+import threading
+from collections import OrderedDict
+from shared import BackupDataError, checkPartsAndGetPartSize, partDataSize, partNeedsDecoding, readPartData
+from comparison import zeroPage, window
+from objectstore import partPathsInSnapshot, snapshotManifest
+
+class LRUCache(object):
+    """A dictionary holding at most capacity items, which forgets the least recently used item to make room for a new
+    one. onEvict, if given, is called with the value of each item that's forgotten."""
+    def __init__(self, capacity, onEvict=None):
+        self.capacity = capacity
+        self.onEvict = onEvict
+        self.items = OrderedDict()
+    
+    def get(self, key):
+        if key not in self.items:
+            return None
+        
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+    
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        
+        while len(self.items) > self.capacity:
+            self._evict(self.items.popitem(last=False)[1])
+    
+    def clear(self):
+        for value in self.items.values():
+            self._evict(value)
+        
+        self.items.clear()
+    
+    def _evict(self, value):
+        if self.onEvict is not None:
+            self.onEvict(value)
+
+def closeDescriptors(fds):
+    for fd in fds:
+        os.close(fd)
+
+class MultipartImage(io.RawIOBase):
+    """A read-only, seekable file object presenting a snapshot as the image it's a backup of, without restoring it.
+    readAt can be called from any thread."""
+    def __init__(self, snapshot, blockSize=1024*1024, cachedBlocks=64, openParts=16, decodedParts=2):
+        io.RawIOBase.__init__(self)
+        self.snapshot = snapshot
+        self.blockSize = blockSize
+        self.partPaths = partPathsInSnapshot(snapshot)
+        
+        if len(self.partPaths) == 0:
+            raise BackupDataError('No parts found in %s' % snapshot)
+        
+        self.partSize = self._partSize()
+        self.size = (len(self.partPaths)-1) * self.partSize + partDataSize(self.partPaths[-1], self.partSize)
+        self.position = 0
+        self.partInfo = {}
+        self.lock = threading.Lock()
+        self.blocks = LRUCache(cachedBlocks)
+        # Maps part index to the descriptors of the part not currently in use, since each thread reading the part
+        # needs one of its own
+        self.descriptors = LRUCache(max(openParts, 1), closeDescriptors)
+        self.decoded = LRUCache(decodedParts)
+        self.decoding = {}
+    
+    def _partSize(self):
+        partSize = checkPartsAndGetPartSize(self.partPaths, self.blockSize)
+        
+        if partSize is not None:
+            return partSize
+        
+        # Every part but the last is empty, so go by the manifest, or by the only part there is
+        entry = snapshotManifest(self.snapshot).get(0)
+        
+        if entry is not None:
+            return entry.size
+        elif len(self.partPaths) == 1:
+            return partDataSize(self.partPaths[0], 0)
+        
+        raise BackupDataError('Could not deduce part size... are all of your parts 0 bytes in size?')
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self.position
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self.position + offset
+        elif whence == os.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('Invalid whence: %s' % whence)
+        
+        if position < 0:
+            raise ValueError('Negative seek position %s' % position)
+        
+        self.position = position
+        return position
+    
+    def readinto(self, b):
+        data = self.readAt(self.position, len(b))
+        memoryview(b)[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+    
+    def readAt(self, offset, length):
+        """Returns up to length bytes of the image starting at offset, without moving the current position. Fewer bytes
+        are returned only at the end of the image."""
+        length = max(0, min(length, self.size - offset))
+        chunks = []
+        
+        while length > 0:
+            index, partOffset = divmod(offset, self.partSize)
+            blockIndex, blockOffset = divmod(partOffset, self.blockSize)
+            block = self._block(index, blockIndex)
+            count = min(len(block) - blockOffset, length)
+            
+            if count <= 0:
+                raise BackupDataError('Part %s is shorter than expected' % self.partPaths[index])
+            
+            chunks.append(window(block, blockOffset, count))
+            offset += count
+            length -= count
+        
+        return ''.join(chunk.tobytes() for chunk in chunks)
+    
+    def prefetch(self, offset, length):
+        """Reads the blocks covering length bytes of the image starting at offset into the cache"""
+        end = min(offset + length, self.size)
+        
+        while offset < end:
+            index, partOffset = divmod(offset, self.partSize)
+            blockIndex = partOffset // self.blockSize
+            self._block(index, blockIndex)
+            offset = min(index * self.partSize + (blockIndex + 1) * self.blockSize, (index + 1) * self.partSize)
+    
+    def _info(self, index):
+        """Returns the number of bytes of the image the part at index represents, and whether it's an empty part of
+        zeros, one that has to be decoded, or one that can be read directly. Two threads looking up the same part both
+        work out the same thing, so this doesn't need the lock."""
+        if index not in self.partInfo:
+            partPath = self.partPaths[index]
+            
+            if os.stat(partPath).st_size == 0:
+                kind = 'zero'
+            elif partNeedsDecoding(partPath):
+                kind = 'encoded'
+            else:
+                kind = 'raw'
+            
+            self.partInfo[index] = (partDataSize(partPath, self.partSize), kind)
+        
+        return self.partInfo[index]
+    
+    def _block(self, index, blockIndex):
+        """Returns the data of the block at blockIndex within the part at index"""
+        partLength, kind = self._info(index)
+        offset = blockIndex * self.blockSize
+        count = min(self.blockSize, partLength - offset)
+        
+        # Zeros are never worth caching
+        if kind == 'zero':
+            return window(zeroPage(count), 0, count)
+        
+        with self.lock:
+            block = self.blocks.get((index, blockIndex))
+        
+        if block is None:
+            if kind == 'encoded':
+                block = self._decodedPart(index)[offset:offset+count]
+            else:
+                block = self._readRaw(index, offset, count)
+            
+            with self.lock:
+                self.blocks.put((index, blockIndex), block)
+        
+        return block
+    
+    def _decodedPart(self, index):
+        """Returns the decoded data of the part at index. A part that another thread is already decoding is waited for
+        rather than decoded a second time."""
+        while True:
+            with self.lock:
+                data = self.decoded.get(index)
+                
+                if data is not None:
+                    return data
+                
+                decoding = self.decoding.get(index)
+                
+                if decoding is None:
+                    decoding = threading.Event()
+                    self.decoding[index] = decoding
+                    break
+            
+            decoding.wait()
+        
+        try:
+            data = readPartData(self.partPaths[index])
+            
+            with self.lock:
+                self.decoded.put(index, data)
+        finally:
+            # If decoding failed, the threads waiting for it try again themselves
+            with self.lock:
+                del self.decoding[index]
+            
+            decoding.set()
+        
+        return data
+    
+    def _readRaw(self, index, offset, count):
+        with self.lock:
+            fds = self.descriptors.get(index)
+            fd = fds.pop() if fds else None
+        
+        if fd is None:
+            fd = os.open(self.partPaths[index], os.O_RDONLY)
+        
+        chunks = []
+        
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+            
+            while count > 0:
+                chunk = os.read(fd, count)
+                
+                if len(chunk) == 0:
+                    break
+                
+                chunks.append(chunk)
+                count -= len(chunk)
+        finally:
+            self._releaseDescriptor(index, fd)
+        
+        return ''.join(chunks)
+    
+    def _releaseDescriptor(self, index, fd):
+        """Keeps a descriptor that's done being read from for the next read of the same part, or closes it if the image
+        has been closed in the meantime"""
+        with self.lock:
+            if not self.closed:
+                fds = self.descriptors.get(index)
+                
+                if fds is None:
+                    self.descriptors.put(index, [fd])
+                else:
+                    fds.append(fd)
+                
+                return
+        
+        os.close(fd)
+    
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.blocks.clear()
+                self.descriptors.clear()
+                self.decoded.clear()
+            
+            # Closing while holding the lock means no descriptor can be kept after the cache has been cleared
+            io.RawIOBase.close(self)
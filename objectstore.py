@@ -0,0 +1,241 @@
+from __future__ import division
+import errno
+import fcntl
+import os
+import tempfile
+from shared import (BackupError, BackupDataError, ManifestEntry, isPartFile, partIndexFromName, partsInSnapshot,
+                    partNamesByIndex, readManifest, isSnapshotDir, writeFileAtomically)
+from compression import availableCodecs
+
+# The object name recorded in an index for a full size part containing only zeros, which like an empty part file
+# isn't stored at all
+emptyObjectName = '-'
+
+class ObjectStore(object):
+    """A folder where every distinct part is stored once, named by its digest, no matter how many snapshots or backups
+    contain it"""
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.objectsPath = os.path.join(self.path, 'objects')
+    
+    def create(self):
+        """Creates the store's folders and files if they don't exist yet"""
+        if not os.path.isdir(self.objectsPath):
+            os.makedirs(self.objectsPath)
+        
+        if not os.path.exists(self.objectPath(emptyObjectName)):
+            open(self.objectPath(emptyObjectName), 'w').close()
+    
+    def exists(self):
+        return os.path.isdir(self.objectsPath)
+    
+    def objectPath(self, name):
+        if name == emptyObjectName:
+            return os.path.join(self.path, 'empty')
+        
+        return os.path.join(self.objectsPath, name[:2], name)
+    
+    def findObject(self, digest):
+        """Returns the name of the object with the given digest, which may be compressed with any codec, or None if the
+        store doesn't contain it"""
+        for name in [digest] + ['%s.%s' % (digest, codec) for codec in availableCodecs()]:
+            if os.path.exists(self.objectPath(name)):
+                return name
+        
+        return None
+    
+    def writeObject(self, name, chunks):
+        """Writes an object made up of chunks of data. It's written to a temporary file and renamed into place, so the
+        object is either complete or not there at all."""
+        directory = os.path.dirname(self.objectPath(name))
+        
+        try:
+            os.mkdir(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        
+        fd, tempPath = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory)
+        
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+            
+            f.flush()
+            os.fsync(f.fileno())
+        
+        os.rename(tempPath, self.objectPath(name))
+    
+    def lock(self, exclusive, blocking):
+        """Locks the store, returning the open lock file that holds the lock until it's closed. Raises BackupError if
+        the store is already locked and blocking isn't set."""
+        lockFile = open(os.path.join(self.path, 'lock'), 'a')
+        
+        try:
+            fcntl.flock(lockFile.fileno(), (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) |
+                        (0 if blocking else fcntl.LOCK_NB))
+        except IOError as e:
+            lockFile.close()
+            
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise BackupError('Object store %s is in use' % self.path)
+            
+            raise
+        
+        return lockFile
+    
+    def rootsPath(self):
+        return os.path.join(self.path, 'roots')
+    
+    def roots(self):
+        """Returns the backup roots that have used the store"""
+        if not os.path.exists(self.rootsPath()):
+            return []
+        
+        with open(self.rootsPath(), 'r') as f:
+            return [line.rstrip('\n') for line in f if line.strip()]
+    
+    def registerRoot(self, root):
+        """Records that the backup at root uses the store, so that garbage collection knows to look at its snapshots"""
+        root = os.path.abspath(root)
+        
+        if root not in self.roots():
+            with open(self.rootsPath(), 'a') as f:
+                f.write(root + '\n')
+    
+    def objectNames(self):
+        """Yields the name of every object in the store along with its path. Temporary files left behind by an
+        interrupted backup are included, so that they get cleaned up."""
+        for directory in sorted(os.listdir(self.objectsPath)):
+            directoryPath = os.path.join(self.objectsPath, directory)
+            
+            if not os.path.isdir(directoryPath):
+                continue
+            
+            for name in sorted(os.listdir(directoryPath)):
+                yield name, os.path.join(directoryPath, name)
+    
+    def referencedObjects(self):
+        """Returns the names of the objects referred to by any snapshot of any backup using the store, including
+        snapshots that are still in progress"""
+        referenced = set()
+        
+        for root in self.roots():
+            if not os.path.isdir(root):
+                continue
+            
+            for snapshot in [root] + [os.path.join(root, x) for x in os.listdir(root) if isSnapshotDir(x)]:
+                if not os.path.exists(indexPath(snapshot)):
+                    continue
+                
+                storePath, manifest, objectNames = readIndex(snapshot)
+                
+                if os.path.realpath(storePath) != os.path.realpath(self.path):
+                    continue
+                
+                referenced.update(objectNames.itervalues())
+                referenced.update(journalObjectNames(snapshot))
+        
+        return referenced
+
+def journalObjectNames(snapshot):
+    """Returns the object names recorded in the journal of an in-progress snapshot, whose index doesn't include them
+    yet"""
+    path = os.path.join(snapshot, 'journal')
+    
+    if not os.path.exists(path):
+        return []
+    
+    with open(path, 'r') as f:
+        return [fields[5] for fields in (line.split() for line in f) if len(fields) == 6 and isPartFile(fields[0])]
+
+def indexPath(snapshot):
+    return os.path.join(snapshot, 'index')
+
+def readIndex(snapshot):
+    """Returns the path of the object store used by the given snapshot, a dictionary mapping part index to
+    ManifestEntry, and a dictionary mapping part index to the name of the object containing the part"""
+    manifest = {}
+    objectNames = {}
+    
+    with open(indexPath(snapshot), 'r') as f:
+        header = f.readline().rstrip('\n').split(' ', 2)
+        
+        if len(header) != 3 or header[0] != 'multipart-backup-index' or header[1] != '1':
+            raise BackupDataError('Index of %s is not valid' % snapshot)
+        
+        for line in f:
+            fields = line.split()
+            
+            if len(fields) != 5 or not isPartFile(fields[0]):
+                continue
+            
+            index = partIndexFromName(fields[0])
+            manifest[index] = ManifestEntry(int(fields[1]), fields[2] == '1', fields[3])
+            objectNames[index] = fields[4]
+    
+    return header[2], manifest, objectNames
+
+def writeIndex(snapshot, storePath, manifest, objectNames):
+    """Writes the index of the given snapshot"""
+    with writeFileAtomically(indexPath(snapshot)) as f:
+        f.write('multipart-backup-index 1 %s\n' % storePath)
+        
+        for index in sorted(manifest.keys()):
+            entry = manifest[index]
+            f.write('part_%08d %d %d %s %s\n' % (index, entry.size, 1 if entry.isZero else 0, entry.digest,
+                                                 objectNames[index]))
+
+def isObjectStoreSnapshot(snapshot):
+    return os.path.exists(indexPath(snapshot))
+
+def partPathsInSnapshot(snapshot):
+    """Returns the paths of the parts of the given snapshot in order. For a snapshot in an object store, these are the
+    paths of the objects named in its index."""
+    if not isObjectStoreSnapshot(snapshot):
+        partNames = partNamesByIndex(snapshot)
+        
+        if sorted(partNames.keys()) != range(len(partNames)):
+            raise BackupDataError('%s is missing parts' % snapshot)
+        
+        return [os.path.join(snapshot, partNames[index]) for index in xrange(len(partNames))]
+    
+    storePath, manifest, objectNames = readIndex(snapshot)
+    store = ObjectStore(storePath)
+    
+    if sorted(objectNames.keys()) != range(len(objectNames)):
+        raise BackupDataError('Index of %s is missing parts' % snapshot)
+    
+    return [store.objectPath(objectNames[index]) for index in xrange(len(objectNames))]
+
+def snapshotManifest(snapshot):
+    """Returns the manifest of the given snapshot, from its index if it's in an object store"""
+    if isObjectStoreSnapshot(snapshot):
+        return readIndex(snapshot)[1]
+    
+    return readManifest(snapshot)
+
+def snapshotsInBackup(backupPath):
+    """Returns the snapshot folders in the given backup root, or the backup path itself if it contains parts directly
+    (i.e. it is a single snapshot or a backup made without snapshots)."""
+    if len(partsInSnapshot(backupPath)) > 0 or isObjectStoreSnapshot(backupPath):
+        return [backupPath]
+    
+    return [os.path.join(backupPath, x) for x in sorted(filter(isSnapshotDir, os.listdir(backupPath)))]
+
+def objectStoreOfBackup(destRoot, snapshotCount):
+    """Returns the object store used by the latest snapshot of the backup at destRoot, or None if it doesn't use one"""
+    if snapshotCount > 0:
+        if not os.path.isdir(destRoot):
+            return None
+        
+        # The in-progress snapshot, if there is one, sorts last
+        snapshots = sorted(filter(isSnapshotDir, os.listdir(destRoot)))
+        latest = os.path.join(destRoot, snapshots[-1]) if len(snapshots) > 0 else None
+    else:
+        latest = destRoot
+    
+    if latest is None or not isObjectStoreSnapshot(latest):
+        return None
+    
+    return ObjectStore(readIndex(latest)[0])
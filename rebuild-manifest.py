@@ -0,0 +1,56 @@
+#!/usr/bin/env python2.7
+from __future__ import division
+import argparse
+import os
+import sys
+from shared import (BackupDataError, outputStatus, humanReadableSizeToBytes, partsInSnapshot,
+                    checkPartsAndGetPartSize, rebuildManifest)
+from objectstore import isObjectStoreSnapshot, snapshotsInBackup
+
+def rebuildManifests(backupPath, defaultPartSize, blockSize):
+    snapshots = snapshotsInBackup(backupPath)
+    
+    if len(snapshots) == 0:
+        raise BackupDataError('No parts or snapshots found in %s' % backupPath)
+    
+    rebuiltCount = 0
+    
+    for snapshot in snapshots:
+        # A snapshot in an object store is described by its index, which can't be rebuilt from parts
+        if isObjectStoreSnapshot(snapshot):
+            continue
+        
+        outputStatus("Rebuilding manifest for %s ..." % os.path.basename(snapshot))
+        partSize = checkPartsAndGetPartSize([os.path.join(snapshot, part) for part in partsInSnapshot(snapshot)],
+                                            blockSize)
+        
+        # If every full size part is empty the part size can't be deduced from the parts themselves
+        if partSize is None:
+            partSize = defaultPartSize
+        
+        rebuildManifest(snapshot, partSize, blockSize)
+        rebuiltCount += 1
+    
+    sys.stdout.write("\nRebuilt %s manifest(s)\n" % rebuiltCount)
+
+def main():
+    parser = argparse.ArgumentParser(description="Recreate the manifests of a multi-part backup from its parts")
+    parser.add_argument('backup', help="Backup root, or folder containing a single snapshot")
+    parser.add_argument('-bs', '--block-size', help='Block size for reading parts. Uses same format for sizes as dd. '
+                        'Defaults to 1 MB.', type=str, default=str(1024*1024))
+    parser.add_argument('-ps', '--part-size', help='Part size to assume when it cannot be deduced from the parts. '
+                        'Uses same format for sizes as dd. Defaults to 100 MB', type=str, default=str(100*1024*1024))
+    args = parser.parse_args()
+    
+    try:
+        partSize = humanReadableSizeToBytes(args.part_size)
+        blockSize = humanReadableSizeToBytes(args.block_size)
+        rebuildManifests(args.backup, partSize, blockSize)
+        return 0
+    except (BackupDataError, ValueError) as e:
+        sys.stderr.write('Error: %s\n' % e)
+        return 1
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -3,59 +3,48 @@ from __future__ import division
 import argparse
 from subprocess import call, Popen, PIPE
 import os
+import io
 import sys
+import stat
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 import shared
 from shared import (BackupDataError, DDError, AverageSpeedCalculator, outputStatus, humanReadableSize,
-                    humanReadableSizeToBytes, partsInSnapshot)
+                    humanReadableSizeToBytes, checkPartsAndGetPartSize, partDigest,
+                    partDataSize, partNeedsDecoding, readPartData, humanReadableDuration, partFilesSize)
+from diskio import zeroRange, writeFully
+from comparison import readFully, zeroPage, window
+from compression import UnknownCodecError
+from metrics import Metrics
+from throttle import Throttle, addThrottleArguments, throttleFromArguments, outputThrottledTime
+from objectstore import partPathsInSnapshot, snapshotManifest
 
 verbose = False
 
-def checkPartsAndGetPartSize(backupPath, parts, blockSize):
-    """Checks to make sure all the parts in the given backup are a consistent size, and returns that size."""
-    backupPartSize = None
-    
-    for i in xrange(len(parts)-1):
-        part = parts[i]
-        partPath = os.path.join(backupPath, part)
-        partSize = os.stat(partPath).st_size
-        
-        if partSize == 0:
-            continue
-        
-        if backupPartSize is None:
-            backupPartSize = partSize
-        else:
-            if partSize != backupPartSize:
-                raise BackupDataError('Parts in backup have inconsistent sizes. Backup may be corrupted!')
-        
-            if partSize % blockSize != 0:
-                print partSize, blockSize
-                raise BackupDataError('Parts in backup have a size that is not an integer multiple of the block size. '
-                                      'Please specify a compatible block size.')
-    
-    return backupPartSize
+def outputRestoreStatus(index, speedCalculator, metrics):
+    if speedCalculator.averageSpeed() is not None and metrics.eta() is not None:
+        outputStatus("Restoring part index %s ... speed: %s/sec, %s remaining" %
+                     (index, humanReadableSize(speedCalculator.averageSpeed()), humanReadableDuration(metrics.eta())))
+    elif speedCalculator.averageSpeed() is not None:
+        outputStatus("Restoring part index %s ... speed: %s/sec" %
+                     (index, humanReadableSize(speedCalculator.averageSpeed())))
+    else:
+        outputStatus("Restoring part index %s ..." % index)
 
-def restore(backupPath, dest, blockSize, startPartIndex):
-    parts = partsInSnapshot(backupPath)
-    backupPartSize = checkPartsAndGetPartSize(backupPath, parts, blockSize)
-    
-    if backupPartSize is None:
-        raise BackupDataError('Could not deduce part size... are all of your parts 0 bytes in size?')
-    
+def restorePartsWithDD(partPaths, dest, backupPartSize, blockSize, startPartIndex, metrics):
     partBlockCount = backupPartSize // blockSize
     speedCalculator = AverageSpeedCalculator(5)
     
-    for i in xrange(startPartIndex, len(parts)):
+    if any(partNeedsDecoding(partPath) for partPath in partPaths[startPartIndex:]):
+        raise BackupDataError('Backup contains compressed parts or deltas, which cannot be restored with dd')
+    
+    for i in xrange(startPartIndex, len(partPaths)):
         speedCalculator.startOfCycle()
         
-        partPath = os.path.join(backupPath, parts[i])
+        partPath = partPaths[i]
         partSize = os.stat(partPath).st_size
-        
-        if speedCalculator.averageSpeed() is not None:
-            outputStatus("Restoring part index %s ... speed: %s/sec" %
-                         (i, humanReadableSize(speedCalculator.averageSpeed())))
-        else:
-            outputStatus("Restoring part index %s ..." % i)
+        outputRestoreStatus(i, speedCalculator, metrics)
         
         if partSize == 0:
             # If the file size is 0, that indicates that it was a full size part that contained only zeros, so we
@@ -64,32 +53,393 @@ def restore(backupPath, dest, blockSize, startPartIndex):
         else:
             partPathToUse = partPath
         
-        if verbose:
-            p = Popen(['dd', 'if=%s' % partPathToUse, 'of=%s' % dest, 'bs=%s' % blockSize, 'count=%s' % partBlockCount,
-                      'oseek=%s' % (i*partBlockCount)])
-            p.communicate()
-        else:
-            p = Popen(['dd', 'if=%s' % partPathToUse, 'of=%s' % dest, 'bs=%s' % blockSize, 'count=%s' % partBlockCount,
-                      'oseek=%s' % (i*partBlockCount)], stdout=PIPE, stderr=PIPE)
-            out, err = p.communicate()
+        with metrics.stage('copy', i):
+            if verbose:
+                p = Popen(['dd', 'if=%s' % partPathToUse, 'of=%s' % dest, 'bs=%s' % blockSize,
+                          'count=%s' % partBlockCount, 'oseek=%s' % (i*partBlockCount)])
+                p.communicate()
+            else:
+                p = Popen(['dd', 'if=%s' % partPathToUse, 'of=%s' % dest, 'bs=%s' % blockSize,
+                          'count=%s' % partBlockCount, 'oseek=%s' % (i*partBlockCount)], stdout=PIPE, stderr=PIPE)
+                out, err = p.communicate()
                 
         if p.returncode != 0:
             sys.stderr.write('dd failed! Output:\n%s\n' % err)
             raise DDError('dd failed on index %s with status %s' % (i, p.returncode))
         
+        imageBytes = partDataSize(partPath, backupPartSize)
+        metrics.count('bytesRead', partSize)
+        metrics.count('bytesWritten', imageBytes)
+        metrics.count('partsZero' if partSize == 0 else 'partsWritten')
+        metrics.partFinished(i, imageBytes, bytesWritten=imageBytes)
         speedCalculator.endOfCycle(partSize)
+
+def readPartBlock(f, buffer, throttle, index):
+    """Reads the next block of the part open as f into buffer, waiting for throttle. Returns the number of bytes
+    read."""
+    startTime = time.time()
+    count = f.readinto(buffer)
+    
+    if count:
+        throttle.read(count, index, time.time() - startTime)
+    
+    return count
+
+def writeThrottled(fd, data, blockSize, throttle, index):
+    """Writes data to fd in pieces of at most blockSize, waiting for throttle before each one"""
+    for chunk in throttle.writeChunks([data], blockSize, index):
+        writeFully(fd, chunk)
+
+def readDecodedPart(partPath, throttle, index):
+    """Returns the decoded contents of a compressed part or a part with deltas, waiting for throttle after reading
+    it"""
+    startTime = time.time()
+    data = readPartData(partPath)
+    throttle.read(partFilesSize(partPath), index, time.time() - startTime)
+    return data
+
+class PartWriter(object):
+    """Writes parts into the destination at their offsets. Each thread gets its own file descriptor and buffer, so
+    parts can be written in parallel."""
+    def __init__(self, dest, backupPartSize, blockSize, zeroParts, diff, manifest, metrics, throttle):
+        self.dest = dest
+        self.backupPartSize = backupPartSize
+        self.blockSize = blockSize
+        self.zeroParts = zeroParts
+        self.diff = diff
+        self.manifest = manifest
+        self.metrics = metrics
+        self.throttle = throttle
+        self.zeroBlock = window(zeroPage(blockSize), 0, blockSize)
+        self.local = threading.local()
+        self.fds = []
+        self.lock = threading.Lock()
+    
+    def _threadFdAndBuffer(self):
+        if not hasattr(self.local, 'fd'):
+            self.local.fd = os.open(self.dest, (os.O_RDWR if self.diff else os.O_WRONLY) | os.O_CREAT, 0o666)
+            self.local.buffer = bytearray(self.backupPartSize if self.diff else self.blockSize)
+            
+            with self.lock:
+                self.fds.append(self.local.fd)
+        
+        return self.local.fd, self.local.buffer
+    
+    def writeZeros(self, fd, offset, length, index):
+        if self.zeroParts == 'skip':
+            return
+        
+        with self.metrics.stage('zero', index):
+            if self.zeroParts == 'discard' and zeroRange(fd, offset, length):
+                return
+            
+            os.lseek(fd, offset, os.SEEK_SET)
+            
+            for blockOffset in xrange(0, length, self.blockSize):
+                count = min(self.blockSize, length-blockOffset)
+                self.throttle.write(count, index)
+                writeFully(fd, self.zeroBlock[:count])
+    
+    def restorePart(self, partPath, index):
+        """Writes the part at partPath to its place in the destination. Returns the number of bytes of the image the
+        part represents and the number of bytes that were written."""
+        if self.diff:
+            return self.restorePartDifferences(partPath, index)
+        
+        fd, buffer = self._threadFdAndBuffer()
+        offset = index * self.backupPartSize
+        
+        if os.stat(partPath).st_size == 0:
+            self.metrics.count('partsZero')
+            self.writeZeros(fd, offset, self.backupPartSize, index)
+            return self.backupPartSize, (0 if self.zeroParts == 'skip' else self.backupPartSize)
+        
+        bytesWritten = 0
+        os.lseek(fd, offset, os.SEEK_SET)
+        
+        if partNeedsDecoding(partPath):
+            with self.metrics.stage('decompress', index):
+                data = readDecodedPart(partPath, self.throttle, index)
+            
+            self.metrics.count('bytesRead', partFilesSize(partPath))
+            
+            with self.metrics.stage('write', index):
+                writeThrottled(fd, data, self.blockSize, self.throttle, index)
+            
+            return len(data), len(data)
+        
+        with io.open(partPath, 'rb', buffering=0) as f:
+            while True:
+                with self.metrics.stage('read', index):
+                    count = readPartBlock(f, buffer, self.throttle, index)
+                
+                if not count:
+                    break
+                
+                with self.metrics.stage('write', index):
+                    self.throttle.write(count, index)
+                    writeFully(fd, memoryview(buffer)[:count])
+                
+                bytesWritten += count
+        
+        self.metrics.count('bytesRead', bytesWritten)
+        
+        return bytesWritten, bytesWritten
+    
+    def restorePartDifferences(self, partPath, index):
+        """Reads the region of the destination the part at partPath belongs in and writes only the blocks that differ
+        from the part. Returns the number of bytes of the image the part represents and the number of bytes that were
+        written."""
+        fd, buffer = self._threadFdAndBuffer()
+        offset = index * self.backupPartSize
+        isZeroPart = os.stat(partPath).st_size == 0
+        size = partDataSize(partPath, self.backupPartSize)
+        
+        if isZeroPart:
+            self.metrics.count('partsZero')
+        
+        if isZeroPart and self.zeroParts == 'skip':
+            return size, 0
+        
+        with self.metrics.stage('compare', index):
+            os.lseek(fd, offset, os.SEEK_SET)
+            
+            with io.open(fd, 'rb', buffering=0, closefd=False) as f:
+                regionLength = readFully(f, buffer, size)
+            
+            # Reading the destination uses the same disk as writing to it, so it counts against the write limits
+            self.throttle.write(regionLength, index)
+            region = memoryview(buffer)[:regionLength]
+            entry = self.manifest.get(index)
+            
+            if not isZeroPart and regionLength == size and entry is not None and entry.size == size:
+                if partDigest(region) == entry.digest:
+                    return size, 0
+        
+        bytesWritten = 0
+        isDecoded = partNeedsDecoding(partPath)
+        
+        if isDecoded:
+            with self.metrics.stage('decompress', index):
+                f = io.BytesIO(readDecodedPart(partPath, self.throttle, index))
+        else:
+            f = open(partPath, 'rb')
+        
+        with f:
+            for blockOffset in xrange(0, size, self.blockSize):
+                length = min(self.blockSize, size-blockOffset)
+                
+                with self.metrics.stage('read', index):
+                    if isZeroPart:
+                        block = self.zeroBlock[:length]
+                    else:
+                        startTime = time.time()
+                        block = f.read(length)
+                        
+                        # Decoded parts were already accounted for as a whole when they were read
+                        if not isDecoded:
+                            self.throttle.read(len(block), index, time.time() - startTime)
+                
+                with self.metrics.stage('compare', index):
+                    if blockOffset + length <= regionLength and region[blockOffset:blockOffset+length] == block:
+                        continue
+                
+                if isZeroPart:
+                    self.writeZeros(fd, offset + blockOffset, length, index)
+                else:
+                    with self.metrics.stage('write', index):
+                        self.throttle.write(length, index)
+                        os.lseek(fd, offset + blockOffset, os.SEEK_SET)
+                        writeFully(fd, block)
+                
+                bytesWritten += length
+        
+        if not isZeroPart:
+            self.metrics.count('bytesRead', partFilesSize(partPath))
+        
+        return size, bytesWritten
+    
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+
+def restoreParts(backupPath, partPaths, dest, backupPartSize, blockSize, startPartIndex, workerCount, zeroParts, diff,
+                 imageSize, metrics, throttle):
+    """Restores the parts into dest from a pool of worker threads, each writing whole parts at their offsets. Returns
+    the number of bytes of the image restored and the number of bytes that were written."""
+    speedCalculator = AverageSpeedCalculator(5)
+    writer = PartWriter(dest, backupPartSize, blockSize, zeroParts, diff, snapshotManifest(backupPath) if diff else {},
+                        metrics, throttle)
+    pool = ThreadPool(workerCount)
+    totalBytesRestored = 0
+    totalBytesWritten = 0
+    
+    def restorePartAtIndex(i):
+        return writer.restorePart(partPaths[i], i)
+    
+    try:
+        speedCalculator.startOfCycle()
+        
+        for i, (bytesRestored, bytesWritten) in enumerate(pool.imap(restorePartAtIndex,
+                                                                    xrange(startPartIndex, len(partPaths))),
+                                                          startPartIndex):
+            metrics.count('bytesWritten', bytesWritten)
+            metrics.count('partsWritten' if bytesWritten > 0 else 'partsSkipped')
+            metrics.partFinished(i, bytesRestored, bytesWritten=bytesWritten)
+            outputRestoreStatus(i, speedCalculator, metrics)
+            speedCalculator.nextCycle(bytesRestored)
+            totalBytesRestored += bytesRestored
+            totalBytesWritten += bytesWritten
+        
+        # Like dd, leave a destination file exactly the size of the image, which also covers any zero parts at its end
+        # that were skipped
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT, 0o666)
+        
+        try:
+            if stat.S_ISREG(os.fstat(fd).st_mode):
+                os.ftruncate(fd, imageSize)
+        finally:
+            os.close(fd)
+    finally:
+        pool.close()
+        pool.join()
+        writer.close()
+    
+    return totalBytesRestored, totalBytesWritten
+
+def restorePartsToStream(partPaths, fd, backupPartSize, blockSize, startPartIndex, metrics, throttle):
+    """Writes the image to fd in order, one block at a time, for a destination that can't seek such as a pipe. Only
+    compressed parts and parts with deltas are held in memory whole. Returns the number of bytes written."""
+    speedCalculator = AverageSpeedCalculator(5)
+    buffer = bytearray(blockSize)
+    zeroBlock = window(zeroPage(blockSize), 0, blockSize)
+    totalBytesWritten = 0
+    speedCalculator.startOfCycle()
+    
+    for i in xrange(startPartIndex, len(partPaths)):
+        partPath = partPaths[i]
+        outputRestoreStatus(i, speedCalculator, metrics)
+        bytesWritten = 0
+        
+        if os.stat(partPath).st_size == 0:
+            metrics.count('partsZero')
+            
+            with metrics.stage('zero', i):
+                for blockOffset in xrange(0, backupPartSize, blockSize):
+                    count = min(blockSize, backupPartSize-blockOffset)
+                    throttle.write(count, i)
+                    writeFully(fd, zeroBlock[:count])
+            
+            bytesWritten = backupPartSize
+        elif partNeedsDecoding(partPath):
+            with metrics.stage('decompress', i):
+                data = readDecodedPart(partPath, throttle, i)
+            
+            metrics.count('bytesRead', partFilesSize(partPath))
+            
+            with metrics.stage('write', i):
+                writeThrottled(fd, data, blockSize, throttle, i)
+            
+            bytesWritten = len(data)
+        else:
+            with io.open(partPath, 'rb', buffering=0) as f:
+                while True:
+                    with metrics.stage('read', i):
+                        count = readPartBlock(f, buffer, throttle, i)
+                    
+                    if not count:
+                        break
+                    
+                    with metrics.stage('write', i):
+                        throttle.write(count, i)
+                        writeFully(fd, memoryview(buffer)[:count])
+                    
+                    bytesWritten += count
+            
+            metrics.count('bytesRead', bytesWritten)
+        
+        metrics.count('bytesWritten', bytesWritten)
+        metrics.count('partsWritten')
+        metrics.partFinished(i, bytesWritten, bytesWritten=bytesWritten)
+        speedCalculator.nextCycle(bytesWritten)
+        totalBytesWritten += bytesWritten
+    
+    return totalBytesWritten
+
+def restore(backupPath, dest, blockSize, startPartIndex, useDD=False, workerCount=2, zeroParts='write', diff=False,
+            metricsPath=None, throttle=None):
+    if throttle is None:
+        throttle = Throttle()
+    
+    if throttle.isLimited() and useDD:
+        raise ValueError('Throttling is not supported when restoring with dd')
+    
+    partPaths = partPathsInSnapshot(backupPath)
+    backupPartSize = checkPartsAndGetPartSize(partPaths, blockSize)
+    
+    if backupPartSize is None:
+        raise BackupDataError('Could not deduce part size... are all of your parts 0 bytes in size?')
+    
+    imageSize = (len(partPaths)-1) * backupPartSize + partDataSize(partPaths[-1], backupPartSize)
+    metrics = Metrics('restore', imageSize, metricsPath)
+    metrics.skip(startPartIndex * backupPartSize)
+    throttle.metrics = metrics
+    succeeded = False
+    
+    if throttle.controlPath is not None:
+        throttle.installSignalHandler()
+    
+    try:
+        if useDD:
+            restorePartsWithDD(partPaths, dest, backupPartSize, blockSize, startPartIndex, metrics)
+        elif dest == '-':
+            bytesRestored = bytesWritten = restorePartsToStream(partPaths, sys.__stdout__.fileno(), backupPartSize,
+                                                                blockSize, startPartIndex, metrics, throttle)
+        else:
+            bytesRestored, bytesWritten = restoreParts(backupPath, partPaths, dest, backupPartSize, blockSize,
+                                                       startPartIndex, workerCount, zeroParts, diff, imageSize,
+                                                       metrics, throttle)
+        
+        succeeded = True
+    finally:
+        throttle.removeSignalHandler()
+        metrics.close(succeeded)
+    
+    if useDD:
+        sys.stdout.write("\nRestore completed\n")
+        return
     
     sys.stdout.write("\nRestore completed\n")
+    outputThrottledTime(metrics)
+    
+    if diff:
+        sys.stdout.write("Wrote %s, skipped %s that was already identical\n" %
+                         (humanReadableSize(bytesWritten), humanReadableSize(bytesRestored - bytesWritten)))
 
 def main():
     global verbose
     parser = argparse.ArgumentParser(description="Iteratively backup file or device to multi-part file")
     parser.add_argument('backup', help="Folder containing multi-part backup")
-    parser.add_argument('dest', help="Destination file or device")
+    parser.add_argument('dest', help="Destination file or device, or - to write the image to stdout")
     parser.add_argument('-bs', '--block-size', help='Block size for dd and comparing files. Uses same format for sizes '
                         'as dd. Defaults to 1MB.', type=str, default=str(1024*1024))
     parser.add_argument('-s', '--start', help='Index of starting part', type=str, default=str(0))
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--use-dd', help='Write each part with dd rather than writing the destination directly. '
+                        'Slower, but available as a fallback.', action='store_true')
+    parser.add_argument('-w', '--workers', type=int, default=2, help='Number of threads writing parts to the '
+                        'destination at the same time. Default is 2.')
+    parser.add_argument('-z', '--zero-parts', choices=['write', 'skip', 'discard'], default='write',
+                        help='How to restore parts that are all zeros. "write" writes out the zeros, "skip" leaves '
+                        'that part of the destination untouched, for a new sparse file or a device known to be zeroed '
+                        'already, and "discard" punches a hole in a file or zeroes out the range of a block device '
+                        'without writing it, falling back to writing zeros. Default is "write".')
+    parser.add_argument('-d', '--diff', help='Read the destination first and only write the blocks that differ from '
+                        'the backup. Much faster when rolling back a device that already holds similar data.',
+                        action='store_true')
+    addThrottleArguments(parser, 'reading parts', 'writing the destination')
+    parser.add_argument('--metrics-file', help='Append a JSON line with the time spent in each stage to this file for '
+                        'every part, and a summary when the restore is done', default=None)
     args = parser.parse_args()
     
     try:
@@ -98,10 +448,26 @@ def main():
         startPartIndex = int(args.start)
         
         blockSize = humanReadableSizeToBytes(args.block_size)
-        restore(args.backup, args.dest, blockSize, startPartIndex)
+        throttle = throttleFromArguments(args)
+        
+        if args.workers < 1:
+            raise ValueError('Worker count must be at least 1')
+        
+        if args.diff and args.use_dd:
+            raise ValueError('--diff cannot be used with --use-dd')
+        
+        if args.dest == '-':
+            if args.diff or args.use_dd or args.zero_parts != 'write':
+                raise ValueError('--diff, --use-dd and --zero-parts cannot be used when restoring to stdout')
+            
+            # The image goes to stdout, so everything else goes to stderr
+            sys.stdout = sys.stderr
+        
+        restore(args.backup, args.dest, blockSize, startPartIndex, args.use_dd, args.workers, args.zero_parts,
+                args.diff, args.metrics_file, throttle)
         return 0
-    except (DDError, BackupDataError) as e:
-        sys.stderr.write('Error: %s\n' % e.message)
+    except (DDError, BackupDataError, ValueError, UnknownCodecError) as e:
+        sys.stderr.write('Error: %s\n' % e)
         return 1
 
 if __name__ == "__main__":
@@ -0,0 +1,397 @@
+#!/usr/bin/env python2.7
+from __future__ import division
+import argparse
+import errno
+import os
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+from Queue import Queue, Full
+from multiprocessing.pool import ThreadPool
+from shared import BackupDataError, humanReadableSize, humanReadableSizeToBytes
+from multipartimage import MultipartImage
+
+# Constants from the NBD protocol, see https://github.com/NetworkBlockDevice/nbd/blob/master/doc/proto.md
+NBD_MAGIC = 0x4e42444d41474943
+NBD_IHAVEOPT = 0x49484156454f5054
+NBD_OPTION_REPLY_MAGIC = 0x3e889045565a9
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_SIMPLE_REPLY_MAGIC = 0x67446698
+
+NBD_FLAG_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_NO_ZEROES = 1 << 1
+NBD_FLAG_C_NO_ZEROES = 1 << 1
+
+NBD_FLAG_HAS_FLAGS = 1 << 0
+NBD_FLAG_READ_ONLY = 1 << 1
+NBD_FLAG_SEND_FLUSH = 1 << 2
+NBD_FLAG_CAN_MULTI_CONN = 1 << 8
+
+NBD_OPT_EXPORT_NAME = 1
+NBD_OPT_ABORT = 2
+NBD_OPT_LIST = 3
+NBD_OPT_INFO = 6
+NBD_OPT_GO = 7
+
+NBD_REP_ACK = 1
+NBD_REP_SERVER = 2
+NBD_REP_INFO = 3
+NBD_REP_ERR_UNSUP = (1 << 31) + 1
+NBD_REP_ERR_INVALID = (1 << 31) + 3
+
+NBD_INFO_EXPORT = 0
+
+NBD_CMD_READ = 0
+NBD_CMD_WRITE = 1
+NBD_CMD_DISC = 2
+NBD_CMD_FLUSH = 3
+
+_requestFormat = '>IHHQQI'
+_requestSize = struct.calcsize(_requestFormat)
+
+# Requests for more than this are refused, so that a client can't make us allocate unlimited memory
+maximumRequestLength = 32*1024*1024
+
+class Overlay(object):
+    """A copy-on-write layer over an image, which itself is never written to. Blocks written by the client are kept in
+    a sparse file at path, which is created afresh, and reads of those blocks are served from it instead of the
+    image."""
+    def __init__(self, path, image, blockSize=4096):
+        self.image = image
+        self.blockSize = blockSize
+        self.file = open(path, 'w+b')
+        self.file.truncate(image.size)
+        self.written = set()
+        self.lock = threading.Lock()
+    
+    def read(self, offset, length):
+        # Only the overlay is read under the lock, so that reads of the image can go on at the same time
+        with self.lock:
+            chunks = self._readWritten(offset, length)
+        
+        return self._readUnwritten(chunks)
+    
+    def _readWritten(self, offset, length):
+        """Reads the runs of blocks that have been written from the overlay file. Returns a list of their data, with
+        the offset and length of each run that has to be read from the image in between."""
+        length = max(0, min(length, self.image.size - offset))
+        end = offset + length
+        chunks = []
+        
+        while offset < end:
+            isWritten = offset // self.blockSize in self.written
+            runEnd = offset
+            
+            while runEnd < end and (runEnd // self.blockSize in self.written) == isWritten:
+                runEnd = min((runEnd // self.blockSize + 1) * self.blockSize, end)
+            
+            if isWritten:
+                self.file.seek(offset)
+                chunks.append(self.file.read(runEnd - offset))
+            else:
+                chunks.append((offset, runEnd - offset))
+            
+            offset = runEnd
+        
+        return chunks
+    
+    def _readUnwritten(self, chunks):
+        return ''.join(self.image.readAt(*chunk) if isinstance(chunk, tuple) else chunk for chunk in chunks)
+    
+    def write(self, offset, data):
+        """Writes data to the overlay at offset. Blocks only partly covered by data are filled in from what's there
+        already, so that every block in the overlay file is complete."""
+        with self.lock:
+            end = offset + len(data)
+            alignedOffset = offset - offset % self.blockSize
+            alignedEnd = min(-(-end // self.blockSize) * self.blockSize, self.image.size)
+            head = self._readUnwritten(self._readWritten(alignedOffset, offset - alignedOffset))
+            tail = self._readUnwritten(self._readWritten(end, alignedEnd - end))
+            self.file.seek(alignedOffset)
+            self.file.write(head + data + tail)
+            self.written.update(xrange(alignedOffset // self.blockSize, -(-alignedEnd // self.blockSize)))
+    
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+    
+    def close(self):
+        self.file.close()
+
+class Prefetcher(object):
+    """Reads ranges of the image into its block cache on a background thread, ahead of a client that's reading
+    sequentially. Requests are dropped rather than queued up when it falls behind."""
+    def __init__(self, image, queueDepth=4):
+        self.image = image
+        self.queue = Queue(queueDepth)
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+    
+    def request(self, offset, length):
+        try:
+            self.queue.put_nowait((offset, length))
+        except Full:
+            pass
+    
+    def _run(self):
+        while True:
+            offset, length = self.queue.get()
+            
+            # Any problem reading the image is reported to the client when it reads that range itself
+            try:
+                self.image.prefetch(offset, length)
+            except Exception:
+                pass
+
+class NBDRequestHandler(SocketServer.BaseRequestHandler):
+    """Serves one client connection: negotiates the export using the fixed newstyle handshake, and then handles
+    requests on a pool of worker threads so that several can be in progress at once. Replies may be sent in a
+    different order than the requests arrived, which the protocol allows."""
+    def setup(self):
+        self.sendLock = threading.Lock()
+        self.sequentialOffset = None
+    
+    def handle(self):
+        try:
+            if not self.negotiate():
+                return
+            
+            self.transmit()
+        except EOFError:
+            pass
+        except socket.error as e:
+            if e.errno not in (errno.ECONNRESET, errno.EPIPE):
+                raise
+    
+    def receive(self, length):
+        chunks = []
+        
+        while length > 0:
+            chunk = self.request.recv(min(length, 1024*1024))
+            
+            if len(chunk) == 0:
+                raise EOFError()
+            
+            chunks.append(chunk)
+            length -= len(chunk)
+        
+        return ''.join(chunks)
+    
+    def send(self, *chunks):
+        with self.sendLock:
+            self.request.sendall(''.join(chunks))
+    
+    def transmissionFlags(self):
+        flags = NBD_FLAG_HAS_FLAGS | NBD_FLAG_CAN_MULTI_CONN
+        
+        if self.server.overlay is None:
+            return flags | NBD_FLAG_READ_ONLY
+        
+        return flags | NBD_FLAG_SEND_FLUSH
+    
+    def sendOptionReply(self, option, replyType, data=''):
+        self.send(struct.pack('>QIII', NBD_OPTION_REPLY_MAGIC, option, replyType, len(data)), data)
+    
+    def negotiate(self):
+        """Runs the handshake and option haggling. Returns true once the client has picked the export, or false if it
+        gave up."""
+        self.send(struct.pack('>QQH', NBD_MAGIC, NBD_IHAVEOPT, NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES))
+        clientFlags = struct.unpack('>I', self.receive(4))[0]
+        
+        while True:
+            magic, option, length = struct.unpack('>QII', self.receive(16))
+            
+            if magic != NBD_IHAVEOPT or length > 65536:
+                return False
+            
+            data = self.receive(length)
+            
+            if option == NBD_OPT_EXPORT_NAME:
+                self.send(struct.pack('>QH', self.server.image.size, self.transmissionFlags()),
+                          '' if clientFlags & NBD_FLAG_C_NO_ZEROES else '\0' * 124)
+                return True
+            elif option == NBD_OPT_ABORT:
+                self.sendOptionReply(option, NBD_REP_ACK)
+                return False
+            elif option == NBD_OPT_LIST:
+                self.sendOptionReply(option, NBD_REP_SERVER, struct.pack('>I', len(self.server.exportName)) +
+                                     self.server.exportName)
+                self.sendOptionReply(option, NBD_REP_ACK)
+            elif option in (NBD_OPT_INFO, NBD_OPT_GO):
+                if length < 6:
+                    self.sendOptionReply(option, NBD_REP_ERR_INVALID)
+                    continue
+                
+                self.sendOptionReply(option, NBD_REP_INFO, struct.pack('>HQH', NBD_INFO_EXPORT, self.server.image.size,
+                                                                       self.transmissionFlags()))
+                self.sendOptionReply(option, NBD_REP_ACK)
+                
+                if option == NBD_OPT_GO:
+                    return True
+            else:
+                self.sendOptionReply(option, NBD_REP_ERR_UNSUP)
+    
+    def transmit(self):
+        """Reads requests until the client disconnects, handing each one to the pool"""
+        pool = ThreadPool(self.server.workerCount)
+        
+        try:
+            while True:
+                magic, flags, command, handle, offset, length = struct.unpack(_requestFormat,
+                                                                               self.receive(_requestSize))
+                
+                if magic != NBD_REQUEST_MAGIC or command == NBD_CMD_DISC:
+                    break
+                
+                if command == NBD_CMD_WRITE and length > maximumRequestLength:
+                    # The data that follows can't be skipped without reading it, so give up on the connection
+                    break
+                
+                data = self.receive(length) if command == NBD_CMD_WRITE else None
+                
+                if command == NBD_CMD_READ:
+                    self.readAhead(offset, length)
+                
+                pool.apply_async(self.serveRequest, (command, handle, offset, length, data))
+        finally:
+            pool.close()
+            pool.join()
+    
+    def readAhead(self, offset, length):
+        """Asks the prefetcher for the range following a read that continues on from the previous one"""
+        if self.server.readahead > 0 and offset == self.sequentialOffset:
+            self.server.prefetcher.request(offset + length, self.server.readahead)
+        
+        self.sequentialOffset = offset + length
+    
+    def serveRequest(self, command, handle, offset, length, data):
+        server = self.server
+        error = 0
+        replyData = ''
+        
+        try:
+            if command == NBD_CMD_READ:
+                if offset + length > server.image.size or length > maximumRequestLength:
+                    error = errno.EINVAL
+                elif server.overlay is not None:
+                    replyData = server.overlay.read(offset, length)
+                else:
+                    replyData = server.image.readAt(offset, length)
+            elif command == NBD_CMD_WRITE:
+                if server.overlay is None:
+                    error = errno.EPERM
+                elif offset + length > server.image.size:
+                    error = errno.ENOSPC
+                else:
+                    server.overlay.write(offset, data)
+            elif command == NBD_CMD_FLUSH:
+                if server.overlay is not None:
+                    server.overlay.flush()
+            else:
+                error = errno.EINVAL
+        except Exception as e:
+            # Whatever went wrong, the client still gets a reply, or it would wait for one forever
+            sys.stderr.write('Error serving request at offset %s: %s\n' % (offset, e))
+            error = errno.EIO
+            replyData = ''
+        
+        try:
+            self.send(struct.pack('>IIQ', NBD_SIMPLE_REPLY_MAGIC, error, handle), replyData)
+        except socket.error:
+            # The client has gone away, which the connection's own thread will notice
+            pass
+
+class NBDServerMixin(SocketServer.ThreadingMixIn):
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def setupExport(self, image, exportName, overlay, workerCount, readahead):
+        self.image = image
+        self.exportName = exportName
+        self.overlay = overlay
+        self.workerCount = workerCount
+        self.readahead = readahead
+        self.prefetcher = Prefetcher(image)
+
+class NBDTCPServer(NBDServerMixin, SocketServer.TCPServer):
+    pass
+
+class NBDUnixServer(NBDServerMixin, SocketServer.UnixStreamServer):
+    pass
+
+def serve(snapshot, blockSize, socketPath, address, port, overlayPath, workerCount, readahead, cachedBlocks):
+    """Exports snapshot over NBD until interrupted"""
+    if workerCount < 1:
+        raise ValueError('Number of workers must be at least 1')
+    
+    image = MultipartImage(snapshot, blockSize, cachedBlocks)
+    overlay = Overlay(overlayPath, image) if overlayPath is not None else None
+    
+    if socketPath is not None:
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        
+        server = NBDUnixServer(socketPath, NBDRequestHandler)
+        location = socketPath
+    else:
+        server = NBDTCPServer((address, port), NBDRequestHandler)
+        location = '%s:%s' % (address, port)
+    
+    server.setupExport(image, os.path.basename(os.path.normpath(snapshot)), overlay, workerCount, readahead)
+    sys.stdout.write("Serving %s (%s) %s on %s\n" % (snapshot, humanReadableSize(image.size),
+                                                     'read-only' if overlay is None else 'with writes going to %s' %
+                                                     overlayPath, location))
+    sys.stdout.flush()
+    
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        
+        if socketPath is not None:
+            os.remove(socketPath)
+        
+        if overlay is not None:
+            overlay.close()
+        
+        image.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a snapshot of a multi-part backup as a network block device, "
+                                     "without restoring it")
+    parser.add_argument('snapshot', help="Folder containing the snapshot to export")
+    parser.add_argument('-bs', '--block-size', help='Block size for reading parts. Uses same format for sizes as dd. '
+                        'Defaults to 1 MB.', type=str, default=str(1024*1024))
+    parser.add_argument('--socket', help='Listen on a Unix domain socket at this path rather than on TCP',
+                        default=None)
+    parser.add_argument('--address', help='Address to listen on. Defaults to 127.0.0.1.', default='127.0.0.1')
+    parser.add_argument('-p', '--port', help='Port to listen on. Defaults to 10809.', type=int, default=10809)
+    parser.add_argument('--overlay', help='Allow writes, keeping them in a new file at this path. The snapshot itself '
+                        'is never written to.', default=None)
+    parser.add_argument('-w', '--workers', type=int, default=4, help='Number of threads serving requests for each '
+                        'client. Default is 4.')
+    parser.add_argument('--readahead', help='How far ahead to read when a client reads sequentially. Uses same format '
+                        'for sizes as dd. Defaults to 8 MB, 0 turns it off.', type=str, default=str(8*1024*1024))
+    parser.add_argument('--cache-blocks', type=int, default=64, help='Number of blocks to keep cached in memory. '
+                        'Default is 64.')
+    args = parser.parse_args()
+    
+    try:
+        blockSize = humanReadableSizeToBytes(args.block_size)
+        readahead = humanReadableSizeToBytes(args.readahead)
+        serve(args.snapshot, blockSize, args.socket, args.address, args.port, args.overlay, args.workers, readahead,
+              args.cache_blocks)
+        return 0
+    except (BackupDataError, ValueError, EnvironmentError) as e:
+        sys.stderr.write('Error: %s\n' % e)
+        return 1
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
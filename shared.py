@@ -6,6 +6,11 @@ import time
 from subprocess import check_output
 import platform
 import uuid
+import re
+import hashlib
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 _outputStatusLastSize = 0
 _outputStatusDontReplaceLine = False
@@ -41,6 +46,12 @@ class AverageSpeedCalculator(object):
         self.bytesCopiedList = self.bytesCopiedList[-self.maxSamples:]
         self.currentAverageSpeed = sum(self.bytesCopiedList) / sum(self.timingList)
     
+    def nextCycle(self, bytesCopied):
+        """Ends the current cycle and starts the next one right away. Used when copy operations overlap, so that the
+        average speed is measured from when one operation finishes to when the next one does."""
+        self.endOfCycle(bytesCopied)
+        self.startOfCycle()
+    
     def averageSpeed(self):
         return self.currentAverageSpeed
 
@@ -59,6 +70,19 @@ def outputStatus(str):
     sys.stdout.flush()
     _outputStatusLastSize = len(str)
 
+def forEachInParallel(function, items, workerCount):
+    """Calls function with each of items from a pool of workerCount threads, re-raising the first error. Used for the
+    many small metadata operations of creating and removing snapshots, which on network filesystems spend far more time
+    waiting on round trips than doing any work."""
+    pool = ThreadPool(workerCount)
+    
+    try:
+        for result in pool.imap_unordered(function, items, 16):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+
 def humanReadableSize(bytes):
     """Returns a nicer human readable representation of the given size in bytes"""
     if bytes < 1024:
@@ -70,6 +94,11 @@ def humanReadableSize(bytes):
     else:
         return '%.1fG' % (bytes / (1024*1024*1024))
 
+def humanReadableDuration(seconds):
+    """Returns the given number of seconds formatted as hours, minutes and seconds"""
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
 def humanReadableSizeToBytes(value):
     """Converts a human readable size value into an exact number of bytes. Uses
     the same format as dd."""
@@ -95,12 +124,306 @@ def humanReadableSizeToBytes(value):
     else:
         return number * validSuffixes[suffix]
 
+_zeroPartDigests = {}
+
+# Size is the number of bytes of source data the part represents, which for a part that is all zeros and stored as an
+# empty file is the full part size
+ManifestEntry = namedtuple('ManifestEntry', ['size', 'isZero', 'digest'])
+
 def isPartFile(filename):
-    return len(filename) == 13 and filename.startswith('part_') and filename[-8:].isdigit()
+    """Returns true if filename is the name of a part: part_ followed by the part's index, with the name of the codec
+    as an extension if the part is compressed"""
+    name, extension = os.path.splitext(filename)
+    return (len(name) == 13 and name.startswith('part_') and name[-8:].isdigit() and
+            (extension == '' or (extension[1:].isalnum() and extension != '.new')))
+
+def partFileName(index, codec=None):
+    """Returns the name of the part at index, compressed with codec if given"""
+    if codec is None:
+        return 'part_%08d' % index
+    
+    return 'part_%08d.%s' % (index, codec)
+
+def partCodec(partName):
+    """Returns the name of the codec the named part was compressed with, or None if it isn't compressed"""
+    extension = os.path.splitext(partName)[1]
+    return extension[1:] if extension else None
+
+def isDeltaFile(filename):
+    """Returns true if filename is the name of a delta: delta_ followed by the index of the part it applies to and its
+    position in that part's chain of deltas"""
+    return (len(filename) == 18 and filename.startswith('delta_') and filename[6:14].isdigit() and
+            filename[14] == '_' and filename[15:].isdigit())
+
+def deltaFileName(index, sequence):
+    """Returns the name of the delta at position sequence, starting from 1, in the chain of the part at index"""
+    return 'delta_%08d_%03d' % (index, sequence)
+
+def deltaIndexFromName(deltaName):
+    return int(deltaName[6:14])
+
+def deltasInSnapshot(dest):
+    return sorted(filter(isDeltaFile, os.listdir(dest)))
+
+def deltaNamesByIndex(dest):
+    """Returns a dictionary mapping part index to the names of the deltas in that part's chain in dest, in the order
+    they're applied"""
+    deltaNames = {}
+    
+    for delta in deltasInSnapshot(dest):
+        deltaNames.setdefault(deltaIndexFromName(delta), []).append(delta)
+    
+    return deltaNames
+
+def partDeltaPaths(partPath):
+    """Returns the paths of the deltas to apply, in order, to the part at partPath to get the part's data"""
+    directory, partName = os.path.split(partPath)
+    
+    if not isPartFile(partName):
+        return []
+    
+    paths = []
+    
+    while True:
+        path = os.path.join(directory, deltaFileName(partIndexFromName(partName), len(paths)+1))
+        
+        if not os.path.exists(path):
+            return paths
+        
+        paths.append(path)
+
+def partFilesSize(partPath):
+    """Returns the number of bytes in the files that make up the part at partPath: the part itself and its deltas"""
+    return sum(os.stat(path).st_size for path in [partPath] + partDeltaPaths(partPath))
+
+def partNeedsDecoding(partPath):
+    """Returns true if the part at partPath can't be used as is, because it's compressed or has deltas to apply"""
+    return partCodec(partPath) is not None or len(partDeltaPaths(partPath)) > 0
+
+def partNamesByIndex(dest):
+    """Returns a dictionary mapping part index to the name of the part with that index in dest. Raises BackupDataError
+    if more than one part has the same index."""
+    partNames = {}
+    
+    for part in partsInSnapshot(dest):
+        index = partIndexFromName(part)
+        
+        if index in partNames:
+            raise BackupDataError('%s contains more than one file for part %s: %s and %s' %
+                                  (dest, index, partNames[index], part))
+        
+        partNames[index] = part
+    
+    return partNames
+
+def storedPartDataSize(partPath):
+    """Returns the number of bytes of data in the part at partPath, which is 0 for an empty part of all zeros"""
+    codec = partCodec(partPath)
+    deltaPaths = partDeltaPaths(partPath)
+    
+    if len(deltaPaths) > 0:
+        from delta import deltaDataSize
+        return deltaDataSize(deltaPaths[-1])
+    
+    if codec is not None:
+        from compression import compressedPartDataSize
+        return compressedPartDataSize(partPath)
+    
+    return os.stat(partPath).st_size
+
+def partDataSize(partPath, backupPartSize):
+    """Returns the number of bytes of the image a part represents. An empty part stands for a full size part that
+    contained only zeros."""
+    partSize = storedPartDataSize(partPath)
+    return backupPartSize if partSize == 0 else partSize
+
+def readPartData(partPath):
+    """Returns the contents of the part at partPath, decompressing it and applying its deltas if needed"""
+    codec = partCodec(partPath)
+    
+    if codec is not None:
+        from compression import readCompressedPart
+        data = readCompressedPart(partPath, codec)
+    else:
+        with open(partPath, 'rb') as f:
+            data = f.read()
+    
+    deltaPaths = partDeltaPaths(partPath)
+    
+    if len(deltaPaths) > 0:
+        from delta import applyDeltaChain
+        data = applyDeltaChain(data, deltaPaths)
+    
+    return data
 
 def partsInSnapshot(dest):
     return sorted(filter(isPartFile, os.listdir(dest)))
 
+def inProgressSnapshotName():
+    return 'snapshot-inprogress'
+
+def isSnapshotDir(dirName):
+    return (dirName == inProgressSnapshotName() or
+            re.search(r"^snapshot-\d{4}-\d{2}-\d{2}-\d{6}", dirName) is not None)
+
+def fileOrDeviceSize(path):
+    """Returns the size in bytes of a file or device"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        return f.tell()
+
+def deviceIdentifierForSourceString(source, sourceIsUUID):
+    """Returns the file or device to read for source, which is a partition UUID if sourceIsUUID is set"""
+    if sourceIsUUID:
+        result = findDiskDeviceIdentifierByUUID(source)
+        
+        if result is None:
+            raise ValueError('Could not find a partition with UUID: %s' % source)
+        
+        return result
+    elif os.path.exists(source):
+        return source
+    else:
+        raise ValueError('"%s" is not a valid device identifier or file' % source)
+
+def partIndexFromName(partName):
+    return int(partName[5:13])
+
+def checkPartsAndGetPartSize(partPaths, blockSize):
+    """Checks to make sure all the parts of a backup are a consistent size, and returns that size."""
+    backupPartSize = None
+    
+    for i in xrange(len(partPaths)-1):
+        partPath = partPaths[i]
+        partSize = storedPartDataSize(partPath)
+        
+        if partSize == 0:
+            continue
+        
+        if backupPartSize is None:
+            backupPartSize = partSize
+        else:
+            if partSize != backupPartSize:
+                raise BackupDataError('Parts in backup have inconsistent sizes. Backup may be corrupted!')
+        
+            if partSize % blockSize != 0:
+                raise BackupDataError('Parts in backup have a size that is not an integer multiple of the block size. '
+                                      'Please specify a compatible block size.')
+    
+    return backupPartSize
+
+def partDigest(data):
+    """Returns the digest recorded in the manifest for a part containing data"""
+    return hashlib.sha256(data).hexdigest()
+
+def zeroPartDigest(length):
+    """Returns the digest of a part consisting of length zeros. Digests are cached since most zero parts have the same
+    length."""
+    if length not in _zeroPartDigests:
+        _zeroPartDigests[length] = partDigest('\0' * length)
+    
+    return _zeroPartDigests[length]
+
+def manifestPath(snapshot):
+    return os.path.join(snapshot, 'manifest')
+
+def readManifest(snapshot):
+    """Returns a dictionary mapping part index to ManifestEntry for the given snapshot. Returns an empty dictionary if
+    the snapshot has no manifest."""
+    manifest = {}
+    
+    if not os.path.exists(manifestPath(snapshot)):
+        return manifest
+    
+    with open(manifestPath(snapshot), 'r') as f:
+        for line in f:
+            fields = line.split()
+            
+            if len(fields) != 4 or not isPartFile(fields[0]):
+                continue
+            
+            manifest[partIndexFromName(fields[0])] = ManifestEntry(int(fields[1]), fields[2] == '1', fields[3])
+    
+    return manifest
+
+@contextmanager
+def writeFileAtomically(path):
+    """Opens a temporary file that replaces the file at path once it's been written, so that an interruption never
+    leaves a partially written file behind"""
+    tempPath = path + '.new'
+    
+    with open(tempPath, 'w') as f:
+        yield f
+        
+        # Otherwise a power loss could leave the rename on disk without the data it renamed
+        f.flush()
+        os.fsync(f.fileno())
+    
+    os.rename(tempPath, path)
+
+def writeManifest(snapshot, manifest):
+    """Writes the manifest of the given snapshot"""
+    with writeFileAtomically(manifestPath(snapshot)) as f:
+        for index in sorted(manifest.keys()):
+            entry = manifest[index]
+            f.write('part_%08d %d %d %s\n' % (index, entry.size, 1 if entry.isZero else 0, entry.digest))
+
+def manifestEntryForPartFile(partPath, partSize, blockSize, throttle=None):
+    """Reads the part at partPath and returns its ManifestEntry. An empty part is taken to be a part of size partSize
+    containing only zeros. Each read waits for throttle, if given."""
+    if os.stat(partPath).st_size == 0:
+        return ManifestEntry(partSize, True, zeroPartDigest(partSize))
+    
+    if partNeedsDecoding(partPath):
+        startTime = time.time()
+        data = readPartData(partPath)
+        
+        if throttle is not None:
+            throttle.read(partFilesSize(partPath), None, time.time() - startTime)
+        
+        isZero = data.count('\0') == len(data)
+        return ManifestEntry(len(data), isZero, zeroPartDigest(len(data)) if isZero else partDigest(data))
+    
+    with open(partPath, 'rb') as f:
+        return manifestEntryForFile(f, blockSize, None, throttle)
+
+def manifestEntryForFile(f, blockSize, length=None, throttle=None):
+    """Reads length bytes from the current position of the open file f, or up to its end if length is None, and returns
+    their ManifestEntry. Each read waits for throttle, if given."""
+    hasher = hashlib.sha256()
+    size = 0
+    isZero = True
+    
+    while length is None or size < length:
+        startTime = time.time()
+        block = f.read(blockSize if length is None else min(blockSize, length - size))
+        
+        if len(block) == 0:
+            break
+        
+        if throttle is not None:
+            throttle.read(len(block), None, time.time() - startTime)
+        
+        hasher.update(block)
+        size += len(block)
+        
+        if isZero and block.count('\0') != len(block):
+            isZero = False
+    
+    return ManifestEntry(size, isZero, hasher.hexdigest())
+
+def rebuildManifest(snapshot, partSize, blockSize):
+    """Recreates the manifest of the given snapshot from the parts on disk. partSize is the size of the empty parts
+    that represent parts of all zeros."""
+    manifest = {}
+    
+    for part in partsInSnapshot(snapshot):
+        manifest[partIndexFromName(part)] = manifestEntryForPartFile(os.path.join(snapshot, part), partSize,
+                                                                     blockSize)
+    
+    writeManifest(snapshot, manifest)
+    return manifest
+
 def normalizeUUID(uuidString):
     return str(uuid.UUID(uuidString)).lower()
 
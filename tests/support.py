@@ -0,0 +1,102 @@
+from __future__ import division
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from contextlib import contextmanager
+from StringIO import StringIO
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+_scripts = {}
+
+def loadScript(name):
+    """Imports one of the scripts, e.g. 'backup-to-parts', whose names can't be imported the usual way"""
+    if name not in _scripts:
+        _scripts[name] = imp.load_source(name.replace('-', '_'), os.path.join(repoPath, name + '.py'))
+    
+    return _scripts[name]
+
+@contextmanager
+def quiet():
+    """Hides the progress the scripts write to stdout, and gives what they wrote as a StringIO"""
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    
+    try:
+        yield sys.stdout
+    finally:
+        sys.stdout = stdout
+
+def makeImage(path, size):
+    """Writes an image of size bytes to path with random data, a compressible stretch and a stretch of zeros, and
+    returns its data"""
+    data = bytearray(os.urandom(size))
+    data[size//5:size*2//5] = 'a' * (size*2//5 - size//5)
+    data[size*3//5:size*4//5] = '\0' * (size*4//5 - size*3//5)
+    writeImage(path, data)
+    return data
+
+def makeSparseImage(path, size, ranges):
+    """Writes a sparse image of size bytes to path with random data in each of the (offset, length) ranges and holes
+    everywhere else, and returns its data"""
+    data = bytearray(size)
+    
+    with open(path, 'wb') as f:
+        for offset, length in ranges:
+            data[offset:offset+length] = os.urandom(length)
+            f.seek(offset)
+            f.write(data[offset:offset+length])
+        
+        f.truncate(size)
+    
+    return data
+
+def writeImage(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+class FakeClock(object):
+    """Stands in for the time module of the module being tested, so that waiting only moves the clock forward. onSleep
+    is called with the number of seconds each time something sleeps."""
+    def __init__(self):
+        self.now = 1000.0
+        self.onSleep = None
+    
+    def time(self):
+        return self.now
+    
+    def sleep(self, seconds):
+        # Like a real sleep, even the shortest one moves the clock on, or rounding could leave a wait that never ends
+        self.now += max(seconds, 1e-9)
+        
+        if self.onSleep is not None:
+            self.onSleep(seconds)
+
+class TempDirTestCase(unittest.TestCase):
+    """Gives each test a temporary folder of its own, at self.dir"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def path(self, *names):
+        return os.path.join(self.dir, *names)
+    
+    def backup(self, source, destRoot, partSize=64*1024, blockSize=16*1024, snapshotCount=3, **kwargs):
+        """Backs up source into destRoot and returns the snapshot that was made"""
+        backupToParts = loadScript('backup-to-parts')
+        
+        # Snapshots are named after the second they're finished in, so two can't be finished in the same second
+        while os.path.exists(os.path.join(destRoot, backupToParts.snapshotTimestamp())):
+            time.sleep(0.1)
+        
+        with quiet():
+            backupToParts.backup(source, False, [destRoot], partSize, blockSize, False, snapshotCount, **kwargs)
+        
+        return sorted(os.path.join(destRoot, x) for x in os.listdir(destRoot) if x.startswith('snapshot-'))[-1]
@@ -0,0 +1,525 @@
+from __future__ import division
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from support import TempDirTestCase, loadScript, makeImage, makeSparseImage, writeImage, quiet
+from shared import ManifestEntry, readManifest, partsInSnapshot
+from changelog import readChangeLog, snapshotChanges
+from multipartimage import MultipartImage
+import diskio
+from diskio import dataRanges
+
+backupToParts = loadScript('backup-to-parts')
+
+class JournalTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.header = backupToParts.journalHeader(1000, 64*1024, False)
+        self.parts = [backupToParts.PreparedPart(0, ManifestEntry(100, False, 'abc'), True, 'part_00000000.zlib'),
+                      backupToParts.PreparedPart(1, ManifestEntry(200, True, 'def'), False, None),
+                      backupToParts.PreparedPart(2, ManifestEntry(300, False, 'ghi'), True, None)]
+    
+    def writeJournal(self):
+        journal = backupToParts.CommitJournal(self.dir, self.header, False)
+        
+        for part in self.parts:
+            journal.record(part)
+        
+        journal.close()
+        return journal
+    
+    def testRoundTrip(self):
+        self.assertEqual(self.writeJournal().changedIndexes, set([0, 2]))
+        self.assertEqual(backupToParts.readJournal(self.dir, self.header), self.parts)
+    
+    def testResumeAppends(self):
+        self.writeJournal()
+        journal = backupToParts.CommitJournal(self.dir, self.header, True)
+        journal.record(backupToParts.PreparedPart(3, ManifestEntry(400, False, 'jkl'), False, None))
+        journal.close()
+        self.assertEqual(len(backupToParts.readJournal(self.dir, self.header)), 4)
+    
+    def testMissingOrMismatchedJournal(self):
+        self.assertIsNone(backupToParts.readJournal(self.dir, self.header))
+        self.writeJournal()
+        self.assertIsNone(backupToParts.readJournal(self.dir, backupToParts.journalHeader(1001, 64*1024, False)))
+        self.assertIsNone(backupToParts.readJournal(self.dir, backupToParts.journalHeader(1000, 64*1024, True)))
+    
+    def testIncompleteLastLineIsIgnored(self):
+        self.writeJournal()
+        
+        with open(backupToParts.journalPath(self.dir), 'a') as f:
+            f.write('part_00000003 400 0 jk')
+        
+        self.assertEqual(backupToParts.readJournal(self.dir, self.header), self.parts)
+
+class ResumeTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.source = self.path('source.img')
+        self.data = makeImage(self.source, 6*64*1024)
+        self.rename = os.rename
+    
+    def tearDown(self):
+        backupToParts.os.rename = self.rename
+        TempDirTestCase.tearDown(self)
+    
+    def interruptCommitOf(self, partName):
+        """Makes the next backup stop as it's about to commit partName"""
+        def rename(source, dest):
+            if os.path.basename(dest) == partName:
+                raise KeyboardInterrupt()
+            
+            return self.rename(source, dest)
+        
+        backupToParts.os.rename = rename
+    
+    def backupInterrupted(self, partName, source=None, **kwargs):
+        self.interruptCommitOf(partName)
+        
+        with self.assertRaises(KeyboardInterrupt):
+            self.backup(source or self.source, self.path('backup'), **kwargs)
+        
+        backupToParts.os.rename = self.rename
+        self.assertTrue(os.path.exists(self.path('backup', 'snapshot-inprogress', 'journal')))
+    
+    def backupStream(self, interruptAt=None):
+        """Backs up the source from stdin, stopping as it's about to commit interruptAt if it's given"""
+        stdin = sys.stdin
+        
+        with open(self.source, 'rb') as sys.stdin:
+            try:
+                if interruptAt is None:
+                    return self.backup('-', self.path('backup'))
+                
+                self.backupInterrupted(interruptAt, '-')
+            finally:
+                sys.stdin = stdin
+    
+    def assertSnapshotMatchesSource(self, snapshot):
+        self.assertEqual(MultipartImage(snapshot, 16*1024).readAt(0, len(self.data)), str(self.data))
+    
+    def testResumeAfterInterruptedCommit(self):
+        first = self.backup(self.source, self.path('backup'), codec='zlib')
+        
+        # Part 1 stops being compressible, so the part replacing it is stored in a different format
+        self.data[64*1024:2*64*1024] = os.urandom(64*1024)
+        self.data[4*64*1024] = 'x'
+        writeImage(self.source, self.data)
+        self.backupInterrupted('part_00000001', codec='zlib')
+        second = self.backup(self.source, self.path('backup'), codec='zlib')
+        
+        names = partsInSnapshot(second)
+        self.assertEqual(len(names), len(set(name.split('.')[0] for name in names)))
+        self.assertFalse(os.path.exists(os.path.join(second, 'journal')))
+        self.assertEqual(len(readManifest(second)), 6)
+        self.assertSnapshotMatchesSource(second)
+        self.assertEqual(readChangeLog(second)[2], snapshotChanges(first, second)[1])
+        self.assertEqual(sorted(change.index for change in readChangeLog(second)[2] if change.action != 'deleted'),
+                         [1, 4])
+    
+    def testResumeIntoObjectStore(self):
+        self.backup(self.source, self.path('backup'), objectStorePath=self.path('store'))
+        self.data[0] = 'x'
+        self.data[3*64*1024] = 'y'
+        writeImage(self.source, self.data)
+        self.backupInterrupted('index', objectStorePath=self.path('store'))
+        second = self.backup(self.source, self.path('backup'), objectStorePath=self.path('store'))
+        self.assertSnapshotMatchesSource(second)
+        self.assertEqual([change.index for change in readChangeLog(second)[2]], [0, 3])
+    
+    def testStreamInterruptedTwice(self):
+        first = self.backupStream()
+        
+        for index in (1, 3, 4):
+            self.data[index*64*1024] = 'x'
+        
+        writeImage(self.source, self.data)
+        
+        # A stream is read again from the start when resumed, so the second backup finds part 1 already changed
+        self.backupStream('part_00000003')
+        self.backupStream('part_00000004')
+        second = self.backupStream()
+        self.assertSnapshotMatchesSource(second)
+        self.assertEqual([(change.action, change.index) for change in readChangeLog(second)[2]],
+                         [('changed', 1), ('changed', 3), ('changed', 4)])
+        self.assertEqual(readChangeLog(second)[2], snapshotChanges(first, second)[1])
+
+class PipelineTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.source = self.path('source.img')
+        self.data = makeImage(self.source, 640*1024)
+        self.preparePart = backupToParts.BackupDestination.preparePart
+        self.commitPart = backupToParts.BackupDestination.commitPart
+        self.prepared = []
+        self.committed = []
+        
+        def commitPart(destination, preparedPart):
+            self.committed.append(preparedPart.index)
+            return self.commitPart(destination, preparedPart)
+        
+        backupToParts.BackupDestination.commitPart = commitPart
+    
+    def tearDown(self):
+        backupToParts.BackupDestination.preparePart = self.preparePart
+        backupToParts.BackupDestination.commitPart = self.commitPart
+        TempDirTestCase.tearDown(self)
+    
+    def prepareWith(self, before):
+        """Makes before be called with the index of each part before it's prepared"""
+        def preparePart(destination, buffer, length, index, entry, storeAsEmpty):
+            before(index)
+            preparedPart = self.preparePart(destination, buffer, length, index, entry, storeAsEmpty)
+            self.prepared.append(index)
+            return preparedPart
+        
+        backupToParts.BackupDestination.preparePart = preparePart
+    
+    def testPartsAreCommittedInOrder(self):
+        def before(index):
+            # The first part is held up until the three after it have been prepared by the other workers
+            for i in xrange(1000):
+                if index != 0 or set([1, 2, 3]) <= set(self.prepared):
+                    break
+                
+                time.sleep(0.01)
+        
+        self.prepareWith(before)
+        snapshot = self.backup(self.source, self.path('backup'), workerCount=4, queueDepth=4)
+        self.assertGreater(self.prepared.index(0), max(self.prepared.index(i) for i in (1, 2, 3)))
+        self.assertEqual(self.committed, range(10))
+        self.assertEqual(MultipartImage(snapshot, 16*1024).readAt(0, len(self.data)), str(self.data))
+    
+    def testPartsBeforeErrorAreCommitted(self):
+        def before(index):
+            if index == 5:
+                raise IOError('Failed to write part 5')
+        
+        self.prepareWith(before)
+        
+        with self.assertRaises(IOError):
+            self.backup(self.source, self.path('backup'), workerCount=4, queueDepth=4)
+        
+        # Parts after the one that failed are never committed, even if they were prepared
+        committedCount = len(self.committed)
+        self.assertEqual(self.committed, range(committedCount))
+        self.assertTrue(committedCount <= 5)
+        header = backupToParts.journalHeader(len(self.data), 64*1024, False)
+        self.assertEqual([p.index for p in backupToParts.readJournal(self.path('backup', 'snapshot-inprogress'),
+                                                                      header)], self.committed)
+        
+        # The next backup carries on from the first part that wasn't committed
+        self.committed = []
+        backupToParts.BackupDestination.preparePart = self.preparePart
+        snapshot = self.backup(self.source, self.path('backup'))
+        self.assertEqual(self.committed, range(committedCount, 10))
+        self.assertEqual(MultipartImage(snapshot, 16*1024).readAt(0, len(self.data)), str(self.data))
+
+class MultipleRootsTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.source = self.path('source.img')
+        self.data = makeImage(self.source, 640*1024)
+        self.roots = [self.path('first'), self.path('second')]
+    
+    def backupIntoBoth(self, **kwargs):
+        """Backs up into both roots at once, and returns the snapshot made in each"""
+        while any(os.path.exists(os.path.join(root, backupToParts.snapshotTimestamp())) for root in self.roots):
+            time.sleep(0.1)
+        
+        with quiet():
+            backupToParts.backup(self.source, False, self.roots, 64*1024, 16*1024, False, 3, **kwargs)
+        
+        return [os.path.join(root, sorted(x for x in os.listdir(root) if x.startswith('snapshot-'))[-1])
+                for root in self.roots]
+    
+    def testEachRootGetsSnapshot(self):
+        first = self.backup(self.source, self.roots[0])
+        self.data[5*64*1024] = 'x'
+        writeImage(self.source, self.data)
+        snapshots = self.backupIntoBoth(workerCount=3)
+        
+        for snapshot in snapshots:
+            self.assertEqual(MultipartImage(snapshot, 16*1024).readAt(0, len(self.data)), str(self.data))
+            self.assertEqual(readManifest(snapshot), readManifest(snapshots[0]))
+        
+        # Each root's change log is against its own previous snapshot
+        self.assertEqual(readChangeLog(snapshots[0])[2], snapshotChanges(first, snapshots[0])[1])
+        self.assertEqual([change.index for change in readChangeLog(snapshots[0])[2]], [5])
+        self.assertEqual(len(readChangeLog(snapshots[1])[2]), 10)
+    
+    def testResumeOneRoot(self):
+        # Only the second root was interrupted, so it picks up where it left off while the first root is backed up
+        # from the start
+        rename = os.rename
+        
+        def interruptingRename(source, dest):
+            if dest == os.path.join(self.roots[1], 'snapshot-inprogress', 'part_00000003'):
+                raise KeyboardInterrupt()
+            
+            return rename(source, dest)
+        
+        backupToParts.os.rename = interruptingRename
+        
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                self.backup(self.source, self.roots[1])
+        finally:
+            backupToParts.os.rename = rename
+        
+        for snapshot in self.backupIntoBoth():
+            self.assertEqual(MultipartImage(snapshot, 16*1024).readAt(0, len(self.data)), str(self.data))
+    
+    def testSlowRootFallsBehindWithinItsQueue(self):
+        prepareParts = backupToParts.BackupDestination.preparePart
+        readPart = backupToParts.BackupPipeline._readPart
+        readIndexes = []
+        release = threading.Event()
+        roots = self.roots
+        
+        def slowPreparePart(destination, buffer, length, index, entry, storeAsEmpty):
+            if destination.path.startswith(roots[1]):
+                release.wait(10)
+            
+            return prepareParts(destination, buffer, length, index, entry, storeAsEmpty)
+        
+        def recordingReadPart(pipeline, buffer, index):
+            readIndexes.append(index)
+            return readPart(pipeline, buffer, index)
+        
+        def releaseOnceStalled():
+            # The second root holds one part in its worker and two in its queue, and the reader is waiting to hand it
+            # the part after those
+            while len(readIndexes) < 4:
+                time.sleep(0.01)
+            
+            time.sleep(0.2)
+            stalledIndexes.extend(readIndexes)
+            release.set()
+        
+        stalledIndexes = []
+        backupToParts.BackupDestination.preparePart = slowPreparePart
+        backupToParts.BackupPipeline._readPart = recordingReadPart
+        thread = threading.Thread(target=releaseOnceStalled)
+        thread.start()
+        
+        try:
+            snapshots = self.backupIntoBoth(workerCount=1, queueDepth=2)
+        finally:
+            release.set()
+            thread.join()
+            backupToParts.BackupDestination.preparePart = prepareParts
+            backupToParts.BackupPipeline._readPart = readPart
+        
+        self.assertEqual(stalledIndexes, [0, 1, 2, 3])
+        
+        for snapshot in snapshots:
+            self.assertEqual(MultipartImage(snapshot, 16*1024).readAt(0, len(self.data)), str(self.data))
+
+class CompressionTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.source = self.path('source.img')
+        
+        # Parts 2 and 3 compress, parts 6 and 7 are all zeros, and the rest are random
+        self.data = makeImage(self.source, 640*1024)
+    
+    def backupWithMetrics(self, **kwargs):
+        """Backs up the source, and returns the snapshot and the lines written to the metrics file"""
+        snapshot = self.backup(self.source, self.path('backup'), metricsPath=self.path('metrics'), **kwargs)
+        
+        with open(self.path('metrics')) as f:
+            lines = [json.loads(line) for line in f]
+        
+        os.remove(self.path('metrics'))
+        return snapshot, lines
+    
+    def compressedIndexes(self, lines):
+        """Returns the indexes of the parts that compression was tried on"""
+        return [line['index'] for line in lines if line['type'] == 'part' and 'compress' in line['stageSeconds']]
+    
+    def testIncompressiblePartsAreStoredRaw(self):
+        snapshot, lines = self.backupWithMetrics(codec='zlib', compressionProcesses=2)
+        self.assertEqual(partsInSnapshot(snapshot), ['part_%08d' % i for i in (0, 1)] +
+                         ['part_%08d.zlib' % i for i in (2, 3)] + ['part_%08d' % i for i in (4, 5, 6, 7, 8, 9)])
+        
+        # Random parts are stored raw because of their entropy, without trying to compress them
+        self.assertEqual(self.compressedIndexes(lines), [2, 3])
+        self.assertEqual(lines[-1]['counts']['partsCompressed'], 2)
+        self.assertEqual(MultipartImage(snapshot, 16*1024).readAt(0, len(self.data)), str(self.data))
+    
+    def testPartsThatDontCompressAreStoredRaw(self):
+        # Without the entropy check random parts are compressed, but the result is thrown away
+        snapshot, lines = self.backupWithMetrics(codec='zlib', entropyThreshold=8.0)
+        self.assertEqual(self.compressedIndexes(lines), [0, 1, 2, 3, 4, 5, 8, 9])
+        self.assertEqual([name for name in partsInSnapshot(snapshot) if name.endswith('.zlib')],
+                         ['part_00000002.zlib', 'part_00000003.zlib'])
+    
+    def testUnchangedBackupWritesNothing(self):
+        first, lines = self.backupWithMetrics(codec='zlib')
+        second, lines = self.backupWithMetrics(codec='zlib')
+        counts = lines[-1]['counts']
+        self.assertEqual(counts['partsUnchanged'], 10)
+        self.assertNotIn('partsChanged', counts)
+        self.assertNotIn('bytesWritten', counts)
+        self.assertEqual(self.compressedIndexes(lines), [])
+        self.assertEqual(readChangeLog(second)[2], [])
+        
+        for name in partsInSnapshot(first):
+            self.assertEqual(os.stat(os.path.join(first, name)).st_ino, os.stat(os.path.join(second, name)).st_ino)
+        
+        self.assertEqual(partsInSnapshot(first), partsInSnapshot(second))
+
+class NoCacheTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.source = self.path('source.img')
+        self.data = makeImage(self.source, 10*64*1024 - 1000)
+        self.functions = dict((name, getattr(backupToParts, name))
+                              for name in ('openUncached', 'fadvise', 'dropFromCache'))
+        self.advice = []
+        self.dropped = []
+        self.uncachedOpens = []
+        
+        def openUncached(path):
+            fd = self.functions['openUncached'](path)
+            self.uncachedOpens.append(fd is not None)
+            return fd
+        
+        def fadvise(fd, offset, length, advice):
+            self.advice.append((offset, length, advice))
+            return self.functions['fadvise'](fd, offset, length, advice)
+        
+        def dropFromCache(path):
+            self.dropped.append(os.path.basename(path))
+            return self.functions['dropFromCache'](path)
+        
+        backupToParts.openUncached = openUncached
+        backupToParts.fadvise = fadvise
+        backupToParts.dropFromCache = dropFromCache
+    
+    def tearDown(self):
+        for name, function in self.functions.items():
+            setattr(backupToParts, name, function)
+        
+        TempDirTestCase.tearDown(self)
+    
+    def assertSnapshotMatchesSource(self, snapshot):
+        self.assertEqual(MultipartImage(snapshot, 16*1024).readAt(0, len(self.data)), str(self.data))
+    
+    def sourceAdvice(self, advice):
+        return [(offset, length) for offset, length, a in self.advice if a == advice]
+    
+    def testDirectIO(self):
+        fd = self.functions['openUncached'](self.source)
+        
+        if fd is None:
+            self.skipTest('The filesystem of the temporary folder does not support O_DIRECT')
+        
+        os.close(fd)
+        snapshot = self.backup(self.source, self.path('backup'), noCache=True)
+        self.assertSnapshotMatchesSource(snapshot)
+        
+        # Reading with O_DIRECT bypasses the cache already, so the source isn't advised at all
+        self.assertEqual(self.uncachedOpens, [True])
+        self.assertEqual(self.sourceAdvice(diskio.POSIX_FADV_WILLNEED), [])
+        
+        # Every part written is dropped from the cache, and so is every existing part the next backup compares, which
+        # without a manifest is all of them
+        self.assertEqual(self.sourceAdvice(diskio.POSIX_FADV_DONTNEED), [(0, 0)] * 10)
+        os.remove(os.path.join(snapshot, 'manifest'))
+        compared = [name for name in partsInSnapshot(snapshot) if os.path.getsize(os.path.join(snapshot, name)) > 0]
+        self.data[0] = 'x'
+        writeImage(self.source, self.data)
+        snapshot = self.backup(self.source, self.path('backup'), noCache=True)
+        self.assertSnapshotMatchesSource(snapshot)
+        self.assertEqual(sorted(self.dropped), compared)
+    
+    def testFallBackToDroppingSourceFromCache(self):
+        self.functions['openUncached'] = lambda path: None
+        snapshot = self.backup(self.source, self.path('backup'), noCache=True)
+        self.assertSnapshotMatchesSource(snapshot)
+        self.assertEqual(self.uncachedOpens, [False])
+        self.assertEqual(self.sourceAdvice(diskio.POSIX_FADV_SEQUENTIAL), [(0, 0)])
+        self.assertEqual(self.sourceAdvice(diskio.POSIX_FADV_WILLNEED)[:3],
+                         [(64*1024, 64*1024), (2*64*1024, 64*1024), (3*64*1024, 64*1024)])
+        
+        # Each part of the source is dropped once it's been read, and so are the parts written to the backup
+        self.assertEqual(sorted(self.sourceAdvice(diskio.POSIX_FADV_DONTNEED)),
+                         [(0, 0)] * 10 + [(i*64*1024, 64*1024) for i in xrange(9)] + [(9*64*1024, 64*1024 - 1000)])
+    
+    def testUnalignedBlockSizeIsNotReadDirectly(self):
+        snapshot = self.backup(self.source, self.path('backup'), partSize=60000, blockSize=15000, noCache=True)
+        self.assertEqual(self.uncachedOpens, [])
+        self.assertEqual(len(self.sourceAdvice(diskio.POSIX_FADV_SEQUENTIAL)), 1)
+        self.assertEqual(MultipartImage(snapshot, 15000).readAt(0, len(self.data)), str(self.data))
+
+class SparseSourceTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.source = self.path('source.img')
+        
+        # Parts 1, 2, 5 and 6 lie entirely in holes, and there's data crossing from part 3 into 4 and from 7 into 8
+        self.data = makeSparseImage(self.source, 10*64*1024 - 3000,
+                                    [(0, 10000), (3*64*1024 + 5000, 64*1024 + 15000), (8*64*1024 - 3000, 6000),
+                                     (10*64*1024 - 5000, 2000)])
+        
+        with open(self.source, 'rb') as f:
+            if dataRanges(f.fileno(), 0, len(self.data)) is None:
+                self.skipTest('The filesystem of the temporary folder cannot find holes')
+    
+    def readPart(self, index):
+        buffer = bytearray(64*1024)
+        
+        with open(self.source, 'rb') as f:
+            length, bytesRead = backupToParts.readSparsePartIntoBuffer(f, buffer, 64*1024, 16*1024, index)
+        
+        self.assertEqual(buffer[:length], self.data[index*64*1024:index*64*1024+length])
+        return length, bytesRead
+    
+    def testReadSparsePart(self):
+        self.assertEqual(self.readPart(1), (64*1024, 0))
+        self.assertEqual(self.readPart(0)[1], 16*1024)
+        
+        # Only the blocks holding the data on either side of a part boundary are read
+        self.assertEqual(self.readPart(3)[1], 64*1024)
+        self.assertEqual(self.readPart(4)[1], 2*16*1024)
+        self.assertEqual(self.readPart(7)[1], 16*1024)
+        self.assertEqual(self.readPart(8)[1], 16*1024)
+        self.assertEqual(self.readPart(9), (64*1024 - 3000, 16*1024 - 3000))
+    
+    def testBackupSparseSource(self):
+        isBufferAllZeros = backupToParts.isBufferAllZeros
+        checkedLengths = []
+        
+        def checkedIsBufferAllZeros(buffer, length, blockSize):
+            checkedLengths.append(length)
+            return isBufferAllZeros(buffer, length, blockSize)
+        
+        backupToParts.isBufferAllZeros = checkedIsBufferAllZeros
+        
+        try:
+            snapshot = self.backup(self.source, self.path('backup'), metricsPath=self.path('metrics'))
+        finally:
+            backupToParts.isBufferAllZeros = isBufferAllZeros
+        
+        manifest = readManifest(snapshot)
+        self.assertEqual(sorted(index for index, entry in manifest.items() if entry.isZero), [1, 2, 5, 6])
+        self.assertEqual(manifest[9].size, 64*1024 - 3000)
+        self.assertEqual(MultipartImage(snapshot, 16*1024).readAt(0, len(self.data)), str(self.data))
+        
+        # Parts that lie entirely in holes are known to be zeros without checking
+        self.assertEqual(len(checkedLengths), 6)
+        
+        with open(self.path('metrics')) as f:
+            counts = json.loads(f.readlines()[-1])['counts']
+        
+        self.assertEqual(counts['bytesRead'], 10*16*1024 - 3000)
+        self.assertEqual(counts['bytesRead'] + counts['bytesInHoles'], len(self.data))
+
+if __name__ == '__main__':
+    unittest.main()
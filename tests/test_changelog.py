@@ -0,0 +1,79 @@
+from __future__ import division
+import os
+import unittest
+from support import TempDirTestCase, makeImage, writeImage
+from shared import ManifestEntry, partsInSnapshot
+from changelog import Change, readChangeLog, snapshotChanges, changesBetweenSnapshots, combineChanges
+
+class ChangeLogTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.source = self.path('source.img')
+        self.data = makeImage(self.source, 640*1024)
+    
+    def change(self, offset, data):
+        self.data[offset:offset+len(data)] = data
+        writeImage(self.source, self.data)
+    
+    def actions(self, snapshot):
+        return [(change.action, change.name) for change in readChangeLog(snapshot)[2]]
+    
+    def testFirstSnapshotAddsEverything(self):
+        snapshot = self.backup(self.source, self.path('backup'))
+        kind, prevName, changes = readChangeLog(snapshot)
+        self.assertEqual((kind, prevName), ('files', None))
+        self.assertEqual(sorted(change.name for change in changes), sorted(partsInSnapshot(snapshot)))
+        self.assertTrue(all(change.action == 'added' for change in changes))
+    
+    def testRoundTrip(self):
+        first = self.backup(self.source, self.path('backup'))
+        self.change(0, 'x' * 10)
+        self.change(9*64*1024, '\0' * 64*1024)
+        second = self.backup(self.source, self.path('backup'))
+        kind, prevName, changes = readChangeLog(second)
+        self.assertEqual(prevName, os.path.basename(first))
+        self.assertEqual([(change.action, change.index, change.name) for change in changes],
+                         [('changed', 0, 'part_00000000'), ('zeroed', 9, 'part_00000009')])
+        self.assertEqual(changes[0].entry.digest, snapshotChanges(first, second)[1][0].entry.digest)
+        self.assertEqual(changes[1], Change('zeroed', 9, 'part_00000009', 0, changes[1].entry))
+        self.assertTrue(changes[1].entry.isZero)
+    
+    def testLogMatchesComparingEveryPart(self):
+        first = self.backup(self.source, self.path('backup'), codec='zlib', deltaDepth=2)
+        self.change(100, 'x' * 10)
+        self.change(3*64*1024, os.urandom(64*1024))
+        writeImage(self.source, self.data[:8*64*1024])
+        second = self.backup(self.source, self.path('backup'), codec='zlib', deltaDepth=2)
+        self.assertEqual(readChangeLog(second)[2], snapshotChanges(first, second)[1])
+        self.assertIn(('added', 'delta_00000000_001'), self.actions(second))
+        self.assertIn(('deleted', 'part_00000009'), self.actions(second))
+    
+    def testChangesBetweenSnapshots(self):
+        first = self.backup(self.source, self.path('backup'))
+        self.change(0, 'x' * 10)
+        self.backup(self.source, self.path('backup'))
+        self.change(64*1024, 'y' * 10)
+        third = self.backup(self.source, self.path('backup'))
+        self.assertEqual([(change.action, change.name) for change in changesBetweenSnapshots(first, third)],
+                         [('changed', 'part_00000000'), ('changed', 'part_00000001')])
+    
+    def testObjectsAreNeverDeleted(self):
+        self.backup(self.source, self.path('backup'), objectStorePath=self.path('store'))
+        self.change(0, 'x' * 10)
+        second = self.backup(self.source, self.path('backup'), objectStorePath=self.path('store'))
+        kind, prevName, changes = readChangeLog(second)
+        self.assertEqual(kind, 'objects')
+        self.assertEqual([(change.action, change.index) for change in changes], [('added', 0)])
+
+class CombineChangesTest(unittest.TestCase):
+    def change(self, action, name):
+        return Change(action, 0, name, 10, ManifestEntry(10, False, 'abc'))
+    
+    def testCombine(self):
+        first = [self.change('added', 'a'), self.change('changed', 'b'), self.change('deleted', 'c')]
+        second = [self.change('deleted', 'a'), self.change('changed', 'b'), self.change('added', 'c')]
+        self.assertEqual([(change.action, change.name) for change in combineChanges([first, second])],
+                         [('changed', 'b'), ('changed', 'c')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+from __future__ import division
+import os
+import unittest
+from support import TempDirTestCase
+import comparison
+from comparison import (firstNonZeroOffset, firstDifferenceOffset, firstNonZeroOffsetInFile,
+                        firstDifferenceOffsetInFiles, firstDifferenceOffsetWithFile)
+
+class ComparisonTest(unittest.TestCase):
+    def testFirstDifferenceOffset(self):
+        data = bytearray(os.urandom(10000))
+        other = bytearray(data)
+        self.assertEqual(firstDifferenceOffset(data, other, 64), None)
+        other[5000] ^= 1
+        
+        for blockSize in (1, 7, 64, 4096, 20000):
+            self.assertEqual(firstDifferenceOffset(data, other, blockSize), 5000)
+        
+        self.assertEqual(firstDifferenceOffset(data, other, 64, 5000), None)
+    
+    def testLengthMismatch(self):
+        data = os.urandom(1000)
+        self.assertEqual(firstDifferenceOffset(data, data[:600], 64), 600)
+        self.assertEqual(firstDifferenceOffset(data[:600], data, 64), 600)
+        self.assertEqual(firstDifferenceOffset('', data, 64), 0)
+    
+    def testFirstNonZeroOffset(self):
+        data = bytearray(10000)
+        self.assertEqual(firstNonZeroOffset(data, 64), None)
+        data[9999] = 1
+        self.assertEqual(firstNonZeroOffset(data, 64), 9999)
+        self.assertEqual(firstNonZeroOffset(data, 64, 9999), None)
+
+class FileComparisonTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.data = os.urandom(100000)
+        self.minimumReadSize = comparison._minimumReadSize
+        
+        # Reading only a few KB at a time makes files that aren't mapped take several reads
+        comparison._minimumReadSize = 4096
+    
+    def tearDown(self):
+        comparison._minimumReadSize = self.minimumReadSize
+        TempDirTestCase.tearDown(self)
+    
+    def write(self, name, data):
+        with open(self.path(name), 'wb') as f:
+            f.write(data)
+        
+        return self.path(name)
+    
+    def testFilesDiffer(self):
+        changed = bytearray(self.data)
+        changed[70000] ^= 1
+        path1 = self.write('a', self.data)
+        
+        for useMmap in (True, False):
+            self.assertEqual(firstDifferenceOffsetInFiles(path1, self.write('b', self.data), 1000, useMmap), None)
+            self.assertEqual(firstDifferenceOffsetInFiles(path1, self.write('b', changed), 1000, useMmap), 70000)
+            self.assertEqual(firstDifferenceOffsetWithFile(changed, len(changed), path1, 1000, useMmap), 70000)
+            self.assertEqual(firstDifferenceOffsetWithFile(self.data, 50000, self.write('b', self.data[:50000]),
+                                                           1000, useMmap), None)
+    
+    def testFileLengthMismatch(self):
+        path = self.write('a', self.data)
+        shorter = self.write('b', self.data[:60000])
+        empty = self.write('c', '')
+        
+        for useMmap in (True, False):
+            self.assertEqual(firstDifferenceOffsetInFiles(path, shorter, 1000, useMmap), 60000)
+            self.assertEqual(firstDifferenceOffsetInFiles(shorter, path, 1000, useMmap), 60000)
+            self.assertEqual(firstDifferenceOffsetInFiles(path, empty, 1000, useMmap), 0)
+            self.assertEqual(firstDifferenceOffsetInFiles(empty, self.write('d', ''), 1000, useMmap), None)
+            self.assertEqual(firstDifferenceOffsetWithFile(self.data, len(self.data), shorter, 1000, useMmap), 60000)
+            self.assertEqual(firstDifferenceOffsetWithFile(self.data, 60000, path, 1000, useMmap), 60000)
+    
+    def testNonZeroOffsetInFile(self):
+        data = bytearray(100000)
+        
+        for useMmap in (True, False):
+            self.assertEqual(firstNonZeroOffsetInFile(self.write('a', data), 1000, useMmap), None)
+            self.assertEqual(firstNonZeroOffsetInFile(self.write('a', ''), 1000, useMmap), None)
+        
+        data[54321] = 1
+        
+        for useMmap in (True, False):
+            self.assertEqual(firstNonZeroOffsetInFile(self.write('a', data), 1000, useMmap), 54321)
+
+if __name__ == '__main__':
+    unittest.main()
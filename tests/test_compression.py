@@ -0,0 +1,41 @@
+from __future__ import division
+import os
+import unittest
+from support import TempDirTestCase
+from shared import BackupDataError, partCodec, partDataSize, readPartData
+from compression import (UnknownCodecError, availableCodecs, codecFunctions, compressData, compressedPartHeader,
+                         compressedPartDataSize, readCompressedPart, isWorthCompressing)
+
+class CompressedPartTest(TempDirTestCase):
+    def writePart(self, name, codec, data, length=None):
+        with open(self.path(name), 'wb') as f:
+            f.write(compressedPartHeader(len(data) if length is None else length))
+            f.write(compressData(codec, data))
+        
+        return self.path(name)
+    
+    def testRoundTrip(self):
+        data = 'abc' * 10000
+        
+        for codec in availableCodecs():
+            path = self.writePart('part_00000000.' + codec, codec, data)
+            self.assertEqual(partCodec(path), codec)
+            self.assertEqual(compressedPartDataSize(path), len(data))
+            self.assertEqual(partDataSize(path, 65536), len(data))
+            self.assertEqual(readCompressedPart(path, codec), data)
+            self.assertEqual(readPartData(path), data)
+            os.remove(path)
+    
+    def testWrongLength(self):
+        path = self.writePart('part_00000000.zlib', 'zlib', 'abc' * 100, 301)
+        self.assertRaises(BackupDataError, readCompressedPart, path, 'zlib')
+    
+    def testUnknownCodec(self):
+        self.assertRaises(UnknownCodecError, codecFunctions, 'nope')
+    
+    def testRandomDataIsNotWorthCompressing(self):
+        self.assertFalse(isWorthCompressing(os.urandom(65536), 65536))
+        self.assertTrue(isWorthCompressing('a' * 65536, 65536))
+
+if __name__ == '__main__':
+    unittest.main()
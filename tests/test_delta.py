@@ -0,0 +1,57 @@
+from __future__ import division
+import os
+import unittest
+from support import TempDirTestCase
+from shared import BackupDataError
+from delta import changedRanges, encodeDelta, deltaDataSize, applyDelta, applyDeltaChain
+
+class DeltaTest(TempDirTestCase):
+    def writeDelta(self, name, newData, oldData, blockSize=16):
+        with open(self.path(name), 'wb') as f:
+            for chunk in encodeDelta(newData, oldData, len(newData), blockSize):
+                f.write(chunk)
+        
+        return self.path(name)
+    
+    def testChangedRanges(self):
+        old = 'a' * 100
+        new = 'b' + 'a' * 40 + 'b' * 20 + 'a' * 38 + 'b'
+        self.assertEqual(list(changedRanges(new, old, 100, 16)), [(0, 16), (32, 32), (96, 4)])
+    
+    def testRoundTrip(self):
+        old = os.urandom(1000)
+        new = bytearray(old)
+        new[0:5] = 'xxxxx'
+        new[500:700] = os.urandom(200)
+        new[999] = 'y'
+        path = self.writeDelta('delta', new, old)
+        self.assertEqual(deltaDataSize(path), 1000)
+        self.assertEqual(applyDelta(bytearray(old), path), new)
+    
+    def testUnchangedDeltaHasNoRecords(self):
+        data = os.urandom(100)
+        path = self.writeDelta('delta', data, data)
+        self.assertEqual(os.path.getsize(path), 8)
+        self.assertEqual(applyDelta(bytearray(data), path), bytearray(data))
+    
+    def testChain(self):
+        first = os.urandom(256)
+        second = first[:100] + 'x' * 20 + first[120:]
+        third = second[:200] + 'y' * 56
+        paths = [self.writeDelta('delta1', second, first), self.writeDelta('delta2', third, second)]
+        self.assertEqual(applyDeltaChain(first, paths), third)
+    
+    def testWrongLength(self):
+        path = self.writeDelta('delta', 'b' * 100, 'a' * 100)
+        self.assertRaises(BackupDataError, applyDelta, bytearray('a' * 99), path)
+    
+    def testTruncated(self):
+        path = self.writeDelta('delta', 'b' * 100, 'a' * 100)
+        
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 1)
+        
+        self.assertRaises(BackupDataError, applyDelta, bytearray('a' * 100), path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+from __future__ import division
+import unittest
+from support import TempDirTestCase, makeSparseImage
+from diskio import dataRanges
+
+class DataRangesTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.data = makeSparseImage(self.path('sparse.img'), 256*1024, [(10000, 2000), (64*1024 - 4096, 8192)])
+        self.file = open(self.path('sparse.img'), 'rb')
+        
+        if dataRanges(self.file.fileno(), 0, len(self.data)) is None:
+            self.skipTest('The filesystem of the temporary folder cannot find holes')
+    
+    def tearDown(self):
+        self.file.close()
+        TempDirTestCase.tearDown(self)
+    
+    def ranges(self, offset, length):
+        return dataRanges(self.file.fileno(), offset, length)
+    
+    def testRangesCoverData(self):
+        ranges = self.ranges(0, len(self.data))
+        self.assertTrue(any(start <= 10000 and 12000 <= start + length for start, length in ranges))
+        self.assertTrue(any(start <= 60*1024 and 68*1024 <= start + length for start, length in ranges))
+        self.assertTrue(all(start + length <= 68*1024 for start, length in ranges))
+    
+    def testRangesAreClipped(self):
+        # The data crossing 64 KB is split between the two halves
+        self.assertEqual(self.ranges(0, 64*1024)[-1], (60*1024, 4096))
+        self.assertEqual(self.ranges(64*1024, 64*1024), [(64*1024, 4096)])
+        self.assertEqual(self.ranges(62*1024, 1024), [(62*1024, 1024)])
+    
+    def testHole(self):
+        self.assertEqual(self.ranges(128*1024, 64*1024), [])
+        self.assertEqual(self.ranges(len(self.data), 1000), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+from __future__ import division
+import json
+import unittest
+from support import TempDirTestCase, FakeClock, makeImage
+import metrics
+from metrics import Metrics
+
+class MetricsTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.clock = FakeClock()
+        self.time = metrics.time
+        metrics.time = self.clock
+    
+    def tearDown(self):
+        metrics.time = self.time
+        TempDirTestCase.tearDown(self)
+    
+    def lines(self):
+        with open(self.path('metrics')) as f:
+            return [json.loads(line) for line in f]
+    
+    def testLines(self):
+        m = Metrics('backup', 1000, self.path('metrics'))
+        
+        with m.stage('read', 0):
+            self.clock.now += 2
+        
+        with m.stage('setup'):
+            self.clock.now += 1
+        
+        m.count('partsChanged')
+        m.count('bytesWritten', 500)
+        m.partFinished(0, 500, changed=True)
+        m.close(True)
+        start, part, summary = self.lines()
+        self.assertEqual((start['type'], start['operation'], start['totalBytes'], start['time']),
+                         ('start', 'backup', 1000, 1000))
+        self.assertEqual((part['type'], part['index'], part['imageBytes'], part['changed'], part['stageSeconds'],
+                          part['elapsedSeconds'], part['etaSeconds']), ('part', 0, 500, True, {'read': 2}, 3, 3))
+        self.assertEqual((summary['type'], summary['succeeded'], summary['imageBytes'], summary['bytesPerSecond']),
+                         ('summary', True, 500, 500 / 3))
+        self.assertEqual(summary['stageSeconds'], {'read': 2, 'setup': 1})
+        self.assertEqual(summary['counts'], {'partsChanged': 1, 'bytesWritten': 500})
+    
+    def testETA(self):
+        m = Metrics('restore', 1000)
+        self.assertEqual(m.eta(), None)
+        self.clock.now += 10
+        m.partFinished(0, 250)
+        self.assertEqual(m.eta(), 30)
+        
+        # Bytes that are skipped, like parts a resumed backup already did, aren't waited for
+        m.skip(250)
+        self.assertEqual(m.eta(), 20)
+        m.partFinished(1, 500)
+        self.assertEqual(m.eta(), 0)
+        self.assertEqual(Metrics('backup', None).eta(), None)
+    
+    def testPartsFromThreadsAreTimedSeparately(self):
+        m = Metrics('backup', None)
+        m.addTime('compress', 1.5, 3)
+        m.addTime('compress', 0.5, 4)
+        m.addTime('compress', 1, 3)
+        self.assertEqual(m.summary()['stageSeconds'], {'compress': 3})
+        self.assertEqual(dict(m.partStageSeconds[3]), {'compress': 2.5})
+
+class BackupMetricsTest(TempDirTestCase):
+    def testBackupWritesLinePerPart(self):
+        data = makeImage(self.path('source.img'), 10*64*1024)
+        self.backup(self.path('source.img'), self.path('backup'), metricsPath=self.path('metrics'))
+        
+        with open(self.path('metrics')) as f:
+            lines = [json.loads(line) for line in f]
+        
+        self.assertEqual([line['type'] for line in lines], ['start'] + ['part'] * 10 + ['summary'])
+        self.assertEqual([line['index'] for line in lines[1:-1]], range(10))
+        self.assertEqual(sum(line['imageBytes'] for line in lines[1:-1]), len(data))
+        self.assertEqual([line['zero'] for line in lines[1:-1]], [False] * 6 + [True] * 2 + [False] * 2)
+        self.assertTrue(lines[-1]['succeeded'])
+        self.assertEqual(lines[-1]['counts']['partsChanged'], 10)
+        self.assertIn('read', lines[-1]['stageSeconds'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+from __future__ import division
+import os
+import unittest
+from support import TempDirTestCase
+from shared import BackupDataError, ManifestEntry, partDigest, zeroPartDigest, writeManifest
+from objectstore import (ObjectStore, emptyObjectName, indexPath, readIndex, writeIndex, isObjectStoreSnapshot,
+                         snapshotManifest)
+
+class IndexTest(TempDirTestCase):
+    def testRoundTrip(self):
+        digest = partDigest('a' * 4096)
+        manifest = {0: ManifestEntry(4096, False, digest), 1: ManifestEntry(4096, True, zeroPartDigest(4096))}
+        objectNames = {0: digest + '.zlib', 1: emptyObjectName}
+        
+        # The store path is the rest of the header line, so it can contain spaces
+        storePath = self.path('object store')
+        writeIndex(self.dir, storePath, manifest, objectNames)
+        self.assertEqual(readIndex(self.dir), (storePath, manifest, objectNames))
+        self.assertFalse(os.path.exists(indexPath(self.dir) + '.new'))
+        self.assertTrue(isObjectStoreSnapshot(self.dir))
+        self.assertEqual(snapshotManifest(self.dir), manifest)
+    
+    def testEmptyIndex(self):
+        writeIndex(self.dir, self.path('store'), {}, {})
+        self.assertEqual(readIndex(self.dir), (self.path('store'), {}, {}))
+    
+    def testInvalidHeader(self):
+        with open(indexPath(self.dir), 'w') as f:
+            f.write('multipart-backup-index 2 store\n')
+        
+        self.assertRaises(BackupDataError, readIndex, self.dir)
+    
+    def testSnapshotManifestOfFileSnapshot(self):
+        manifest = {0: ManifestEntry(10, False, 'abc')}
+        writeManifest(self.dir, manifest)
+        self.assertFalse(isObjectStoreSnapshot(self.dir))
+        self.assertEqual(snapshotManifest(self.dir), manifest)
+
+class ObjectStoreTest(TempDirTestCase):
+    def testWriteAndFindObject(self):
+        store = ObjectStore(self.path('store'))
+        store.create()
+        digest = partDigest('data')
+        self.assertIsNone(store.findObject(digest))
+        store.writeObject(digest, ['da', 'ta'])
+        self.assertEqual(store.findObject(digest), digest)
+        self.assertEqual(open(store.objectPath(digest), 'rb').read(), 'data')
+
+if __name__ == '__main__':
+    unittest.main()
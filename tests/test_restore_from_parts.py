@@ -0,0 +1,165 @@
+from __future__ import division
+import json
+import os
+import unittest
+from support import TempDirTestCase, loadScript, makeImage, writeImage, quiet
+
+restoreFromParts = loadScript('restore-from-parts')
+
+class RestoreTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.source = self.path('source.img')
+        
+        # Parts 6 and 7 are all zeros, and so is part 10, the last one
+        self.data = makeImage(self.source, 640*1024) + bytearray(64*1024)
+        writeImage(self.source, self.data)
+        self.snapshot = self.backup(self.source, self.path('backup'))
+        self.dest = self.path('dest.img')
+        self.zeroOffsets = [6*64*1024, 7*64*1024, 10*64*1024]
+        self.writeFully = restoreFromParts.writeFully
+        self.zeroRange = restoreFromParts.zeroRange
+        self.writes = []
+        self.zeroedRanges = []
+        
+        def writeFully(fd, data):
+            self.writes.append((os.lseek(fd, 0, os.SEEK_CUR), len(data)))
+            self.writeFully(fd, data)
+        
+        def zeroRange(fd, offset, length):
+            self.zeroedRanges.append((offset, length))
+            return self.zeroRange(fd, offset, length)
+        
+        restoreFromParts.writeFully = writeFully
+        restoreFromParts.zeroRange = zeroRange
+    
+    def tearDown(self):
+        restoreFromParts.writeFully = self.writeFully
+        restoreFromParts.zeroRange = self.zeroRange
+        TempDirTestCase.tearDown(self)
+    
+    def restore(self, snapshot=None, **kwargs):
+        """Restores the snapshot into self.dest, and returns the counts from the summary of the restore's metrics"""
+        with quiet():
+            restoreFromParts.restore(snapshot or self.snapshot, self.dest, 16*1024, 0, workerCount=4,
+                                     metricsPath=self.path('metrics'), **kwargs)
+        
+        with open(self.path('metrics')) as f:
+            summary = json.loads(f.readlines()[-1])
+        
+        os.remove(self.path('metrics'))
+        self.assertTrue(summary['succeeded'])
+        return summary['counts']
+    
+    def restored(self):
+        with open(self.dest, 'rb') as f:
+            return f.read()
+    
+    def wroteAt(self, offset):
+        return any(offset <= writeOffset < offset + 64*1024 for writeOffset, length in self.writes)
+    
+    def testWriteZeros(self):
+        counts = self.restore(zeroParts='write')
+        self.assertEqual(self.restored(), str(self.data))
+        self.assertEqual(counts['partsZero'], 3)
+        self.assertEqual(counts['bytesWritten'], len(self.data))
+        self.assertTrue(all(self.wroteAt(offset) for offset in self.zeroOffsets))
+        self.assertEqual(self.zeroedRanges, [])
+    
+    def testSkipZeros(self):
+        # The zero parts in the middle are left as holes, and the one at the end is covered by truncating the file
+        counts = self.restore(zeroParts='skip')
+        self.assertEqual(self.restored(), str(self.data))
+        self.assertEqual(counts['bytesWritten'], len(self.data) - 3*64*1024)
+        self.assertFalse(any(self.wroteAt(offset) for offset in self.zeroOffsets))
+    
+    def testDiscardZeros(self):
+        writeImage(self.dest, '\xff' * len(self.data))
+        self.restore(zeroParts='discard')
+        self.assertEqual(self.restored(), str(self.data))
+        self.assertEqual(sorted(self.zeroedRanges), [(offset, 64*1024) for offset in self.zeroOffsets])
+    
+    def testDiscardFallsBackToWriting(self):
+        restoreFromParts.zeroRange = lambda fd, offset, length: False
+        writeImage(self.dest, '\xff' * len(self.data))
+        self.restore(zeroParts='discard')
+        self.assertEqual(self.restored(), str(self.data))
+        self.assertTrue(all(self.wroteAt(offset) for offset in self.zeroOffsets))
+    
+    def testRestoreIntoLargerFile(self):
+        for zeroParts in ('write', 'discard'):
+            writeImage(self.dest, '\xff' * (len(self.data) + 100*1024))
+            self.restore(zeroParts=zeroParts)
+            self.assertEqual(self.restored(), str(self.data))
+        
+        # Skipping leaves what was there before in place of the zero parts, but the file is still cut to size
+        writeImage(self.dest, '\xff' * (len(self.data) + 100*1024))
+        self.restore(zeroParts='skip')
+        expected = bytearray(self.data)
+        
+        for offset in self.zeroOffsets:
+            expected[offset:offset+64*1024] = '\xff' * 64*1024
+        
+        self.assertEqual(self.restored(), str(expected))
+    
+    def testCompressedPartsAndDeltas(self):
+        self.backup(self.source, self.path('compressed'), codec='zlib', deltaDepth=2)
+        self.data[0:10] = 'x' * 10
+        writeImage(self.source, self.data)
+        snapshot = self.backup(self.source, self.path('compressed'), codec='zlib', deltaDepth=2)
+        self.assertIn('delta_00000000_001', os.listdir(snapshot))
+        
+        for zeroParts in ('write', 'skip', 'discard'):
+            if os.path.exists(self.dest):
+                os.remove(self.dest)
+            
+            self.restore(snapshot, zeroParts=zeroParts)
+            self.assertEqual(self.restored(), str(self.data))
+    
+    def modifiedCopy(self):
+        """Writes a copy of the image to self.dest with a block changed in parts 0 and 3 and in zero part 6, and
+        returns the offsets of the changed blocks"""
+        copy = bytearray(self.data)
+        offsets = [16*1024, 3*64*1024 + 32*1024, 6*64*1024 + 16*1024]
+        
+        for offset in offsets:
+            copy[offset+100:offset+200] = 'y' * 100
+        
+        writeImage(self.dest, copy)
+        return offsets
+    
+    def testDiffRewritesOnlyDifferingBlocks(self):
+        offsets = self.modifiedCopy()
+        counts = self.restore(zeroParts='write', diff=True)
+        self.assertEqual(self.restored(), str(self.data))
+        self.assertEqual(sorted(self.writes), [(offset, 16*1024) for offset in offsets])
+        self.assertEqual(counts['bytesWritten'], 3*16*1024)
+        self.assertEqual(counts['partsSkipped'], 8)
+        
+        # Parts whose region matches the digest in the manifest aren't read, so only parts 0 and 3 are
+        self.assertEqual(counts['bytesRead'], 2*64*1024)
+    
+    def testDiffDiscardsDifferingZeroBlocks(self):
+        offsets = self.modifiedCopy()
+        self.restore(zeroParts='discard', diff=True)
+        self.assertEqual(self.restored(), str(self.data))
+        self.assertEqual(self.zeroedRanges, [(offsets[2], 16*1024)])
+        self.assertEqual(sorted(self.writes), [(offset, 16*1024) for offset in offsets[:2]])
+    
+    def testDiffWithoutManifest(self):
+        # Every part is compared block by block instead
+        offsets = self.modifiedCopy()
+        os.remove(os.path.join(self.snapshot, 'manifest'))
+        counts = self.restore(zeroParts='write', diff=True)
+        self.assertEqual(self.restored(), str(self.data))
+        self.assertEqual(sorted(self.writes), [(offset, 16*1024) for offset in offsets])
+        self.assertEqual(counts['bytesRead'], len(self.data) - 3*64*1024)
+    
+    def testDiffOverShorterFile(self):
+        writeImage(self.dest, self.data[:100*1024])
+        counts = self.restore(zeroParts='write', diff=True)
+        self.assertEqual(self.restored(), str(self.data))
+        self.assertEqual(counts['bytesWritten'], len(self.data) - 96*1024)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,236 @@
+from __future__ import division
+import errno
+import os
+import random
+import socket
+import struct
+import threading
+import unittest
+from support import TempDirTestCase, loadScript, makeImage
+from multipartimage import MultipartImage
+
+serveNBD = loadScript('serve-nbd')
+
+class NBDClient(object):
+    """Just enough of an NBD client to talk to serve-nbd.py"""
+    def __init__(self, socketPath):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socketPath)
+        magic, option, self.handshakeFlags = struct.unpack('>QQH', self.receive(18))
+        assert magic == serveNBD.NBD_MAGIC and option == serveNBD.NBD_IHAVEOPT
+        self.socket.sendall(struct.pack('>I', serveNBD.NBD_FLAG_C_NO_ZEROES))
+    
+    def receive(self, length):
+        chunks = []
+        
+        while length > 0:
+            chunk = self.socket.recv(length)
+            
+            if len(chunk) == 0:
+                raise EOFError()
+            
+            chunks.append(chunk)
+            length -= len(chunk)
+        
+        return ''.join(chunks)
+    
+    def sendOption(self, option, data=''):
+        self.socket.sendall(struct.pack('>QII', serveNBD.NBD_IHAVEOPT, option, len(data)) + data)
+    
+    def receiveOptionReply(self):
+        """Returns the option and type of the next option reply, and its data"""
+        magic, option, replyType, length = struct.unpack('>QIII', self.receive(20))
+        assert magic == serveNBD.NBD_OPTION_REPLY_MAGIC
+        return option, replyType, self.receive(length)
+    
+    def go(self):
+        """Picks the export with NBD_OPT_GO and returns its size and transmission flags"""
+        self.sendOption(serveNBD.NBD_OPT_GO, struct.pack('>IH', 0, 0))
+        option, replyType, data = self.receiveOptionReply()
+        assert replyType == serveNBD.NBD_REP_INFO
+        infoType, size, flags = struct.unpack('>HQH', data)
+        assert self.receiveOptionReply()[1] == serveNBD.NBD_REP_ACK
+        return size, flags
+    
+    def sendRequest(self, command, handle, offset, length, data=''):
+        self.socket.sendall(struct.pack('>IHHQQI', serveNBD.NBD_REQUEST_MAGIC, 0, command, handle, offset, length) +
+                            data)
+    
+    def receiveReply(self, lengthForHandle=None):
+        """Returns the error and handle of the next reply, and its data if it's a successful read, whose length is
+        given by lengthForHandle"""
+        magic, error, handle = struct.unpack('>IIQ', self.receive(16))
+        assert magic == serveNBD.NBD_SIMPLE_REPLY_MAGIC
+        data = self.receive(lengthForHandle(handle)) if error == 0 and lengthForHandle is not None else ''
+        return error, handle, data
+    
+    def read(self, offset, length):
+        self.sendRequest(serveNBD.NBD_CMD_READ, 1, offset, length)
+        error, handle, data = self.receiveReply(lambda handle: length)
+        return error, data
+    
+    def write(self, offset, data):
+        self.sendRequest(serveNBD.NBD_CMD_WRITE, 2, offset, len(data), data)
+        return self.receiveReply()[0]
+    
+    def close(self):
+        self.sendRequest(serveNBD.NBD_CMD_DISC, 0, 0, 0)
+        self.socket.close()
+
+class ServeNBDTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.data = makeImage(self.path('source.img'), 1000000)
+        self.snapshot = self.backup(self.path('source.img'), self.path('backup'), codec='zlib')
+        self.server = None
+    
+    def tearDown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.image.close()
+            
+            if self.overlay is not None:
+                self.overlay.close()
+        
+        TempDirTestCase.tearDown(self)
+    
+    def serve(self, withOverlay=False):
+        """Starts serving the snapshot, and returns a client that's connected to it"""
+        self.image = MultipartImage(self.snapshot, 16*1024, 8)
+        self.overlay = serveNBD.Overlay(self.path('overlay'), self.image) if withOverlay else None
+        self.server = serveNBD.NBDUnixServer(self.path('socket'), serveNBD.NBDRequestHandler)
+        self.server.setupExport(self.image, 'snapshot', self.overlay, 4, 64*1024)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return NBDClient(self.path('socket'))
+    
+    def testHandshake(self):
+        client = self.serve()
+        self.assertTrue(client.handshakeFlags & serveNBD.NBD_FLAG_FIXED_NEWSTYLE)
+        
+        client.sendOption(serveNBD.NBD_OPT_LIST)
+        option, replyType, data = client.receiveOptionReply()
+        self.assertEqual(replyType, serveNBD.NBD_REP_SERVER)
+        self.assertEqual(data[4:], 'snapshot')
+        self.assertEqual(client.receiveOptionReply()[1], serveNBD.NBD_REP_ACK)
+        
+        client.sendOption(99)
+        self.assertEqual(client.receiveOptionReply()[1], serveNBD.NBD_REP_ERR_UNSUP)
+        
+        size, flags = client.go()
+        self.assertEqual(size, len(self.data))
+        self.assertTrue(flags & serveNBD.NBD_FLAG_READ_ONLY)
+        self.assertEqual(client.read(0, 100), (0, str(self.data[:100])))
+        client.close()
+    
+    def testExportName(self):
+        client = self.serve()
+        client.sendOption(serveNBD.NBD_OPT_EXPORT_NAME, 'snapshot')
+        size, flags = struct.unpack('>QH', client.receive(10))
+        self.assertEqual(size, len(self.data))
+        self.assertEqual(client.read(len(self.data) - 10, 10), (0, str(self.data[-10:])))
+        client.close()
+    
+    def testSequentialReads(self):
+        client = self.serve()
+        client.go()
+        
+        for offset in xrange(0, len(self.data), 40000):
+            length = min(40000, len(self.data) - offset)
+            self.assertEqual(client.read(offset, length), (0, str(self.data[offset:offset+length])))
+        
+        client.close()
+    
+    def testPipelinedReads(self):
+        client = self.serve()
+        client.go()
+        r = random.Random(1)
+        requests = {}
+        
+        # Every request is sent before any reply is read, so the server has many of them in progress at once
+        for handle in xrange(200):
+            offset = r.randrange(len(self.data))
+            length = r.randrange(1, min(200000, len(self.data) - offset) + 1)
+            requests[handle] = (offset, length)
+            client.sendRequest(serveNBD.NBD_CMD_READ, handle, offset, length)
+        
+        for i in xrange(len(requests)):
+            error, handle, data = client.receiveReply(lambda handle: requests[handle][1])
+            offset, length = requests.pop(handle)
+            self.assertEqual(error, 0)
+            self.assertEqual(data, str(self.data[offset:offset+length]))
+        
+        client.close()
+    
+    def testOutOfBounds(self):
+        client = self.serve()
+        client.go()
+        self.assertEqual(client.read(len(self.data) - 10, 11)[0], errno.EINVAL)
+        self.assertEqual(client.read(len(self.data) + 10, 1)[0], errno.EINVAL)
+        
+        # The connection is still usable after an error
+        self.assertEqual(client.read(0, 10), (0, str(self.data[:10])))
+        client.close()
+    
+    def testWritesAreRefusedWhenReadOnly(self):
+        client = self.serve()
+        client.go()
+        self.assertEqual(client.write(0, 'abc'), errno.EPERM)
+        self.assertEqual(client.read(0, 3), (0, str(self.data[:3])))
+        client.close()
+    
+    def testWritesGoToOverlay(self):
+        client = self.serve(withOverlay=True)
+        size, flags = client.go()
+        self.assertFalse(flags & serveNBD.NBD_FLAG_READ_ONLY)
+        expected = bytearray(self.data)
+        
+        for offset, data in [(5000, 'abc'), (16*1024 - 1, 'XY'), (len(self.data) - 3, 'END'), (30000, 'Q' * 40000)]:
+            self.assertEqual(client.write(offset, data), 0)
+            expected[offset:offset+len(data)] = data
+        
+        self.assertEqual(client.write(len(self.data) - 1, 'ab'), errno.ENOSPC)
+        client.sendRequest(serveNBD.NBD_CMD_FLUSH, 3, 0, 0)
+        self.assertEqual(client.receiveReply()[0], 0)
+        self.assertEqual(client.read(0, len(self.data)), (0, str(expected)))
+        client.close()
+        
+        # The snapshot itself is left alone
+        self.assertEqual(MultipartImage(self.snapshot, 16*1024).readAt(0, len(self.data)), str(self.data))
+    
+    def testOverlayReadsTheImageWithoutItsLock(self):
+        image = MultipartImage(self.snapshot, 16*1024)
+        overlay = serveNBD.Overlay(self.path('overlay'), image)
+        readAt = image.readAt
+        
+        def checkedReadAt(offset, length):
+            self.assertFalse(overlay.lock.locked())
+            return readAt(offset, length)
+        
+        image.readAt = checkedReadAt
+        overlay.write(4096, 'Q' * 4096)
+        self.assertEqual(overlay.read(0, 3*4096), str(self.data[:4096]) + 'Q' * 4096 + str(self.data[2*4096:3*4096]))
+        overlay.close()
+        image.close()
+    
+    def testUnreadablePartGivesError(self):
+        # A part compressed with a codec that isn't available can't be read, but the client still gets a reply
+        os.rename(os.path.join(self.snapshot, 'part_00000004.zlib'), os.path.join(self.snapshot, 'part_00000004.xz9'))
+        client = self.serve()
+        client.go()
+        stderr = serveNBD.sys.stderr
+        serveNBD.sys.stderr = open(os.devnull, 'w')
+        
+        try:
+            self.assertEqual(client.read(4*64*1024, 10)[0], errno.EIO)
+        finally:
+            serveNBD.sys.stderr.close()
+            serveNBD.sys.stderr = stderr
+        
+        self.assertEqual(client.read(0, 10), (0, str(self.data[:10])))
+        client.close()
+
+if __name__ == '__main__':
+    unittest.main()
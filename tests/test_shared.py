@@ -0,0 +1,95 @@
+from __future__ import division
+import os
+import unittest
+from support import TempDirTestCase
+from shared import (BackupDataError, ManifestEntry, readManifest, writeManifest, manifestPath, writeFileAtomically,
+                    partNamesByIndex, partFilesSize, zeroPartDigest, partDigest)
+
+class ManifestTest(TempDirTestCase):
+    def testRoundTrip(self):
+        manifest = {0: ManifestEntry(4096, False, partDigest('a' * 4096)),
+                    1: ManifestEntry(4096, True, zeroPartDigest(4096)),
+                    2: ManifestEntry(100, False, partDigest('b' * 100))}
+        writeManifest(self.dir, manifest)
+        self.assertEqual(readManifest(self.dir), manifest)
+        self.assertFalse(os.path.exists(manifestPath(self.dir) + '.new'))
+    
+    def testMissingManifestIsEmpty(self):
+        self.assertEqual(readManifest(self.dir), {})
+    
+    def testInvalidLinesAreSkipped(self):
+        with open(manifestPath(self.dir), 'w') as f:
+            f.write('part_00000000 10 0 abc\nnot a manifest line\npart_00000001 10 1\n')
+        
+        self.assertEqual(readManifest(self.dir), {0: ManifestEntry(10, False, 'abc')})
+
+class WriteFileAtomicallyTest(TempDirTestCase):
+    def testReplacesFile(self):
+        with open(self.path('file'), 'w') as f:
+            f.write('old')
+        
+        with writeFileAtomically(self.path('file')) as f:
+            f.write('new')
+            
+            # Until it's finished being written, the old file is still there
+            self.assertEqual(open(self.path('file')).read(), 'old')
+        
+        self.assertEqual(open(self.path('file')).read(), 'new')
+        self.assertEqual(os.listdir(self.dir), ['file'])
+    
+    def testInterruptionLeavesOldFile(self):
+        with open(self.path('file'), 'w') as f:
+            f.write('old')
+        
+        with self.assertRaises(KeyboardInterrupt):
+            with writeFileAtomically(self.path('file')) as f:
+                f.write('new')
+                raise KeyboardInterrupt()
+        
+        self.assertEqual(open(self.path('file')).read(), 'old')
+    
+    def testDataIsSyncedBeforeRename(self):
+        fsync = os.fsync
+        rename = os.rename
+        calls = []
+        
+        def recordingFsync(fd):
+            calls.append(('fsync', os.fstat(fd).st_size))
+            fsync(fd)
+        
+        def recordingRename(source, dest):
+            calls.append(('rename', os.path.basename(dest)))
+            rename(source, dest)
+        
+        os.fsync = recordingFsync
+        os.rename = recordingRename
+        
+        try:
+            with writeFileAtomically(self.path('file')) as f:
+                f.write('new')
+        finally:
+            os.fsync = fsync
+            os.rename = rename
+        
+        self.assertEqual(calls, [('fsync', 3), ('rename', 'file')])
+
+class PartFilesTest(TempDirTestCase):
+    def write(self, name, data):
+        with open(self.path(name), 'wb') as f:
+            f.write(data)
+    
+    def testDuplicatePartsAreRejected(self):
+        self.write('part_00000000', 'a')
+        self.write('part_00000001', 'b')
+        self.write('part_00000001.zlib', 'c')
+        self.assertRaises(BackupDataError, partNamesByIndex, self.dir)
+    
+    def testPartFilesSizeCountsDeltas(self):
+        self.write('part_00000000', 'a' * 100)
+        self.write('delta_00000000_001', 'b' * 10)
+        self.write('delta_00000000_002', 'c' * 5)
+        self.write('delta_00000001_001', 'd' * 1000)
+        self.assertEqual(partFilesSize(self.path('part_00000000')), 115)
+
+if __name__ == '__main__':
+    unittest.main()
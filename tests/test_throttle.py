@@ -0,0 +1,167 @@
+from __future__ import division
+import os
+import signal
+import unittest
+from support import TempDirTestCase, FakeClock, quiet
+import throttle
+from throttle import TokenBucket, Throttle
+from metrics import Metrics
+
+class ClockTestCase(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.clock = FakeClock()
+        self.time = throttle.time
+        throttle.time = self.clock
+    
+    def tearDown(self):
+        throttle.time = self.time
+        TempDirTestCase.tearDown(self)
+
+class TokenBucketTest(ClockTestCase):
+    def testUnlimited(self):
+        self.assertEqual(TokenBucket().consume(10**12), 0)
+    
+    def testRate(self):
+        bucket = TokenBucket(1000)
+        self.assertAlmostEqual(bucket.consume(500), 0.5)
+        self.assertAlmostEqual(bucket.consume(250), 0.25)
+        
+        # After a pause at most a second's worth can be used at once, and more than that goes into debt
+        self.clock.now += 10
+        self.assertEqual(bucket.consume(1000), 0)
+        self.assertAlmostEqual(bucket.consume(3000), 3)
+        self.assertAlmostEqual(self.clock.now, 1013.75)
+    
+    def testDebtIsWaitedOutByNextCaller(self):
+        bucket = TokenBucket(1000)
+        self.clock.now += 1
+        self.assertEqual(bucket.consume(1000), 0)
+        self.assertAlmostEqual(bucket.consume(1), 0.001)
+    
+    def testRateChangeTakesEffectWhileWaiting(self):
+        bucket = TokenBucket(100)
+        
+        def onSleep(seconds):
+            self.assertTrue(seconds <= 0.25)
+            
+            if self.clock.now >= 1001:
+                bucket.setRate(None)
+        
+        self.clock.onSleep = onSleep
+        self.assertAlmostEqual(bucket.consume(1000), 1)
+
+class ControlFileTest(ClockTestCase):
+    def setUp(self):
+        ClockTestCase.setUp(self)
+        self.controlPath = self.path('throttle')
+        self.writeControlFile('read 1M\nwrite-iops 50  # comment\n', 100)
+    
+    def writeControlFile(self, text, modificationTime):
+        with open(self.controlPath, 'w') as f:
+            f.write(text)
+        
+        os.utime(self.controlPath, (modificationTime, modificationTime))
+    
+    def testLimitsFromControlFile(self):
+        limits = Throttle(readRate=10, writeRate=20, controlPath=self.controlPath)
+        self.assertEqual((limits.readBytes.rate, limits.readOps.rate, limits.writeBytes.rate, limits.writeOps.rate),
+                         (1024*1024, None, 20, 50))
+    
+    def testReloadWhenChanged(self):
+        limits = Throttle(writeRate=20, controlPath=self.controlPath, metrics=Metrics('backup', 0))
+        limits.read(1)
+        self.writeControlFile('read 2M\n', 200)
+        
+        # The control file is looked at no more than once a second
+        with quiet():
+            limits.read(1)
+            self.assertEqual(limits.readBytes.rate, 1024*1024)
+            self.clock.now += 1
+            limits.read(1)
+        
+        self.assertEqual((limits.readBytes.rate, limits.writeBytes.rate, limits.writeOps.rate), (2*1024*1024, 20, None))
+        self.assertEqual(limits.metrics.counts['throttleReloads'], 1)
+    
+    def testReloadOnSIGHUP(self):
+        limits = Throttle(controlPath=self.controlPath)
+        limits.installSignalHandler()
+        
+        try:
+            # The file is changed without its modification time changing, so only the signal makes it reloaded
+            self.writeControlFile('read none\n', 100)
+            limits.read(1)
+            self.assertEqual(limits.readBytes.rate, 1024*1024)
+            os.kill(os.getpid(), signal.SIGHUP)
+            
+            with quiet():
+                limits.read(1)
+        finally:
+            limits.removeSignalHandler()
+        
+        self.assertEqual(limits.readBytes.rate, None)
+        self.assertNotEqual(signal.getsignal(signal.SIGHUP), limits._handleSignal)
+    
+    def testMalformedControlFileKeepsLimits(self):
+        limits = Throttle(controlPath=self.controlPath)
+        self.writeControlFile('read fast\n', 200)
+        self.clock.now += 1
+        stderr = throttle.sys.stderr
+        throttle.sys.stderr = open(os.devnull, 'w')
+        
+        try:
+            limits.read(1)
+        finally:
+            throttle.sys.stderr.close()
+            throttle.sys.stderr = stderr
+        
+        self.assertEqual(limits.readBytes.rate, 1024*1024)
+        
+        with self.assertRaises(ValueError):
+            Throttle(controlPath=self.controlPath)
+
+class AdaptiveTest(ClockTestCase):
+    def read(self, limits, latency):
+        self.clock.now += 1.1
+        limits.read(1024*1024, latency=latency)
+    
+    def testBacksOffAndRecovers(self):
+        limits = Throttle(adaptive=True)
+        
+        for i in xrange(8):
+            self.read(limits, 0.01)
+        
+        self.assertEqual(limits.readBytes.rate, None)
+        
+        # Reads taking ten times as long halve the rate the source has been managing
+        self.read(limits, 0.1)
+        self.assertAlmostEqual(limits.readBytes.rate, limits.recentThroughput / 2)
+        self.read(limits, 0.1)
+        self.assertAlmostEqual(limits.readBytes.rate, limits.recentThroughput / 4, delta=limits.recentThroughput / 10)
+        
+        # Once the average latency has come back down the rate goes back up a step at a time, until it's no longer
+        # limited at all
+        rates = []
+        
+        while limits.readBytes.rate is not None and len(rates) < 50:
+            rates.append(limits.readBytes.rate)
+            self.read(limits, 0.01)
+        
+        self.assertEqual(limits.readBytes.rate, None)
+        lowest = rates.index(min(rates))
+        self.assertEqual(rates[lowest:], sorted(rates[lowest:]))
+        self.assertGreater(rates[-1], rates[lowest] * 4)
+    
+    def testNeverBelowMinimum(self):
+        limits = Throttle(adaptive=True)
+        
+        for i in xrange(8):
+            self.read(limits, 0.5)
+        
+        for i in xrange(20):
+            self.read(limits, 50)
+        
+        self.assertEqual(limits.readBytes.rate, throttle.minimumAdaptiveRate)
+
+if __name__ == '__main__':
+    unittest.main()
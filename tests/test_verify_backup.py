@@ -0,0 +1,110 @@
+from __future__ import division
+import os
+import time
+import unittest
+from support import TempDirTestCase, loadScript, makeImage, writeImage, quiet
+from throttle import Throttle
+
+verifyBackup = loadScript('verify-backup')
+
+class VerifyTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.source = self.path('source.img')
+        self.data = makeImage(self.source, 640*1024)
+        self.first = self.backup(self.source, self.path('backup'))
+        self.data[5*64*1024] = 'x'
+        writeImage(self.source, self.data)
+        self.second = self.backup(self.source, self.path('backup'))
+        self.readPaths = []
+        self.resumePath = None
+        self.manifestEntryForPartFile = verifyBackup.manifestEntryForPartFile
+        
+        def manifestEntryForPartFile(partPath, *args):
+            # Reads after the first wait for it to be recorded, which is when a verification with no time to spare
+            # decides to stop, so that it doesn't get through every part first
+            if self.resumePath is not None and len(self.readPaths) > 0:
+                for i in xrange(500):
+                    if 'file ' in open(self.resumePath).read():
+                        break
+                    
+                    time.sleep(0.01)
+            
+            self.readPaths.append(partPath)
+            return self.manifestEntryForPartFile(partPath, *args)
+        
+        verifyBackup.manifestEntryForPartFile = manifestEntryForPartFile
+    
+    def tearDown(self):
+        verifyBackup.manifestEntryForPartFile = self.manifestEntryForPartFile
+        TempDirTestCase.tearDown(self)
+    
+    def verify(self, resumePath=None, timeLimit=None):
+        """Verifies the backup, and returns the result and the problems that were reported"""
+        self.readPaths = []
+        self.resumePath = resumePath if timeLimit == 0 else None
+        
+        with quiet() as output:
+            result = verifyBackup.verify([self.path('backup')], None, 16*1024, 2, Throttle(), resumePath, timeLimit)
+        
+        return result, [line for line in output.getvalue().splitlines() if line.startswith('snapshot-')]
+    
+    def corrupt(self, snapshot, name, modificationTime=None):
+        """Changes a byte of a part in place, so every snapshot it's linked into sees the change"""
+        path = os.path.join(snapshot, name)
+        
+        with open(path, 'r+b') as f:
+            f.seek(100)
+            byte = f.read(1)
+            f.seek(100)
+            f.write(chr(ord(byte) ^ 1))
+        
+        if modificationTime is not None:
+            os.utime(path, (modificationTime, modificationTime))
+    
+    def inodesRead(self):
+        return [os.stat(path).st_ino for path in self.readPaths]
+    
+    def testSharedPartsAreReadOnce(self):
+        self.assertEqual(os.stat(os.path.join(self.first, 'part_00000000')).st_ino,
+                         os.stat(os.path.join(self.second, 'part_00000000')).st_ino)
+        self.assertEqual(self.verify(), (0, []))
+        
+        # Parts 6 and 7 are empty, and every other part but the changed one is shared, leaving 9 files to read
+        self.assertEqual(len(self.readPaths), 9)
+        self.assertEqual(len(set(self.inodesRead())), 9)
+    
+    def testCorruptSharedPartIsReportedInBothSnapshots(self):
+        self.corrupt(self.first, 'part_00000002')
+        result, problems = self.verify()
+        self.assertEqual(result, 1)
+        self.assertEqual(problems, ['%s: part_00000002 does not match its digest in the manifest' %
+                                    os.path.basename(snapshot) for snapshot in (self.first, self.second)])
+    
+    def testCorruptChangedPartIsReportedInItsSnapshot(self):
+        self.corrupt(self.second, 'part_00000005')
+        self.assertEqual(self.verify(), (1, ['%s: part_00000005 does not match its digest in the manifest' %
+                                             os.path.basename(self.second)]))
+    
+    def testResume(self):
+        resumePath = self.path('resume')
+        
+        # With no time at all, verification stops once the first part is read
+        self.assertEqual(self.verify(resumePath, 0)[0], 2)
+        readFirst = list(self.readPaths)
+        self.assertTrue(0 < len(readFirst) < 9)
+        self.assertTrue(os.path.exists(resumePath))
+        
+        # A part that was changed after it was read is read again
+        changed = readFirst[0]
+        self.corrupt(os.path.dirname(changed), os.path.basename(changed), 1000000000)
+        result, problems = self.verify(resumePath)
+        self.assertEqual(result, 1)
+        self.assertEqual(len(problems), 2 if os.path.basename(changed) != 'part_00000005' else 1)
+        self.assertEqual(sorted(self.inodesRead()),
+                         sorted(set(os.stat(path).st_ino for path in self.readPaths)))
+        self.assertEqual(len(self.readPaths), 9 - len(readFirst) + 1)
+        self.assertFalse(os.path.exists(resumePath))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,348 @@
+from __future__ import division
+import os
+import signal
+import sys
+import threading
+import time
+from shared import humanReadableSizeToBytes, humanReadableSize, humanReadableDuration
+
+# When backing off, the adaptive read limit never goes below this many bytes per second
+minimumAdaptiveRate = 1024*1024
+
+# Weights given to each new read latency sample by the fast and slow moving averages adaptive mode compares
+_fastLatencyWeight = 0.3
+_slowLatencyWeight = 0.02
+
+# Number of latency samples taken before adaptive mode starts adjusting anything, and the least time between changes
+_adaptiveWarmupSamples = 8
+_adaptiveInterval = 1.0
+
+# Keys that can be set in a throttle control file, and the limit each one sets
+controlFileKeys = {'read': 'readRate', 'write': 'writeRate', 'read-iops': 'readIOPS', 'write-iops': 'writeIOPS'}
+
+def parseLimit(value, isOperations):
+    """Returns the limit given as a string, which is a number of operations per second if isOperations is set and
+    otherwise a size in the same format as dd, or None for a value of 'none' or 0, which mean unlimited"""
+    if value.strip().lower() == 'none':
+        return None
+    
+    limit = int(value) if isOperations else humanReadableSizeToBytes(value)
+    
+    if limit < 0:
+        raise ValueError('Limit must not be negative: %s' % value)
+    
+    return limit if limit > 0 else None
+
+class TokenBucket(object):
+    """Limits something to rate units per second. Up to a second's worth of units can be used at once after a pause,
+    and an amount larger than that is allowed through by going into debt, which the next caller has to wait out. A
+    rate of None is unlimited. consume can be called from any thread."""
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.tokens = 0
+        self.lastTime = time.time()
+        self.lock = threading.Lock()
+    
+    def setRate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            
+            if rate is None:
+                self.tokens = 0
+    
+    def _refill(self):
+        now = time.time()
+        
+        if self.rate is not None:
+            self.tokens = min(self.rate, self.tokens + (now - self.lastTime) * self.rate)
+        
+        self.lastTime = now
+    
+    def consume(self, amount):
+        """Takes amount units, waiting until the rate allows it. Returns the number of seconds spent waiting."""
+        if self.rate is None:
+            return 0
+        
+        startTime = time.time()
+        
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+        
+        # The wait is done in short steps so that a change to the rate takes effect right away
+        while True:
+            with self.lock:
+                self._refill()
+                
+                if self.rate is None or self.tokens >= 0:
+                    break
+                
+                wait = -self.tokens / self.rate
+            
+            time.sleep(min(wait, 0.25))
+        
+        return time.time() - startTime
+
+class Throttle(object):
+    """Limits the bytes and operations per second of reading the source and writing the destination. A limit of
+    None is unlimited."""
+    def __init__(self, readRate=None, writeRate=None, readIOPS=None, writeIOPS=None, metrics=None, controlPath=None,
+                 adaptive=False, adaptiveLatency=2.0):
+        self.limits = {'readRate': readRate, 'writeRate': writeRate, 'readIOPS': readIOPS, 'writeIOPS': writeIOPS}
+        self.metrics = metrics
+        self.controlPath = controlPath
+        self.controlFileTime = None
+        self.lastControlCheck = 0
+        self.reloadRequested = False
+        self.previousHandler = None
+        self.adaptive = adaptive
+        self.adaptiveLatency = adaptiveLatency
+        self.adaptiveRate = None
+        self.fastLatency = None
+        self.slowLatency = None
+        self.latencySamples = 0
+        self.lastAdjustment = 0
+        self.recentThroughput = None
+        self.lock = threading.Lock()
+        self.readBytes = TokenBucket()
+        self.readOps = TokenBucket()
+        self.writeBytes = TokenBucket()
+        self.writeOps = TokenBucket()
+        
+        if controlPath is not None and os.path.exists(controlPath):
+            self.controlFileTime = os.stat(controlPath).st_mtime
+            self.activeLimits = self._limitsWithControlFile()
+        else:
+            self.activeLimits = dict(self.limits)
+        
+        self._applyLimits()
+    
+    def isLimited(self):
+        """Returns true if reading or writing may ever be held up"""
+        return self.adaptive or self.controlPath is not None or any(v is not None for v in self.limits.values())
+    
+    def _limitsWithControlFile(self):
+        """Returns the limits given to the throttle, updated with the ones in the control file. Raises ValueError if
+        the control file is malformed."""
+        limits = dict(self.limits)
+        
+        with open(self.controlPath) as f:
+            for lineNumber, line in enumerate(f, 1):
+                line = line.split('#')[0].strip()
+                
+                if len(line) == 0:
+                    continue
+                
+                fields = line.split()
+                
+                if len(fields) != 2 or fields[0] not in controlFileKeys:
+                    raise ValueError('Line %s of throttle control file %s is invalid: %s' %
+                                     (lineNumber, self.controlPath, line))
+                
+                key = controlFileKeys[fields[0]]
+                limits[key] = parseLimit(fields[1], key.endswith('IOPS'))
+        
+        return limits
+    
+    def _applyLimits(self):
+        readRate = self.activeLimits['readRate']
+        
+        if self.adaptiveRate is not None:
+            readRate = self.adaptiveRate if readRate is None else min(readRate, self.adaptiveRate)
+        
+        self.readBytes.setRate(readRate)
+        self.readOps.setRate(self.activeLimits['readIOPS'])
+        self.writeBytes.setRate(self.activeLimits['writeRate'])
+        self.writeOps.setRate(self.activeLimits['writeIOPS'])
+    
+    def installSignalHandler(self):
+        """Makes SIGHUP reload the control file. Has to be called from the main thread."""
+        self.previousHandler = signal.signal(signal.SIGHUP, self._handleSignal)
+    
+    def removeSignalHandler(self):
+        if self.previousHandler is not None:
+            signal.signal(signal.SIGHUP, self.previousHandler)
+            self.previousHandler = None
+    
+    def _handleSignal(self, signum, frame):
+        # Signal handlers run on the main thread, which may be waiting on the pipeline, so the reload is left to
+        # whichever thread reads or writes next
+        self.reloadRequested = True
+    
+    def _checkControlFile(self):
+        """Reloads the control file if it changed or SIGHUP was received. A control file that's been removed or has
+        become malformed leaves the limits as they are."""
+        if self.controlPath is None:
+            return
+        
+        now = time.time()
+        
+        if not self.reloadRequested and now - self.lastControlCheck < 1:
+            return
+        
+        with self.lock:
+            self.lastControlCheck = now
+            
+            try:
+                modificationTime = os.stat(self.controlPath).st_mtime
+            except OSError:
+                return
+            
+            if not self.reloadRequested and modificationTime == self.controlFileTime:
+                return
+            
+            self.reloadRequested = False
+            self.controlFileTime = modificationTime
+            
+            try:
+                limits = self._limitsWithControlFile()
+            except (IOError, ValueError) as e:
+                sys.stderr.write('\nWarning: keeping the current limits, could not reload %s: %s\n' %
+                                 (self.controlPath, e))
+                return
+            
+            if limits != self.activeLimits:
+                self.activeLimits = limits
+                self._applyLimits()
+                self._count('throttleReloads')
+                sys.stdout.write('\nReloaded %s, now limiting %s\n' % (self.controlPath, self.describe()))
+    
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.count(name)
+    
+    def _wait(self, stage, buckets, byteCount, index):
+        self._checkControlFile()
+        bytesBucket, opsBucket = buckets
+        startTime = time.time()
+        waited = opsBucket.consume(1) + bytesBucket.consume(byteCount)
+        
+        # Recorded after the fact so that reads and writes that weren't held up don't show up as a stage at all
+        if waited > 0 and self.metrics is not None:
+            self.metrics.addTime(stage, waited, index)
+        
+        return time.time() - startTime
+    
+    def read(self, byteCount, index=None, latency=None):
+        """Waits until reading byteCount bytes of the source in one operation is within the limits, for the part at
+        index if given. latency is how long the read took, which adaptive mode goes by."""
+        if latency is not None and self.adaptive and byteCount > 0:
+            self._recordLatency(latency, byteCount)
+        
+        return self._wait('readThrottle', (self.readBytes, self.readOps), byteCount, index)
+    
+    def write(self, byteCount, index=None):
+        """Waits until writing byteCount bytes to the destination in one operation is within the limits"""
+        return self._wait('writeThrottle', (self.writeBytes, self.writeOps), byteCount, index)
+    
+    def writeChunks(self, chunks, blockSize, index=None):
+        """Yields chunks split into pieces of at most blockSize, waiting before each one until writing it is within the
+        limits, so that writing a part doesn't happen in a single burst"""
+        for chunk in chunks:
+            view = memoryview(chunk)
+            
+            for offset in xrange(0, len(view), blockSize):
+                piece = view[offset:offset+blockSize]
+                self.write(len(piece), index)
+                yield piece
+    
+    def _recordLatency(self, latency, byteCount):
+        """Backs off the read rate when reads are taking much longer than they have been, and raises it again once they
+        recover. Latency is compared per byte so that a short final read doesn't skew it."""
+        sample = latency / byteCount
+        
+        with self.lock:
+            self.latencySamples += 1
+            
+            if self.fastLatency is None:
+                self.fastLatency = self.slowLatency = sample
+            else:
+                self.fastLatency += (sample - self.fastLatency) * _fastLatencyWeight
+                self.slowLatency += (sample - self.slowLatency) * _slowLatencyWeight
+            
+            if latency > 0:
+                throughput = byteCount / latency
+                self.recentThroughput = (throughput if self.recentThroughput is None else
+                                         self.recentThroughput + (throughput - self.recentThroughput) * 0.1)
+            
+            now = time.time()
+            
+            if self.latencySamples < _adaptiveWarmupSamples or now - self.lastAdjustment < _adaptiveInterval:
+                return
+            
+            if self.fastLatency > self.slowLatency * self.adaptiveLatency:
+                currentRate = self.readBytes.rate
+                
+                if currentRate is None:
+                    currentRate = self.recentThroughput if self.recentThroughput is not None else minimumAdaptiveRate
+                
+                self.adaptiveRate = max(minimumAdaptiveRate, currentRate / 2)
+                self._count('throttleBackoffs')
+            elif self.adaptiveRate is not None and self.fastLatency < self.slowLatency * (1 + self.adaptiveLatency) / 2:
+                self.adaptiveRate *= 1.25
+                
+                # Once well past what the source has been managing, adaptive mode stops limiting reads altogether
+                if self.recentThroughput is not None and self.adaptiveRate > self.recentThroughput * 2:
+                    self.adaptiveRate = None
+            else:
+                return
+            
+            self.lastAdjustment = now
+            self._applyLimits()
+    
+    def describe(self):
+        """Returns a summary of the current limits for status messages"""
+        def describeBytes(rate):
+            return 'unlimited' if rate is None else '%s/sec' % humanReadableSize(rate)
+        
+        def describeOps(rate):
+            return '%s IOPS' % ('unlimited' if rate is None else rate)
+        
+        return 'read: %s, %s; write: %s, %s' % (describeBytes(self.readBytes.rate), describeOps(self.readOps.rate),
+                                                describeBytes(self.writeBytes.rate), describeOps(self.writeOps.rate))
+
+def addThrottleArguments(parser, readDescription, writeDescription=None):
+    """Adds the options for limiting the rate of reading and writing, described as readDescription and
+    writeDescription, to an ArgumentParser. The options for writing are left out if writeDescription isn't given."""
+    parser.add_argument('--read-limit', help='Limit %s to this many bytes per second. Uses same format for sizes as '
+                        'dd.' % readDescription, default=None)
+    
+    if writeDescription is not None:
+        parser.add_argument('--write-limit', help='Limit %s to this many bytes per second. Uses same format for sizes '
+                            'as dd.' % writeDescription, default=None)
+    
+    parser.add_argument('--read-iops', help='Limit %s to this many reads per second' % readDescription, default=None)
+    
+    if writeDescription is not None:
+        parser.add_argument('--write-iops', help='Limit %s to this many writes per second' % writeDescription,
+                            default=None)
+    
+    parser.add_argument('--throttle-file', help='Read limits from this file, which is reloaded when it changes or on '
+                        'SIGHUP, so that they can be changed while running', default=None)
+    parser.add_argument('--adaptive', help='Slow down reading when its latency rises, as when something else is '
+                        'using the disk', action='store_true')
+    parser.add_argument('--adaptive-latency', type=float, default=2.0, help='With --adaptive, slow down when reads '
+                        'take this many times longer than their recent average. Default is 2.0.')
+
+def throttleFromArguments(args):
+    """Returns the Throttle described by the options added by addThrottleArguments"""
+    if args.adaptive_latency <= 1:
+        raise ValueError('Adaptive latency factor must be greater than 1')
+    
+    def limit(value, isOperations):
+        return None if value is None else parseLimit(value, isOperations)
+    
+    return Throttle(limit(args.read_limit, False), limit(getattr(args, 'write_limit', None), False),
+                    limit(args.read_iops, True), limit(getattr(args, 'write_iops', None), True),
+                    controlPath=args.throttle_file, adaptive=args.adaptive, adaptiveLatency=args.adaptive_latency)
+
+def outputThrottledTime(metrics):
+    """Writes out how long reading and writing were held up by throttling, if they were at all"""
+    stageSeconds = metrics.summary()['stageSeconds']
+    readSeconds = stageSeconds.get('readThrottle', 0)
+    writeSeconds = stageSeconds.get('writeThrottle', 0)
+    
+    if readSeconds > 0 or writeSeconds > 0:
+        sys.stdout.write("Time spent throttled: %s reading, %s writing\n" % (humanReadableDuration(readSeconds),
+                                                                             humanReadableDuration(writeSeconds)))
@@ -0,0 +1,453 @@
+#!/usr/bin/env python2.7
+from __future__ import division
+import argparse
+import os
+import sys
+import threading
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from shared import (BackupError, BackupDataError, ManifestEntry, outputStatus, humanReadableSize,
+                    humanReadableSizeToBytes, humanReadableDuration, partsInSnapshot, partIndexFromName, partDeltaPaths,
+                    deltasInSnapshot, zeroPartDigest, fileOrDeviceSize, deviceIdentifierForSourceString,
+                    inProgressSnapshotName, manifestEntryForPartFile, manifestEntryForFile)
+from objectstore import ObjectStore, isObjectStoreSnapshot, readIndex, snapshotManifest, snapshotsInBackup
+from throttle import addThrottleArguments, throttleFromArguments, outputThrottledTime
+from metrics import Metrics
+
+def fileKey(paths):
+    """Returns what identifies the contents of a part made up of the files at paths. A file linked into several
+    snapshots has the same key in all of them, so it only has to be read once, while a file that's been modified since
+    it was last read gets a new key."""
+    return ','.join('%d:%d:%d:%d' % (stat.st_dev, stat.st_ino, stat.st_size, int(stat.st_mtime * 1000000))
+                    for stat in map(os.stat, paths))
+
+class VerifyJournal(object):
+    """Records the contents of each file, and each part of the source, as it's read, so that a verification that's
+    stopped can be continued later without reading them again. The journal is only written to when path is given."""
+    def __init__(self, path):
+        self.path = path
+        self.fileEntries = {}
+        self.sourceEntries = {}
+        self.file = None
+        
+        if path is None:
+            return
+        
+        if os.path.exists(path):
+            self._load()
+        
+        self.file = open(path, 'a')
+        
+        if os.path.getsize(path) == 0:
+            self.file.write('multipart-backup-verify 1\n')
+            self.file.flush()
+    
+    def _load(self):
+        with open(self.path, 'r') as f:
+            header = f.readline().split()
+            
+            if header != ['multipart-backup-verify', '1']:
+                raise BackupDataError('%s is not a verification resume file' % self.path)
+            
+            for line in f:
+                fields = line.split()
+                
+                # A line cut short by an interruption is simply read again
+                if len(fields) != 5 or fields[0] not in ('file', 'source'):
+                    continue
+                
+                entry = ManifestEntry(int(fields[2]), fields[3] == '1', fields[4])
+                
+                if fields[0] == 'file':
+                    self.fileEntries[fields[1]] = entry
+                else:
+                    self.sourceEntries[int(fields[1])] = entry
+    
+    def record(self, kind, key, entry):
+        if self.file is None:
+            return
+        
+        self.file.write('%s %s %d %d %s\n' % (kind, key, entry.size, 1 if entry.isZero else 0, entry.digest))
+        self.file.flush()
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+    
+    def remove(self):
+        self.close()
+        
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+class SnapshotCheck(object):
+    """The files making up each part of a snapshot and what its manifest says each part contains"""
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.name = os.path.basename(os.path.normpath(snapshot))
+        self.manifest = snapshotManifest(snapshot)
+        self.partPaths = {}
+        # Indexes of the parts that can't be checked at all, and have already been reported
+        self.unreadable = set()
+        self.problems = []
+        
+        if isObjectStoreSnapshot(snapshot):
+            self._findObjects()
+        else:
+            self._findParts()
+        
+        self._checkManifest()
+    
+    def _checkManifest(self):
+        """Checks that the parts and the manifest entries match up one to one, and that every part but the last is the
+        same size as the first"""
+        indexes = set(self.partPaths.keys()) | set(self.manifest.keys()) | self.unreadable
+        partCount = max(indexes) + 1 if len(indexes) > 0 else 0
+        
+        for index in xrange(partCount):
+            if index in self.unreadable:
+                continue
+            elif index not in self.partPaths:
+                self.problem('part_%08d is missing' % index)
+            elif len(self.manifest) > 0 and index not in self.manifest:
+                self.problem('part_%08d is not in the manifest' % index)
+        
+        if 0 not in self.manifest:
+            return
+        
+        partSize = self.manifest[0].size
+        
+        for index, entry in sorted(self.manifest.items()):
+            if entry.size > partSize or (entry.size != partSize and index != partCount - 1):
+                self.problem('part_%08d is %s bytes in the manifest, but the parts are %s bytes' %
+                             (index, entry.size, partSize))
+    
+    def _findParts(self):
+        chainedDeltas = set()
+        partNames = {}
+        
+        for name in partsInSnapshot(self.snapshot):
+            partNames.setdefault(partIndexFromName(name), []).append(name)
+        
+        for index, names in partNames.items():
+            # There's no telling which of them is the real part, so none of them can be trusted
+            if len(names) > 1:
+                self.problem('part_%08d is stored more than once: %s' % (index, ', '.join(names)))
+                self.unreadable.add(index)
+                continue
+            
+            partPath = os.path.join(self.snapshot, names[0])
+            self.partPaths[index] = [partPath] + partDeltaPaths(partPath)
+            chainedDeltas.update(os.path.basename(path) for path in self.partPaths[index][1:])
+        
+        # A delta left out of its part's chain is never applied, so whatever change it held has been lost
+        for name in deltasInSnapshot(self.snapshot):
+            if name not in chainedDeltas:
+                self.problem('%s is not part of any chain of deltas' % name)
+    
+    def _findObjects(self):
+        storePath, manifest, objectNames = readIndex(self.snapshot)
+        store = ObjectStore(storePath)
+        
+        for index, name in objectNames.items():
+            path = store.objectPath(name)
+            
+            if os.path.exists(path):
+                self.partPaths[index] = [path]
+            else:
+                self.unreadable.add(index)
+                self.problem('object %s, holding part_%08d, is missing from %s' % (name, index, storePath))
+    
+    def problem(self, message):
+        self.problems.append('%s: %s' % (self.name, message))
+    
+    def checkEntry(self, index, entry):
+        """Compares the contents read for the part at index with its manifest"""
+        expected = self.manifest.get(index)
+        
+        if expected is None:
+            return
+        
+        if entry.size != expected.size:
+            self.problem('part_%08d holds %s bytes, but its manifest says %s' % (index, entry.size, expected.size))
+        elif entry.digest != expected.digest:
+            self.problem('part_%08d does not match its digest in the manifest' % index)
+    
+    def checkEmptyPart(self, index):
+        """Checks an empty part, which stands for a part of all zeros, against its manifest without reading anything"""
+        expected = self.manifest.get(index)
+        
+        if expected is not None and (not expected.isZero or expected.digest != zeroPartDigest(expected.size)):
+            self.problem('part_%08d is empty, but its manifest says it holds data' % index)
+    
+    def unlinkedPartCount(self, previous):
+        """Returns the number of parts that are the same as in the previous snapshot of the same backup but are separate
+        files, such as when hard links were lost by copying the backup"""
+        if previous is None or isObjectStoreSnapshot(self.snapshot) or isObjectStoreSnapshot(previous.snapshot):
+            return 0
+        
+        count = 0
+        
+        for index, paths in self.partPaths.items():
+            previousPaths = previous.partPaths.get(index)
+            
+            if (previousPaths is None or [os.path.basename(p) for p in paths] !=
+                    [os.path.basename(p) for p in previousPaths] or self.manifest.get(index) is None or
+                    self.manifest.get(index) != previous.manifest.get(index)):
+                continue
+            
+            if fileKey(paths) != fileKey(previousPaths):
+                count += 1
+        
+        return count
+
+def snapshotsToVerify(paths):
+    """Returns the snapshots at paths, each of which can be a snapshot or a backup root, in which case all of its
+    finished snapshots are verified, oldest first"""
+    snapshots = []
+    
+    for path in paths:
+        if not os.path.isdir(path):
+            raise ValueError('"%s" is not a snapshot or backup root' % path)
+        
+        found = [s for s in snapshotsInBackup(path) if os.path.basename(s) != inProgressSnapshotName()]
+        
+        if len(found) == 0:
+            raise BackupDataError('No parts or snapshots found in %s' % path)
+        
+        snapshots.extend(os.path.normpath(s) for s in found if os.path.normpath(s) not in snapshots)
+    
+    return snapshots
+
+def verify(paths, source, blockSize, workerCount, throttle, resumePath, timeLimit):
+    """Reads every part of the snapshots at paths, each file linked into several of them only once, and checks them
+    against their manifests. If source is given, it's compared with the manifest of the last snapshot as well. Returns
+    0 if nothing was wrong, 1 if problems were found, and 2 if verification was stopped before it could finish."""
+    snapshots = snapshotsToVerify(paths)
+    checks = []
+    
+    for snapshot in snapshots:
+        outputStatus("Looking at %s ..." % snapshot)
+        checks.append(SnapshotCheck(snapshot))
+    
+    sys.stdout.write('\n')
+    journal = VerifyJournal(resumePath)
+    
+    # Each distinct file is read once, and the result checked against every snapshot it's part of
+    filePaths = {}
+    fileParts = {}
+    
+    for check in checks:
+        for index, partPaths in sorted(check.partPaths.items()):
+            if len(partPaths) == 1 and os.path.getsize(partPaths[0]) == 0:
+                check.checkEmptyPart(index)
+                continue
+            
+            key = fileKey(partPaths)
+            filePaths[key] = partPaths
+            fileParts.setdefault(key, []).append((check, index))
+    
+    work = [('file', key) for key in sorted(filePaths.keys()) if key not in journal.fileEntries]
+    totalBytes = sum(os.path.getsize(path) for kind, key in work for path in filePaths[key])
+    sourceParts = {}
+    sourceCheck = checks[-1]
+    
+    if source is not None:
+        sourceParts = sourcePartRanges(source, sourceCheck)
+        sourceWork = [('source', index) for index in sorted(sourceParts.keys())
+                      if index not in journal.sourceEntries]
+        work.extend(sourceWork)
+        totalBytes += sum(sourceParts[index][1] for kind, index in sourceWork)
+    
+    skippedCount = len(filePaths) + len(sourceParts) - len(work)
+    metrics = Metrics('verify', totalBytes)
+    throttle.metrics = metrics
+    stopping = threading.Event()
+    
+    def readWork(item):
+        kind, key = item
+        
+        # Once stopping, the remaining work is left for the next run
+        if stopping.is_set():
+            return kind, key, None, None
+        
+        try:
+            if kind == 'file':
+                # Empty parts are never read, so the part size they stand for doesn't matter
+                return kind, key, manifestEntryForPartFile(filePaths[key][0], None, blockSize, throttle), None
+            
+            with open(source, 'rb') as f:
+                offset, length = sourceParts[key]
+                f.seek(offset)
+                return kind, key, manifestEntryForFile(f, blockSize, length, throttle), None
+        except Exception as e:
+            # Besides I/O errors, a corrupt compressed part or delta can fail to decode in any number of ways
+            return kind, key, None, str(e)
+    
+    for key, entry in journal.fileEntries.items():
+        for check, index in fileParts.get(key, []):
+            check.checkEntry(index, entry)
+    
+    for index, entry in journal.sourceEntries.items():
+        if index in sourceParts:
+            checkSourceEntry(sourceCheck, index, entry)
+    
+    if skippedCount > 0:
+        sys.stdout.write("Resuming, %s part(s) were already read\n" % skippedCount)
+    
+    if throttle.controlPath is not None:
+        throttle.installSignalHandler()
+    
+    pool = ThreadPool(workerCount)
+    readCount = 0
+    stopReason = None
+    
+    try:
+        results = pool.imap_unordered(readWork, work)
+        
+        while True:
+            try:
+                kind, key, entry, error = results.next(1)
+            except StopIteration:
+                break
+            except TimeoutError:
+                if timeLimit is not None and metrics.elapsed() > timeLimit and not stopping.is_set():
+                    stopReason = 'the time limit was reached'
+                    stopping.set()
+                
+                continue
+            except KeyboardInterrupt:
+                stopReason = 'it was interrupted'
+                stopping.set()
+                sys.stdout.write("\nStopping once the parts being read are done...\n")
+                continue
+            
+            if entry is None and error is None:
+                continue
+            
+            readCount += 1
+            byteCount = (sum(os.path.getsize(path) for path in filePaths[key]) if kind == 'file' else
+                         sourceParts[key][1])
+            metrics.partFinished(None, byteCount)
+            
+            if kind == 'file':
+                for check, index in fileParts[key]:
+                    if error is not None:
+                        check.problem('part_%08d could not be read: %s' % (index, error))
+                    else:
+                        check.checkEntry(index, entry)
+            elif error is not None:
+                sourceCheck.problem('part_%08d of the source could not be read: %s' % (key, error))
+            else:
+                checkSourceEntry(sourceCheck, key, entry)
+            
+            if entry is not None:
+                journal.record(kind, key, entry)
+            
+            eta = metrics.eta()
+            outputStatus("Verified %s of %s, %s remaining" % (humanReadableSize(metrics.bytesDone),
+                                                                humanReadableSize(totalBytes),
+                                                                humanReadableDuration(eta) if eta is not None else '?'))
+            
+            if timeLimit is not None and metrics.elapsed() > timeLimit and not stopping.is_set():
+                stopReason = 'the time limit was reached'
+                stopping.set()
+    finally:
+        pool.close()
+        pool.join()
+        throttle.removeSignalHandler()
+        metrics.close(stopReason is None)
+    
+    sys.stdout.write('\n')
+    unlinkedCount = sum(check.unlinkedPartCount(previous) for previous, check in zip([None] + checks[:-1], checks)
+                        if previous is not None and os.path.dirname(previous.snapshot) ==
+                        os.path.dirname(check.snapshot))
+    problems = [problem for check in checks for problem in check.problems]
+    
+    for problem in problems:
+        sys.stdout.write("%s\n" % problem)
+    
+    if unlinkedCount > 0:
+        sys.stdout.write("Note: %s part(s) are the same as in the snapshot before but aren't linked to it, taking up "
+                         "extra space. This is expected for snapshots made with --reflink.\n" % unlinkedCount)
+    
+    outputThrottledTime(metrics)
+    sys.stdout.write("Read %s part(s) in %s\n" % (readCount, humanReadableDuration(metrics.elapsed())))
+    
+    if stopReason is not None:
+        journal.close()
+        sys.stdout.write("Stopped because %s, with %s problem(s) found so far.%s\n" %
+                         (stopReason, len(problems), ' Run again with the same --resume-file to continue.'
+                          if resumePath is not None else ''))
+        return 1 if len(problems) > 0 else 2
+    
+    # The next run starts over
+    journal.remove()
+    sys.stdout.write("Verified %s snapshot(s), %s problem(s) found\n" % (len(checks), len(problems)))
+    return 1 if len(problems) > 0 else 0
+
+def sourcePartRanges(source, check):
+    """Returns a dictionary mapping part index to the offset and length of each part in the source, going by the
+    manifest of the snapshot check is for"""
+    manifest = check.manifest
+    
+    if len(manifest) == 0:
+        raise BackupDataError('%s has no manifest to compare the source with' % check.snapshot)
+    
+    if 0 not in manifest:
+        raise BackupDataError('The manifest of %s is missing its first part' % check.snapshot)
+    
+    partSize = manifest[0].size
+    imageSize = sum(entry.size for entry in manifest.values())
+    sourceSize = fileOrDeviceSize(source)
+    
+    if sourceSize != imageSize:
+        check.problem('the source is %s bytes, but the snapshot holds %s' % (sourceSize, imageSize))
+    
+    return dict((index, (index * partSize, entry.size)) for index, entry in manifest.items())
+
+def checkSourceEntry(check, index, entry):
+    expected = check.manifest[index]
+    
+    if entry.size != expected.size or entry.digest != expected.digest:
+        check.problem('part_%08d differs from the source' % index)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the parts of a multi-part backup against their manifests, and "
+                                     "optionally against the source")
+    parser.add_argument('snapshots', nargs='+', metavar='snapshot', help="Snapshot to verify, or backup root to verify "
+                        "every snapshot of")
+    parser.add_argument('-bs', '--block-size', help='Block size for reading parts. Uses same format for sizes as dd. '
+                        'Defaults to 1 MB.', type=str, default=str(1024*1024))
+    parser.add_argument('-w', '--workers', type=int, default=2, help='Number of threads reading and hashing parts at '
+                        'the same time. Default is 2.')
+    parser.add_argument('--source', help='Also compare the last snapshot with this file or device', default=None)
+    parser.add_argument('-u', '--uuid', help='Indicates the source is a partition UUID', action='store_true')
+    parser.add_argument('--resume-file', help='Record progress in this file, so that an interrupted verification can '
+                        'continue where it left off', default=None)
+    parser.add_argument('--time-limit', type=float, default=None, help='Stop after this many minutes, so that the '
+                        'rest can be verified later with --resume-file')
+    addThrottleArguments(parser, 'reading parts and the source')
+    args = parser.parse_args()
+    
+    try:
+        blockSize = humanReadableSizeToBytes(args.block_size)
+        throttle = throttleFromArguments(args)
+        
+        if args.workers < 1:
+            raise ValueError('Worker count must be at least 1')
+        
+        if args.uuid and args.source is None:
+            raise ValueError('--uuid can only be used with --source')
+        
+        source = deviceIdentifierForSourceString(args.source, args.uuid) if args.source is not None else None
+        timeLimit = args.time_limit * 60 if args.time_limit is not None else None
+        return verify(args.snapshots, source, blockSize, args.workers, throttle, args.resume_file, timeLimit)
+    except (BackupError, BackupDataError, ValueError) as e:
+        sys.stderr.write('Error: %s\n' % e)
+        return 1
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)